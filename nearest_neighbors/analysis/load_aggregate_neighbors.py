@@ -5,7 +5,8 @@ from ..data_models import *
 from ..database import *
 
 def loadAggregateNeighbors(group_name, src, trg, config, db, k=10, neighbor_type=None,
-        spec='', filter_spec='', query_spec='', vocab_spec=''):
+        spec='', filter_spec='', query_spec='', vocab_spec='',
+        conflict_policy=ConflictPolicy.FAIL):
     log.writeln('  >> Loading pre-calculated aggregate nearest neighbors')
     aggregate_neighbors = nn_io.loadPairedNeighbors(
         src, None, trg, config, k, aggregate=True, with_distances=True,
@@ -32,7 +33,22 @@ def loadAggregateNeighbors(group_name, src, trg, config, db, k=10, neighbor_type
                 neighbor_key=nbr_key,
                 mean_distance=dist
             ))
-    db.insertOrUpdate(nbrs, neighbor_type=neighbor_type)
+    summary = db.insertOrUpdate(nbrs, neighbor_type=neighbor_type,
+        conflict_policy=conflict_policy)
+
+    log.writeln('  >> Staged {0:,} neighbor records: {1:,} new, {2:,} already saved'.format(
+        summary['staged'], summary['inserted'], summary['existing']
+    ))
+    if summary['conflicts'] > 0:
+        log.writeln('  >> {0:,} records conflicted with saved distances ({1})'.format(
+            summary['conflicts'],
+            ('overwritten' if conflict_policy == ConflictPolicy.OVERWRITE else 'skipped')
+        ))
+        for (key, nbr_key, source_ID, saved_dist, provided_dist) in summary['conflict_examples']:
+            log.writeln('       {0} <-> {1}  saved: {2:.4f}  provided: {3:.4f}'.format(
+                key, nbr_key, saved_dist, provided_dist
+            ))
+    return summary
 
 
 if __name__ == '__main__':
@@ -61,6 +77,10 @@ if __name__ == '__main__':
             default='', help='specifier of query key set used to generate neighbor file')
         parser.add_option('--vocab-spec', dest='vocab_spec',
             default='', help='specifier of vocabulary set used to interpret neighbor file')
+        parser.add_option('--on-conflict', dest='conflict_policy',
+            type='choice', choices=ConflictPolicy.choices(), default=ConflictPolicy.FAIL,
+            help='what to do with neighbors already saved with a different distance:'
+                 ' {0} (default: %default)'.format('/'.join(ConflictPolicy.choices())))
         parser.add_option('-l', '--logfile', dest='logfile',
             help='name of file to write log contents to (empty for stdout)',
             default=None)
@@ -93,6 +113,7 @@ if __name__ == '__main__':
         ('Key filter specifier', options.filter_spec),
         ('Query key set specifier', options.query_spec),
         ('Vocabulary set specifier', options.vocab_spec),
+        ('Conflict policy', options.conflict_policy),
     ], 'Loading aggregate neighbors into DB')
 
     log.writeln('Reading configuration file from %s...' % options.configf)
@@ -121,7 +142,8 @@ if __name__ == '__main__':
         spec=options.neighbor_spec,
         filter_spec=options.filter_spec,
         query_spec=options.query_spec,
-        vocab_spec=options.vocab_spec
+        vocab_spec=options.vocab_spec,
+        conflict_policy=options.conflict_policy
     )
     log.writeln('Done.')
 
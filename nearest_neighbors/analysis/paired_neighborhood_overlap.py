@@ -5,26 +5,107 @@ from .. import nn_io
 from ..data_models import *
 from ..database import EmbeddingNeighborhoodDatabase
 
+def alignNeighborSets(neighbor_sets):
+    '''Converts a list of neighbor sets (as returned by
+    nn_io.loadPairedNeighbors) into fixed-width int32 neighbor-ID matrices,
+    aligned by key.
+
+    Returns (keys, matrices, present, counts):
+      keys :: list of all keys found in any of the neighbor sets
+      matrices :: (sets x keys x k) int32 array of neighbor IDs; each row
+                  holds the distinct neighbors of a key, padded with -1
+      present :: (sets x keys) boolean array, True where the key is in the set
+      counts :: (sets x keys) number of distinct neighbors for each key
+    '''
+    key_index = {}
+    for neighbors in neighbor_sets:
+        for key in neighbors:
+            if not key in key_index:
+                key_index[key] = len(key_index)
+    keys = list(key_index.keys())
+
+    # flatten each neighbor set to (row, neighbor) pairs
+    flat_rows, flat_neighbors, row_lengths = [], [], []
+    for neighbors in neighbor_sets:
+        flat_rows.append([key_index[key] for key in neighbors])
+        row_lengths.append([len(nbr_info) for nbr_info in neighbors.values()])
+        flat_neighbors.append([
+            nbr_ID
+                for nbr_info in neighbors.values()
+                for (nbr_ID, dist) in nbr_info
+        ])
+    width = max([max(lengths, default=0) for lengths in row_lengths], default=0)
+    neighbor_index = {
+        nbr_ID: i
+            for (i, nbr_ID) in enumerate(dict.fromkeys(
+                nbr_ID
+                    for nbr_IDs in flat_neighbors
+                    for nbr_ID in nbr_IDs
+            ))
+    }
+
+    matrices = np.full((len(neighbor_sets), len(keys), width), -1, dtype=np.int32)
+    present = np.zeros((len(neighbor_sets), len(keys)), dtype=bool)
+    for i in range(len(neighbor_sets)):
+        rows = np.array(flat_rows[i], dtype=np.int64)
+        lengths = np.array(row_lengths[i], dtype=np.int64)
+        nbr_IDs = np.fromiter(
+            map(neighbor_index.__getitem__, flat_neighbors[i]),
+            dtype=np.int32,
+            count=len(flat_neighbors[i])
+        )
+        row_starts = np.cumsum(lengths) - lengths
+        columns = np.arange(len(nbr_IDs)) - np.repeat(row_starts, lengths)
+        matrices[i, np.repeat(rows, lengths), columns] = nbr_IDs
+        present[i, rows] = True
+
+    # neighbor lists are treated as sets, so blank out any repeated neighbors
+    matrices.sort(axis=2)
+    repeated = (matrices[:, :, 1:] == matrices[:, :, :-1]) & (matrices[:, :, 1:] >= 0)
+    matrices[:, :, 1:][repeated] = -1
+    counts = (matrices >= 0).sum(axis=2)
+
+    return keys, matrices, present, counts
+
+def _pairedOverlap(matrix_1, present_1, counts_1, matrix_2, present_2, counts_2):
+    '''Overlap between two aligned neighbor matrices, for every key at once.
+
+    Rows hold distinct neighbor IDs, so after sorting the two rows for a key
+    together, each shared neighbor shows up as one pair of equal adjacent
+    entries.
+
+    Returns (overlaps, in_union), where in_union marks the keys present in
+    either neighbor set (overlaps for other keys are 0).
+    '''
+    merged = np.sort(np.concatenate([matrix_1, matrix_2], axis=1), axis=1)
+    overlap_counts = (
+        (merged[:, 1:] == merged[:, :-1])
+        & (merged[:, 1:] >= 0)
+    ).sum(axis=1)
+
+    in_union = present_1 | present_2
+    denominators = np.maximum(counts_1, counts_2)
+    if np.any(in_union & (denominators == 0)):
+        raise ZeroDivisionError('division by zero')
+    overlaps = np.zeros(len(overlap_counts), dtype=np.float64)
+    np.divide(overlap_counts, denominators, out=overlaps, where=in_union)
+
+    return overlaps, in_union
+
 def getNeighborhoodOverlap(neighbors_1, neighbors_2):
-    overlap_percentages = {}
     ## TODO: under current workflow, union vs intersection should be identical here.
     ## However, should really check that.
-    total_keys = set(neighbors_1.keys()).union(set(neighbors_2.keys()))
-    #log.writeln('[INFO] Neighbors 1 -- %d keys' % len(neighbors_1))
-    #log.writeln('[INFO] Neighbors 2 -- %d keys' % len(neighbors_2))
-    #log.writeln('[INFO] Union -- %d keys' % len(total_keys))
-
-    for key in total_keys:
-        nbr_info_1 = neighbors_1.get(key, [])
-        nbr_info_2 = neighbors_2.get(key, [])
-        nbrs_1 = set([nbr_ID for (nbr_ID, dist) in nbr_info_1])
-        nbrs_2 = set([nbr_ID for (nbr_ID, dist) in nbr_info_2])
-        overlap_count = len(nbrs_1.intersection(nbrs_2))
-        overlap = overlap_count / (max(len(nbrs_1), len(nbrs_2)))
-        #log.writeln('[DEBUG] Key "%s"  Neighbors 1: [%s]  Neighbors 2: [%s]  Overlap: %.1f%%' % (
-        #    key, ','.join(nbrs_1), ','.join(nbrs_2), 100*overlap
-        #))
-        overlap_percentages[key] = overlap
+    (keys, matrices, present, counts) = alignNeighborSets([neighbors_1, neighbors_2])
+    (overlaps, in_union) = _pairedOverlap(
+        matrices[0], present[0], counts[0],
+        matrices[1], present[1], counts[1]
+    )
+    overlaps = overlaps.tolist()
+
+    overlap_percentages = {
+        keys[row]: overlaps[row]
+            for row in np.flatnonzero(in_union)
+    }
 
     return overlap_percentages
 
@@ -33,24 +114,41 @@ def pairedOverlapDistributions(neighbor_sets_1, neighbor_sets_2, self_paired=Fal
     #  if self_paired (i.e., comparing neighbors pulled from runs for the same
     #    subset), only do the unique pairs
     #  otherwise, take full cross-product
-    overlap_percentage_samples = {}
+    if neighbor_sets_1 is neighbor_sets_2:
+        all_neighbor_sets, offset = list(neighbor_sets_1), 0
+    else:
+        all_neighbor_sets = list(neighbor_sets_1) + list(neighbor_sets_2)
+        offset = len(neighbor_sets_1)
+    (keys, matrices, present, counts) = alignNeighborSets(all_neighbor_sets)
+
+    pairs = []
     for i in range(len(neighbor_sets_1)):
         inner_loop_start = (i+1) if self_paired else 0
         for j in range(inner_loop_start, len(neighbor_sets_2)):
-            overlap_percentages = getNeighborhoodOverlap(
-                neighbor_sets_1[i],
-                neighbor_sets_2[j]
-            )
+            pairs.append((i, offset+j))
 
-            for (key, perc) in overlap_percentages.items():
-                if not key in overlap_percentage_samples:
-                    overlap_percentage_samples[key] = []
-                overlap_percentage_samples[key].append(perc)
+    # (keys x pairs) overlap samples, and which samples exist for each key
+    overlap_samples = np.zeros((len(keys), len(pairs)), dtype=np.float64)
+    sampled = np.zeros((len(keys), len(pairs)), dtype=bool)
+    for p in range(len(pairs)):
+        (i, j) = pairs[p]
+        (overlap_samples[:, p], sampled[:, p]) = _pairedOverlap(
+            matrices[i], present[i], counts[i],
+            matrices[j], present[j], counts[j]
+        )
 
     # squish overlap distributions for each individual key down to its mean
+    overlap_means = np.zeros(len(keys), dtype=np.float64)
+    fully_sampled = sampled.all(axis=1)
+    if len(pairs) > 0 and fully_sampled.any():
+        overlap_means[fully_sampled] = np.mean(overlap_samples[fully_sampled], axis=1)
+    # keys that were only in some of the neighbor sets
+    for row in np.flatnonzero(sampled.any(axis=1) & ~fully_sampled):
+        overlap_means[row] = np.mean(overlap_samples[row, sampled[row]])
+
     overlap_percentage_means = {
-        key: np.mean(samples)
-            for (key, samples) in overlap_percentage_samples.items()
+        keys[row]: overlap_means[row]
+            for row in np.flatnonzero(sampled.any(axis=1))
     }
 
     return overlap_percentage_means
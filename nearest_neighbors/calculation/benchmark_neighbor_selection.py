@@ -0,0 +1,89 @@
+'''
+Benchmark top-k neighbor selection over a batch of distance vectors:
+full per-row argsort (previous behavior) vs. batched partial selection
+(model._selectNeighbors)
+'''
+
+import time
+import numpy as np
+from hedgepig_logger import log
+from . import model
+
+def _fullSortSelection(averaged_distances, batch_input, top_k):
+    nearest_neighbors = []
+    for i in range(len(batch_input)):
+        sorted_neighbors = np.argsort(averaged_distances[i])
+        if sorted_neighbors[0] == batch_input[i]: sorted_neighbors = sorted_neighbors[1:]
+        nearest_neighbors.append(sorted_neighbors[:top_k])
+    return nearest_neighbors
+
+def _time(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def benchmarkSelection(vocab_size, batch_size, top_k, repeats=5, seed=1):
+    rng = np.random.default_rng(seed)
+    averaged_distances = rng.random((batch_size, vocab_size), dtype=np.float32)
+    batch_input = list(range(batch_size))
+    # make each query its own nearest neighbor, as in real data
+    averaged_distances[batch_input, batch_input] = 0.
+
+    full_sort = _time(
+        lambda: _fullSortSelection(averaged_distances, batch_input, top_k),
+        repeats
+    )
+    partial = _time(
+        lambda: model._selectNeighbors(averaged_distances, batch_input, top_k=top_k, no_self=True),
+        repeats
+    )
+    return full_sort, partial
+
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog')
+        parser.add_option('--vocab-sizes', dest='vocab_sizes',
+                help='comma-separated list of vocabulary sizes to benchmark (default: %default)',
+                default='100000,500000')
+        parser.add_option('--batch-size', dest='batch_size',
+                type='int', default=25,
+                help='number of queries per batch (default: %default)')
+        parser.add_option('-k', '--nearest-neighbors', dest='k',
+                help='number of nearest neighbors to select (default: %default)',
+                type='int', default=25)
+        parser.add_option('--repeats', dest='repeats',
+                type='int', default=5,
+                help='number of timing repeats (best is reported; default: %default)')
+        parser.add_option('-l', '--logfile', dest='logfile',
+                help='name of file to write log contents to (empty for stdout)',
+                default=None)
+        (options, args) = parser.parse_args()
+        options.vocab_sizes = [int(v) for v in options.vocab_sizes.split(',')]
+        return options
+
+    options = _cli()
+    log.start(options.logfile)
+    log.writeConfig([
+        ('Vocabulary sizes', ', '.join(['{0:,}'.format(v) for v in options.vocab_sizes])),
+        ('Batch size', options.batch_size),
+        ('Number of nearest neighbors', options.k),
+        ('Timing repeats', options.repeats),
+    ], 'Nearest neighbor selection benchmark')
+
+    for vocab_size in options.vocab_sizes:
+        full_sort, partial = benchmarkSelection(
+            vocab_size,
+            options.batch_size,
+            options.k,
+            repeats=options.repeats
+        )
+        log.writeln('Vocab {0:,}  full argsort: {1:.2f}ms/batch  partial selection: {2:.2f}ms/batch  ({3:.1f}x)'.format(
+            vocab_size, 1000*full_sort, 1000*partial, full_sort/partial
+        ))
+
+    log.stop()
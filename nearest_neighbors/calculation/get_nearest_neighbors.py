@@ -3,23 +3,29 @@ Get the top k nearest neighbors for a set of embeddings and save to a file
 '''
 
 import multiprocessing as mp
-import tensorflow as tf
 import numpy as np
 import codecs
 import os
+import time
+import queue
 import pyemblib
 from hedgepig_logger import log
 from drgriffis.common import util
 from . import model
 from .. import nn_io
 
+# seconds to wait for each (already-exited) worker's throughput stats
+STATS_TIMEOUT = 30
+
 class _SIGNALS:
     HALT = -1
     COMPUTE = 1
 
 def KNearestNeighbors(emb_arrs, node_IDs, top_k, neighbor_file, threads=2,
         batch_size=5, completed_neighbors=None, with_distances=False,
-        neighbor_file_mode='w'):
+        neighbor_file_mode='w', backend=model.Backend.TENSORFLOW,
+        memory_budget=None, fused_replicates=False,
+        output_format=nn_io.NeighborFileFormat.TEXT, node_map=None):
     '''docstring goes here
     '''
     # set up threads
@@ -33,29 +39,40 @@ def KNearestNeighbors(emb_arrs, node_IDs, top_k, neighbor_file, threads=2,
         all_indices = filtered_indices
         log.writeln('  >> Filtered out {0:,} completed indices'.format(len(emb_arrs[0]) - len(filtered_indices)))
         log.writeln('  >> Filtered set size: {0:,}'.format(len(all_indices)))
-    index_subsets = util.prepareForParallel(all_indices, threads-1, data_only=True)
-    nn_q = mp.Queue()
-    nn_writer = mp.Process(
-        target=_nn_writer,
-        args=(neighbor_file, node_IDs, None, nn_q, with_distances, neighbor_file_mode)
-    )
-    computers = [
-        mp.Process(
-            target=_threadedNeighbors,
-            args=(index_subsets[i], emb_arrs, batch_size, top_k, nn_q, with_distances)
+    task_q = _queueBatches(all_indices, batch_size, threads-1)
+    (worker_emb_arrs, shared_emb_arrs) = _shareEmbeddings(emb_arrs, backend, fused_replicates)
+    try:
+        nn_q = mp.Queue()
+        stats_q = mp.Queue()
+        nn_writer = mp.Process(
+            target=_nn_writer,
+            args=(neighbor_file, node_IDs, None, nn_q, with_distances, neighbor_file_mode,
+                output_format, node_map, None)
         )
-            for i in range(threads - 1)
-    ]
-    nn_writer.start()
-    log.writeln('2 | Neighbor computation')
-    util.parallelExecute(computers)
-    nn_q.put(_SIGNALS.HALT)
-    nn_writer.join()
+        computers = [
+            mp.Process(
+                target=_threadedNeighbors,
+                args=(i+1, task_q, worker_emb_arrs, top_k, nn_q, stats_q, with_distances, backend, memory_budget, fused_replicates)
+            )
+                for i in range(threads - 1)
+        ]
+        nn_writer.start()
+        log.writeln('2 | Neighbor computation')
+        util.parallelExecute(computers)
+        nn_q.put(_SIGNALS.HALT)
+        nn_writer.join()
+        _reportWorkerThroughput(stats_q, computers)
+    finally:
+        if shared_emb_arrs:
+            shared_emb_arrs.close()
 
 def KNearestNeighborsFromQueries(emb_arrs, node_IDs, query_emb_arrs,
         query_node_IDs, top_k, neighbor_file, threads=2,
         batch_size=5, completed_neighbors=None, with_distances=False,
-        neighbor_file_mode='w'):
+        neighbor_file_mode='w', backend=model.Backend.TENSORFLOW,
+        memory_budget=None, fused_replicates=False,
+        output_format=nn_io.NeighborFileFormat.TEXT, node_map=None,
+        query_node_map=None):
     '''docstring goes here
     '''
     # set up threads
@@ -70,90 +87,217 @@ def KNearestNeighborsFromQueries(emb_arrs, node_IDs, query_emb_arrs,
         all_indices = filtered_indices
         log.writeln('  >> Filtered out {0:,} completed indices'.format(len(emb_arrs[0]) - len(filtered_indices)))
         log.writeln('  >> Filtered set size: {0:,}'.format(len(all_indices)))
-    index_subsets = util.prepareForParallel(all_indices, threads-1, data_only=True)
-    nn_q = mp.Queue()
-    nn_writer = mp.Process(
-        target=_nn_writer,
-        args=(neighbor_file, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode)
-    )
-    computers = [
-        mp.Process(
-            target=_threadedCrossSetNeighbors,
-            args=(index_subsets[i], query_emb_arrs, emb_arrs, batch_size, top_k, nn_q, with_distances)
+    task_q = _queueBatches(all_indices, batch_size, threads-1)
+    (worker_emb_arrs, shared_emb_arrs) = _shareEmbeddings(emb_arrs, backend, fused_replicates)
+    try:
+        nn_q = mp.Queue()
+        stats_q = mp.Queue()
+        nn_writer = mp.Process(
+            target=_nn_writer,
+            args=(neighbor_file, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode,
+                output_format, node_map, query_node_map)
         )
-            for i in range(threads - 1)
+        computers = [
+            mp.Process(
+                target=_threadedCrossSetNeighbors,
+                args=(i+1, task_q, query_emb_arrs, worker_emb_arrs, top_k, nn_q, stats_q, with_distances, backend, memory_budget, fused_replicates)
+            )
+                for i in range(threads - 1)
+        ]
+        nn_writer.start()
+        log.writeln('2 | Neighbor computation')
+        util.parallelExecute(computers)
+        nn_q.put(_SIGNALS.HALT)
+        nn_writer.join()
+        _reportWorkerThroughput(stats_q, computers)
+    finally:
+        if shared_emb_arrs:
+            shared_emb_arrs.close()
+
+def _queueBatches(all_indices, batch_size, num_workers):
+    '''Queue up all batches of indices to compute, for workers to pull from
+    on demand (so that faster workers take on more of the load), followed by
+    a HALT signal for each worker.
+    '''
+    task_q = mp.Queue()
+    for ix in range(0, len(all_indices), batch_size):
+        task_q.put(all_indices[ix:ix+batch_size])
+    for _ in range(num_workers):
+        task_q.put(_SIGNALS.HALT)
+    return task_q
+
+def _reportWorkerThroughput(stats_q, workers, timeout=STATS_TIMEOUT):
+    '''Log the throughput statistics reported by each (joined) worker process.
+
+    Raises RuntimeError if any worker exited abnormally or never reported,
+    as its share of the neighbors will be missing from the output.
+    '''
+    log.writeln('3 | Worker throughput')
+    failed = [
+        (i+1, p.exitcode)
+            for (i, p) in enumerate(workers)
+            if p.exitcode != 0
     ]
-    nn_writer.start()
-    log.writeln('2 | Neighbor computation')
-    util.parallelExecute(computers)
-    nn_q.put(_SIGNALS.HALT)
-    nn_writer.join()
+    if len(failed) > 0:
+        raise RuntimeError('Neighbor computation failed: {0}'.format(
+            ', '.join('worker {0} exited with code {1}'.format(worker_ID, exitcode)
+                for (worker_ID, exitcode) in failed)
+        ))
+    all_stats = []
+    for _ in range(len(workers)):
+        try:
+            all_stats.append(stats_q.get(timeout=timeout))
+        except queue.Empty:
+            raise RuntimeError('Neighbor computation failed: only {0} of {1} workers reported completion'.format(
+                len(all_stats), len(workers)
+            ))
+    all_stats.sort()
+    for (worker_ID, num_queries, num_batches, compute_time, total_time) in all_stats:
+        log.writeln('  >> Worker {0}: {1:,} queries in {2:,} batches, {3:.1f} queries/s ({4:.1f}s computing, {5:.1f}s total)'.format(
+            worker_ID,
+            num_queries,
+            num_batches,
+            (num_queries / total_time) if total_time > 0 else 0.,
+            compute_time,
+            total_time
+        ))
+
+def _shareEmbeddings(emb_arrs, backend, fused_replicates):
+    '''For the NumPy backend, place the unit-normed embedding matrices in
+    shared memory once, for all worker processes to attach to without
+    copying.  (The TensorFlow backend copies the matrices into its own
+    graph, so they are passed as-is.)
+
+    Returns the embedding arrays to pass to workers, and the shared memory
+    object (if any) to release once they are done.
+    '''
+    if backend == model.Backend.NUMPY:
+        t_sub = log.startTimer('  >> Placing normalized embeddings in shared memory...')
+        shared_emb_arrs = model.SharedEmbeddingMatrices(emb_arrs, fused=fused_replicates)
+        log.stopTimer(t_sub, message='  >> Shared {0:,} bytes in {1}s.'.format(
+            shared_emb_arrs.matrix.nbytes, '{0:.2f}'
+        ))
+        return (shared_emb_arrs, shared_emb_arrs)
+    else:
+        return (emb_arrs, None)
 
-def _nn_writer(neighborf, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode):
-    stream = open(neighborf, neighbor_file_mode)
-    stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+def _nn_writer(neighborf, node_IDs, query_node_IDs, nn_q, with_distances, neighbor_file_mode,
+        output_format, node_map, query_node_map):
+    write_text = output_format in (nn_io.NeighborFileFormat.TEXT, nn_io.NeighborFileFormat.BOTH)
+    write_binary = output_format in (nn_io.NeighborFileFormat.BINARY, nn_io.NeighborFileFormat.BOTH)
+
+    if write_text:
+        stream = open(neighborf, neighbor_file_mode)
+        stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+    binary_query_IDs, binary_neighbors, binary_distances = [], [], []
 
     total = len(node_IDs) if query_node_IDs is None else len(query_node_IDs)
 
+    # map indices to node IDs for a whole batch at a time
+    node_IDs = np.array(node_IDs)
+    if query_node_IDs is None:
+        src_node_IDs = node_IDs
+    else:
+        src_node_IDs = np.array(query_node_IDs)
+
     result = nn_q.get()
     log.track(message='  >> Processed {0}/{1:,} samples'.format('{0:,}', total), writeInterval=50)
     while result != _SIGNALS.HALT:
-        (ix, neighbors) = result
-        if with_distances:
-            mapped_neighbors = [
-                (node_IDs[nbr], dist)
-                    for (nbr, dist) in neighbors
-            ]
-        else:
-            mapped_neighbors = [
-                node_IDs[nbr]
-                    for nbr in neighbors
-            ]
+        (batch, neighbors, distances) = result
 
-        if query_node_IDs is None:
-            src_ID = node_IDs[ix]
+        # rows may be padded with -1 if fewer than k neighbors were found
+        valid = (neighbors >= 0)
+        if valid.all():
+            neighbor_counts = None
         else:
-            src_ID = query_node_IDs[ix]
-
-        nn_io.writeNeighborFileLine(
-            stream,
-            src_ID,
-            mapped_neighbors,
-            with_distances=with_distances
-        )
-        log.tick()
+            neighbor_counts = valid.sum(axis=1)
+        mapped_neighbors = node_IDs[np.where(valid, neighbors, 0)]
+
+        if write_text:
+            nn_io.writeNeighborFileLines(
+                stream,
+                src_node_IDs[batch],
+                mapped_neighbors,
+                distances=(distances if with_distances else None),
+                neighbor_counts=neighbor_counts
+            )
+        if write_binary:
+            binary_query_IDs.append(src_node_IDs[batch])
+            binary_neighbors.append(np.where(valid, mapped_neighbors, -1))
+            if with_distances:
+                binary_distances.append(distances)
+        for _ in range(len(batch)):
+            log.tick()
         result = nn_q.get() 
     log.flushTracker()
 
-def _threadedNeighbors(thread_indices, emb_arrs, batch_size, top_k, nn_q, with_distances):
-    sess = tf.Session()
-    grph = model.MultiNearestNeighbors(sess, emb_arrs)
-
-    ix = 0
-    while ix < len(thread_indices):
-        batch = thread_indices[ix:ix+batch_size]
-        nn = grph.nearestNeighbors(batch, indices=True, top_k=top_k, no_self=True, with_distances=with_distances)
-        for i in range(len(batch)):
-            nn_q.put((batch[i], nn[i]))
-        ix += batch_size
-
-def _threadedCrossSetNeighbors(thread_indices, src_emb_arrs, dest_emb_arrs, batch_size, top_k, nn_q, with_distances):
-    sess = tf.Session()
-    grph = model.MultiNearestNeighbors(sess, dest_emb_arrs)
-
-    ix = 0
-    while ix < len(thread_indices):
-        batch = thread_indices[ix:ix+batch_size]
+    if write_text:
+        stream.close()
+    if write_binary and len(binary_query_IDs) > 0:
+        binary_neighborf = nn_io.binaryNeighborFilePath(neighborf)
+        log.writeln('  >> Writing binary neighbor file to %s' % binary_neighborf)
+        nn_io.writeBinaryNeighborFile(
+            binary_neighborf,
+            np.concatenate(binary_query_IDs),
+            np.concatenate(binary_neighbors),
+            distances=(np.concatenate(binary_distances) if with_distances else None),
+            node_map=node_map,
+            query_node_map=query_node_map,
+            append=(neighbor_file_mode == 'a')
+        )
+
+def _sendBatch(nn_q, batch, nn, with_distances):
+    '''Send a whole batch of results to the writer as one message of compact
+    arrays: query indices, neighbor index matrix, and (optional) distances.
+    '''
+    (neighbors, distances) = nn
+    nn_q.put((
+        np.array(batch, dtype=np.int32),
+        neighbors,
+        (distances if with_distances else None)
+    ))
+
+def _threadedNeighbors(worker_ID, task_q, emb_arrs, top_k, nn_q, stats_q, with_distances, backend, memory_budget, fused_replicates):
+    start_time = time.time()
+    grph = model.buildMultiNearestNeighbors(emb_arrs, backend=backend,
+        memory_budget=memory_budget, fused=fused_replicates)
+
+    num_queries, num_batches, compute_time = 0, 0, 0.
+    batch = task_q.get()
+    while batch != _SIGNALS.HALT:
+        t = time.time()
+        nn = grph.nearestNeighbors(batch, indices=True, top_k=top_k, no_self=True,
+            with_distances=with_distances, as_matrices=True)
+        compute_time += time.time() - t
+        _sendBatch(nn_q, batch, nn, with_distances)
+        num_queries += len(batch)
+        num_batches += 1
+        batch = task_q.get()
+    stats_q.put((worker_ID, num_queries, num_batches, compute_time, time.time() - start_time))
+
+def _threadedCrossSetNeighbors(worker_ID, task_q, src_emb_arrs, dest_emb_arrs, top_k, nn_q, stats_q, with_distances, backend, memory_budget, fused_replicates):
+    start_time = time.time()
+    grph = model.buildMultiNearestNeighbors(dest_emb_arrs, backend=backend,
+        memory_budget=memory_budget, fused=fused_replicates)
+
+    num_queries, num_batches, compute_time = 0, 0, 0.
+    batch = task_q.get()
+    while batch != _SIGNALS.HALT:
+        t = time.time()
         nn = grph.nearestNeighbors(
             [src_emb_arr[batch] for src_emb_arr in src_emb_arrs],
             indices=False,
             top_k=top_k,
             no_self=False,
-            with_distances=with_distances
+            with_distances=with_distances,
+            as_matrices=True
         )
-        for i in range(len(batch)):
-            nn_q.put((batch[i], nn[i]))
-        ix += batch_size
+        compute_time += time.time() - t
+        _sendBatch(nn_q, batch, nn, with_distances)
+        num_queries += len(batch)
+        num_batches += 1
+        batch = task_q.get()
+    stats_q.put((worker_ID, num_queries, num_batches, compute_time, time.time() - start_time))
 
 if __name__ == '__main__':
     def _cli():
@@ -173,9 +317,32 @@ if __name__ == '__main__':
         parser.add_option('--batch-size', dest='batch_size',
                 type='int', default=25,
                 help='number of points to process at once (default %default)')
+        parser.add_option('--backend', dest='backend',
+                type='choice', choices=model.Backend.choices(), default=model.Backend.TENSORFLOW,
+                help='computation backend for neighbor calculation ({0}); the'
+                     ' {1} backend does not require TensorFlow (default: %default)'.format(
+                        '/'.join(model.Backend.choices()), model.Backend.NUMPY
+                    ))
+        parser.add_option('--memory-budget', dest='memory_budget',
+                type='float', default=None,
+                help='(optional, {0} backend only) working memory budget per thread, in MB;'
+                     ' if given, distances are computed in tiles of target keys sized to'
+                     ' fit in the budget, allowing for much larger --batch-size'.format(model.Backend.NUMPY))
+        parser.add_option('--fused-replicates', dest='fused_replicates',
+                action='store_true', default=False,
+                help='({0} backend only) compute averaged distances over all embedding'
+                     ' files with a single matrix multiply over the concatenated'
+                     ' replicate vectors'.format(model.Backend.NUMPY))
         parser.add_option('--embedding-mode', dest='embedding_mode',
                 type='choice', choices=[pyemblib.Mode.Text, pyemblib.Mode.Binary], default=pyemblib.Mode.Binary,
                 help='embedding file is in text ({0}) or binary ({1}) format (default: %default)'.format(pyemblib.Mode.Text, pyemblib.Mode.Binary))
+        parser.add_option('--embedding-cache-dir', dest='embedding_cache_dir',
+                help='directory to cache memory-mappable copies of embedding files in'
+                     ' (default: .embedding_cache/ next to each embedding file)')
+        parser.add_option('--no-embedding-cache', dest='use_embedding_cache',
+                action='store_false', default=True,
+                help='always parse embedding files directly, without reading or'
+                     ' writing the embedding cache')
         parser.add_option('--draw-queries-from', dest='draw_queries_from',
                 help='comma-separated list of embedding files to use for neighborhood queries,'
                      ' instead of EMB1 EMB2 etc. Queries will still be compared to EMB1 EMB2 etc.'
@@ -196,6 +363,10 @@ if __name__ == '__main__':
                      ' DIFFERENT set of embeddings as queries)')
         parser.add_option('--filter-queries-to', dest='filter_queries_to',
                 help='(optional) file listing query keys to filter neighbor calculation to')
+        parser.add_option('--output-format', dest='output_format',
+                type='choice', choices=nn_io.NeighborFileFormat.choices(), default=nn_io.NeighborFileFormat.TEXT,
+                help='format to write neighbors in ({0}); binary neighbors are written'
+                     ' to OUTPUT.npz (default: %default)'.format('/'.join(nn_io.NeighborFileFormat.choices())))
         parser.add_option('--with-distances', dest='with_distances',
                 action='store_true', default=False,
                 help='include distances in nearest neighbors file')
@@ -209,6 +380,10 @@ if __name__ == '__main__':
             if len(options.draw_queries_from) != len(args):
                 parser.error('If using --draw-queries-from, must provide same number'
                              ' of embedding files as given on command line!')
+        if options.memory_budget and options.backend != model.Backend.NUMPY:
+            parser.error('--memory-budget is only supported with --backend %s' % model.Backend.NUMPY)
+        if options.fused_replicates and options.backend != model.Backend.NUMPY:
+            parser.error('--fused-replicates is only supported with --backend %s' % model.Backend.NUMPY)
         if options.threads < 2:
             parser.print_help()
             parser.error('--threads must be at least 2')
@@ -226,12 +401,18 @@ if __name__ == '__main__':
                 for i in range(len(embedfs))
         ]),
         ('Input embedding file mode', options.embedding_mode),
+        ('Using embedding cache', options.use_embedding_cache),
+        ('Embedding cache directory', ('default' if not options.embedding_cache_dir else options.embedding_cache_dir)),
         ('Output neighbor file', options.outputf),
         ('Writing distance to neighbors', options.with_distances),
+        ('Output neighbor file format', options.output_format),
         ('Ordered vocabulary file', options.vocabf),
         ('Number of nearest neighbors', options.k),
         ('Batch size', options.batch_size),
         ('Number of threads', options.threads),
+        ('Computation backend', options.backend),
+        ('Memory budget per thread (MB)', ('N/A' if not options.memory_budget else options.memory_budget)),
+        ('Using fused replicates', options.fused_replicates),
         ('Partial nearest neighbors file for resuming', options.partial_neighbors_file),
         ('Drawing queries from', ('N/A' if not options.draw_queries_from else [
             ('Query set %d' % (i+1), options.draw_queries_from[i])
@@ -246,7 +427,8 @@ if __name__ == '__main__':
     embeds = []
     for i in range(len(embedfs)):
         t_sub = log.startTimer('Reading embeddings (set %d) from %s...' % (i, embedfs[i]))
-        these_embeds = pyemblib.read(embedfs[i], mode=options.embedding_mode, errors='replace')
+        these_embeds = nn_io.readEmbeddings(embedfs[i], mode=options.embedding_mode,
+            cache_dir=options.embedding_cache_dir, use_cache=options.use_embedding_cache)
         log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(these_embeds), '{0:.2f}'))
         embeds.append(these_embeds)
 
@@ -256,7 +438,8 @@ if __name__ == '__main__':
         query_embeds = []
         for i in range(len(options.draw_queries_from)):
             t_sub = log.startTimer('Reading query embeddings (set %d) from %s...' % (i, options.draw_queries_from[i]))
-            these_embeds = pyemblib.read(options.draw_queries_from[i], mode=options.embedding_mode, errors='replace')
+            these_embeds = nn_io.readEmbeddings(options.draw_queries_from[i], mode=options.embedding_mode,
+                cache_dir=options.embedding_cache_dir, use_cache=options.use_embedding_cache)
             log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(these_embeds), '{0:.2f}'))
             query_embeds.append(these_embeds)
 
@@ -307,7 +490,8 @@ if __name__ == '__main__':
     ## TODO: handle this for specified query embeddings
     if options.shared_keys_with:
         t_sub = log.startTimer('Reading reference embeddings from %s...' % options.shared_keys_with)
-        emb2 = pyemblib.read(options.shared_keys_with, errors='replace')
+        emb2 = nn_io.readEmbeddings(options.shared_keys_with,
+            cache_dir=options.embedding_cache_dir, use_cache=options.use_embedding_cache)
         log.stopTimer(t_sub, message='Read {0:,} embeddings in {1}s.\n'.format(len(emb2), '{0:.2f}'))
 
         if options.filter_to:
@@ -406,9 +590,7 @@ if __name__ == '__main__':
 
     emb_arrs = []
     for i in range(len(embeds)):
-        emb_arr = np.array([
-            embeds[i][v] for v in ordered_vocab
-        ])
+        emb_arr = nn_io.embeddingArray(embeds[i], ordered_vocab)
         emb_arrs.append(emb_arr)
     
     # do the same setup for query embedding arrays
@@ -423,19 +605,19 @@ if __name__ == '__main__':
         query_emb_arrs = []
         if options.draw_queries_from:
             for i in range(len(query_embeds)):
-                query_emb_arr = np.array([
-                    query_embeds[i][v] for v in ordered_query_vocab
-                ])
+                query_emb_arr = nn_io.embeddingArray(query_embeds[i], ordered_query_vocab)
                 query_emb_arrs.append(query_emb_arr)
         elif options.filtered_query_keys:
             for i in range(len(filtered_query_embed_sets)):
-                query_emb_arr = np.array([
-                    filtered_query_embed_sets[i][v] for v in ordered_query_vocab
-                ])
+                query_emb_arr = nn_io.embeddingArray(filtered_query_embed_sets[i], ordered_query_vocab)
                 query_emb_arrs.append(query_emb_arr)
 
     # TODO: what should this do if a query set is specified?
-    if options.partial_neighbors_file:
+    if options.partial_neighbors_file and options.partial_neighbors_file.endswith('.npz'):
+        completed_neighbors = set(
+            nn_io.readBinaryNeighborArrays(options.partial_neighbors_file)['query_IDs'].tolist()
+        )
+    elif options.partial_neighbors_file:
         completed_neighbors = set()
         with open(options.partial_neighbors_file, 'r') as stream:
             for line in stream:
@@ -457,7 +639,13 @@ if __name__ == '__main__':
             threads=options.threads,
             batch_size=options.batch_size,
             completed_neighbors=completed_neighbors,
-            with_distances=options.with_distances
+            with_distances=options.with_distances,
+            backend=options.backend,
+            memory_budget=options.memory_budget,
+            fused_replicates=options.fused_replicates,
+            output_format=options.output_format,
+            node_map=node_map,
+            query_node_map=query_node_map
         )
     if not options.draw_queries_from:
         KNearestNeighbors(
@@ -469,7 +657,12 @@ if __name__ == '__main__':
             batch_size=options.batch_size,
             completed_neighbors=completed_neighbors,
             with_distances=options.with_distances,
-            neighbor_file_mode=('a' if options.filtered_query_keys else 'w')
+            neighbor_file_mode=('a' if options.filtered_query_keys else 'w'),
+            backend=options.backend,
+            memory_budget=options.memory_budget,
+            fused_replicates=options.fused_replicates,
+            output_format=options.output_format,
+            node_map=node_map
         )
     log.writeln('Done!\n')
 
@@ -1,13 +1,259 @@
 '''
+Cosine nearest neighbor models, averaged over multiple embedding replicates.
+
+Two interchangeable backends are provided behind the same nearestNeighbors()
+API: the original TensorFlow graph (MultiNearestNeighbors) and a pure
+NumPy/BLAS implementation (NumpyMultiNearestNeighbors), which does not
+require TensorFlow to be installed.
 '''
 
 import numpy as np
-import tensorflow as tf
 import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
+# TensorFlow is only imported when the TensorFlow backend is actually used,
+# so the NumPy backend runs without paying for (or requiring) it
+tf = None
+
+def _loadTensorFlow():
+    global tf
+    if tf is None:
+        import tensorflow
+        tf = tensorflow
+    return tf
+
+class Backend:
+    TENSORFLOW = 'tensorflow'
+    NUMPY = 'numpy'
+
+    @staticmethod
+    def choices():
+        return [Backend.TENSORFLOW, Backend.NUMPY]
+
+def buildMultiNearestNeighbors(embed_arrays, backend=Backend.TENSORFLOW,
+        memory_budget=None, fused=False):
+    '''Instantiate a nearest neighbor model over embed_arrays, using the
+    requested backend.
+
+    memory_budget (in MB) and fused are only supported by the NumPy backend,
+    which also accepts a SharedEmbeddingMatrices object as embed_arrays.
+    '''
+    if backend == Backend.NUMPY:
+        return NumpyMultiNearestNeighbors(embed_arrays, memory_budget=memory_budget, fused=fused)
+    elif backend == Backend.TENSORFLOW:
+        if not (memory_budget is None):
+            raise ValueError('Memory budget is only supported with the %s backend' % Backend.NUMPY)
+        if fused:
+            raise ValueError('Fused replicates are only supported with the %s backend' % Backend.NUMPY)
+        try:
+            _loadTensorFlow()
+        except ImportError:
+            raise ImportError('TensorFlow backend requested, but tensorflow'
+                              ' could not be imported; try --backend %s' % Backend.NUMPY)
+        sess = tf.Session()
+        return MultiNearestNeighbors(sess, embed_arrays)
+    else:
+        raise ValueError('Backend "%s" not known' % backend)
+
+def _unitNorm(embed_array):
+    embed_array = np.asarray(embed_array, dtype=np.float32)
+    norms = np.linalg.norm(embed_array, axis=1, keepdims=True)
+    return embed_array / norms
+
+class SharedEmbeddingMatrices:
+    '''Unit-normed embedding matrices, placed once in shared memory so that
+    nearest neighbor worker processes can attach to them without copying.
+
+    Matrices are stored stacked as (replicates x vocab size x dimensionality),
+    or, if fused, side by side as (vocab size x replicates*dimensionality)
+    (see NumpyMultiNearestNeighbors).  The creating process owns the shared
+    block, and releases it on close(); copies passed to other processes only
+    attach to it.
+    '''
+
+    def __init__(self, embed_arrays, fused=False):
+        self.fused = fused
+        self.number_of_embeddings = len(embed_arrays)
+        (vocab_size, dimensionality) = embed_arrays[0].shape
+        if self.fused:
+            self.shape = (vocab_size, self.number_of_embeddings * dimensionality)
+        else:
+            self.shape = (self.number_of_embeddings, vocab_size, dimensionality)
+
+        self._shm = shared_memory.SharedMemory(
+            create=True,
+            size=int(np.prod(self.shape)) * np.dtype(np.float32).itemsize
+        )
+        self._owner = True
+
+        matrix = self.matrix
+        for i in range(self.number_of_embeddings):
+            if self.fused:
+                matrix[:, i*dimensionality:(i+1)*dimensionality] = _unitNorm(embed_arrays[i])
+            else:
+                matrix[i] = _unitNorm(embed_arrays[i])
+
+    def __getstate__(self):
+        return {
+            'name': self._shm.name,
+            'shape': self.shape,
+            'fused': self.fused,
+            'number_of_embeddings': self.number_of_embeddings
+        }
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.fused = state['fused']
+        self.number_of_embeddings = state['number_of_embeddings']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        # attaching registers the block with this process's resource tracker
+        # (a separate one under spawn), which would unlink it when the worker
+        # exits; only the creating process should release it
+        resource_tracker.unregister(self._shm._name, 'shared_memory')
+
+    @property
+    def matrix(self):
+        return np.ndarray(self.shape, dtype=np.float32, buffer=self._shm.buf)
+
+    def close(self):
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+def _topCandidates(distances, num_candidates):
+    '''Get the (column indices, distances) of the num_candidates smallest
+    distances in each row, sorted ascending.
+
+    Uses a linear-time partial selection, so only the kept candidates are
+    sorted.
+    '''
+    num_columns = distances.shape[1]
+    num_candidates = min(num_candidates, num_columns)
+    if num_candidates < num_columns:
+        candidates = np.argpartition(
+            distances,
+            num_candidates - 1,
+            axis=1
+        )[:, :num_candidates]
+    else:
+        candidates = np.tile(np.arange(num_columns), (len(distances), 1))
+    candidate_distances = np.take_along_axis(distances, candidates, axis=1)
+    candidate_order = np.argsort(candidate_distances, axis=1)
+    return (
+        np.take_along_axis(candidates, candidate_order, axis=1),
+        np.take_along_axis(candidate_distances, candidate_order, axis=1)
+    )
+
+def _selfOffsets(sorted_neighbors, batch_input, indices=True, no_self=True):
+    '''Get the number of leading neighbors (0 or 1) to skip in each row to
+    drop the query itself: it should be in the 0th position, and if it's
+    not, nothing is skipped.  Queries given as embeddings (indices=False)
+    have no index to match, so are never skipped.
+    '''
+    num_queries = len(sorted_neighbors)
+    if no_self and indices and num_queries > 0:
+        return (np.asarray(sorted_neighbors)[:, 0] == np.asarray(batch_input)).astype(np.int64)
+    else:
+        return np.zeros(num_queries, dtype=np.int64)
+
+def _formatNeighbors(sorted_neighbors, sorted_distances, batch_input,
+        indices=True, top_k=None, no_self=True, with_distances=False,
+        as_matrices=False):
+    '''Convert per-query sorted neighbor indices/distances into the output
+    format of nearestNeighbors().
+
+    If as_matrices is True, returns a (batch size x k) int32 matrix of
+    neighbor indices and a matching float32 matrix of distances instead of
+    per-query lists; any rows with fewer than k neighbors are padded at the
+    end with index -1 (and distance NaN).
+    '''
+    if as_matrices:
+        return _packNeighbors(sorted_neighbors, sorted_distances, batch_input,
+            indices=indices, top_k=top_k, no_self=no_self)
+
+    nearest_neighbors = []
+    if indices:
+        itr = range(len(batch_input))
+    else:
+        itr = range(len(batch_input[0]))
+    offsets = _selfOffsets(sorted_neighbors, batch_input, indices=indices, no_self=no_self)
+    for i in itr:
+        # if skipping the query, remove it from the neighbor list
+        row_neighbors = sorted_neighbors[i][offsets[i]:]
+        row_distances = sorted_distances[i][offsets[i]:]
+        # if restricting to top k, do so here
+        if top_k is None:
+            kept_neighbors = row_neighbors
+        else:
+            kept_neighbors = row_neighbors[:top_k]
+        # if including distance, pull those for the indices being kept
+        if with_distances:
+            kept_neighbors = [
+                (kept_neighbors[j], row_distances[j])
+                    for j in range(len(kept_neighbors))
+            ]
+        nearest_neighbors.append(kept_neighbors)
+    return nearest_neighbors
+
+def _packNeighbors(sorted_neighbors, sorted_distances, batch_input,
+        indices=True, top_k=None, no_self=True):
+    '''Vectorized version of _formatNeighbors, producing neighbor index and
+    distance matrices for the whole batch.
+    '''
+    sorted_neighbors = np.asarray(sorted_neighbors)
+    sorted_distances = np.asarray(sorted_distances)
+    (num_queries, num_columns) = sorted_neighbors.shape
+
+    offsets = _selfOffsets(sorted_neighbors, batch_input, indices=indices, no_self=no_self)
+    num_kept = num_columns if top_k is None else min(top_k, num_columns)
+
+    columns = offsets[:, np.newaxis] + np.arange(num_kept)[np.newaxis, :]
+    valid = columns < num_columns
+    columns = np.minimum(columns, num_columns - 1)
+
+    neighbor_matrix = np.take_along_axis(sorted_neighbors, columns, axis=1).astype(np.int32)
+    distance_matrix = np.take_along_axis(sorted_distances, columns, axis=1).astype(np.float32)
+    neighbor_matrix[~valid] = -1
+    distance_matrix[~valid] = np.nan
+    return (neighbor_matrix, distance_matrix)
+
+def _selectNeighbors(averaged_distances, batch_input, indices=True,
+        top_k=None, no_self=True, with_distances=False, as_matrices=False):
+    '''Given a (batch size x vocab size) matrix of distances, get the sorted
+    list of neighbors for each query in the batch.
+
+    If top_k is given, the k (+1, for dropping the query itself) closest
+    candidates are found for the whole batch with a linear-time partial
+    selection, and only those candidates are sorted.
+    '''
+    averaged_distances = np.asarray(averaged_distances)
+
+    if top_k is None:
+        sorted_neighbors = np.argsort(averaged_distances, axis=1)
+        sorted_distances = np.take_along_axis(averaged_distances, sorted_neighbors, axis=1)
+    else:
+        # keep one extra candidate in case the query needs to be removed
+        (sorted_neighbors, sorted_distances) = _topCandidates(
+            averaged_distances,
+            top_k + (1 if no_self else 0)
+        )
+
+    return _formatNeighbors(
+        sorted_neighbors,
+        sorted_distances,
+        batch_input,
+        indices=indices,
+        top_k=top_k,
+        no_self=no_self,
+        with_distances=with_distances,
+        as_matrices=as_matrices
+    )
 
 class MultiNearestNeighbors:
     
     def __init__(self, session, embed_arrays):
+        _loadTensorFlow()
         self._session = session
         self._prints = []
 
@@ -97,7 +343,8 @@ class MultiNearestNeighbors:
         outputs = self._session.run(all_nodes, feed_dict=feed_dict)
         return outputs[len(self._prints):]
 
-    def nearestNeighbors(self, batch_input, indices=True, top_k=None, no_self=True, with_distances=False):
+    def nearestNeighbors(self, batch_input, indices=True, top_k=None, no_self=True, with_distances=False,
+            as_matrices=False):
         # get the pairwise distances for this batch for each set of embeddings
         all_distances = []
         for i in range(self._number_of_embeddings):
@@ -125,34 +372,177 @@ class MultiNearestNeighbors:
         averaged_distances = np.mean(all_distances, axis=0)
         assert len(averaged_distances) == len(pairwise_distances)
 
-        nearest_neighbors = []
-        if indices:
-            itr = range(len(batch_input))
-        else:
-            itr = range(len(batch_input[0]))
-        for i in itr:
-            distance_vector = averaged_distances[i]
-            sorted_neighbors = np.argsort(distance_vector)
-            # if skipping the query, remove it from the neighbor list
-            # (should be in the 0th position; if it's not, just move on)
-            if no_self: 
-                if sorted_neighbors[0] == batch_input[i]: sorted_neighbors = sorted_neighbors[1:]
-            # if restricting to top k, do so here
-            if top_k is None:
-                kept_neighbors = sorted_neighbors
-            else:
-                kept_neighbors = sorted_neighbors[:top_k]
-            # if including distance, pull those for the indices being kept
-            if with_distances:
-                kept_neighbors = [
-                    (ix, distance_vector[ix])
-                        for ix in kept_neighbors
-                ]
-            nearest_neighbors.append(kept_neighbors)
-        return nearest_neighbors
+        return _selectNeighbors(
+            averaged_distances,
+            batch_input,
+            indices=indices,
+            top_k=top_k,
+            no_self=no_self,
+            with_distances=with_distances,
+            as_matrices=as_matrices
+        )
 
 
 class NearestNeighbors(MultiNearestNeighbors):
     
     def __init__(self, session, embed_array):
         super().__init__(session, [embed_array])
+
+
+class NumpyMultiNearestNeighbors:
+    '''NumPy implementation of MultiNearestNeighbors.
+
+    Embedding matrices are unit-normed once (as float32) at construction time,
+    so each batch costs one BLAS matrix multiply per replicate.
+
+    If memory_budget (in MB) is given, distances are computed in tiles of
+    target columns sized to fit in the budget, keeping only the running top k
+    candidates for each query between tiles; the budget covers the per-batch
+    working set, not the embedding matrices themselves.
+
+    If fused is True, the unit-normed replicate matrices are laid side by side
+    in a single (vocab size x replicates*dimensionality) matrix.  The mean
+    cosine similarity over replicates is then the dot product of the fused
+    vectors scaled by 1/replicates, so each batch (or tile) costs one large
+    matrix multiply instead of one per replicate.
+
+    embed_arrays may also be a SharedEmbeddingMatrices object, in which case
+    the (already unit-normed) shared matrices are used directly, and its
+    layout determines whether the fused mode is used.
+    '''
+
+    # bytes of working memory per (query, target) pair in a tile: float32
+    # distance accumulator and matmul output, and int64 partition indices
+    _BYTES_PER_TILE_CELL = 4 + 4 + 8
+    
+    def __init__(self, embed_arrays, memory_budget=None, fused=False):
+        self._memory_budget = memory_budget
+        self._fused = fused
+
+        if isinstance(embed_arrays, SharedEmbeddingMatrices):
+            if embed_arrays.fused != fused:
+                raise ValueError('Shared embedding matrices were built with fused={0}, but fused={1} was requested'.format(
+                    embed_arrays.fused, fused
+                ))
+            # keep a reference to the shared block, so it stays attached
+            self._shared = embed_arrays
+            self._number_of_embeddings = embed_arrays.number_of_embeddings
+            if self._fused:
+                self._fused_matrix = embed_arrays.matrix
+                self._embed_matrices = None
+            else:
+                shared_matrix = embed_arrays.matrix
+                self._embed_matrices = [
+                    shared_matrix[i]
+                        for i in range(self._number_of_embeddings)
+                ]
+        else:
+            self._shared = None
+            self._number_of_embeddings = len(embed_arrays)
+            self._embed_matrices = [
+                _unitNorm(embed_array)
+                    for embed_array in embed_arrays
+            ]
+            if self._fused:
+                self._fused_matrix = np.concatenate(self._embed_matrices, axis=1)
+                # the per-replicate matrices are no longer needed
+                self._embed_matrices = None
+
+        if self._fused:
+            self._vocab_size = len(self._fused_matrix)
+        else:
+            self._vocab_size = len(self._embed_matrices[0])
+
+    def _tileSize(self, num_queries, num_candidates):
+        if self._memory_budget is None:
+            return self._vocab_size
+        budget_bytes = self._memory_budget * 1024 * 1024
+        tile_size = int(budget_bytes // (num_queries * self._BYTES_PER_TILE_CELL))
+        # need room for at least the candidates being carried over
+        return max(num_candidates, min(self._vocab_size, tile_size))
+
+    def _averagedDistances(self, sample_points, start, end):
+        '''Get the (batch size x (end-start)) matrix of cosine distances to
+        target columns [start, end), averaged over all sets of embeddings.
+        '''
+        if self._fused:
+            # sum of per-replicate dot products in a single matrix multiply
+            similarities = np.matmul(sample_points, self._fused_matrix[start:end].T)
+        else:
+            similarities = np.zeros((len(sample_points[0]), end-start), dtype=np.float32)
+            product = np.empty_like(similarities)
+            for i in range(self._number_of_embeddings):
+                # both inputs are already unit-normed
+                np.matmul(sample_points[i], self._embed_matrices[i][start:end].T, out=product)
+                similarities += product
+        similarities /= self._number_of_embeddings
+        return 1 - similarities
+
+    def nearestNeighbors(self, batch_input, indices=True, top_k=None, no_self=True, with_distances=False,
+            as_matrices=False):
+        # get the (unit-normed) batch points for each set of embeddings
+        if indices:
+            num_queries = len(batch_input)
+            if self._fused:
+                sample_points = self._fused_matrix[batch_input]
+            else:
+                sample_points = [
+                    embed_matrix[batch_input]
+                        for embed_matrix in self._embed_matrices
+                ]
+        else:
+            num_queries = len(batch_input[0])
+            sample_points = [
+                _unitNorm(batch_input[i])
+                    for i in range(self._number_of_embeddings)
+            ]
+            if self._fused:
+                sample_points = np.concatenate(sample_points, axis=1)
+
+        # without a top k, need the full distance matrix to sort
+        if top_k is None:
+            averaged_distances = self._averagedDistances(sample_points, 0, self._vocab_size)
+            return _selectNeighbors(
+                averaged_distances,
+                batch_input,
+                indices=indices,
+                top_k=top_k,
+                no_self=no_self,
+                with_distances=with_distances,
+                as_matrices=as_matrices
+            )
+
+        # otherwise, stream over tiles of target columns, keeping the running
+        # top candidates for each query
+        num_candidates = top_k + (1 if no_self else 0)
+        tile_size = self._tileSize(num_queries, num_candidates)
+        (best_neighbors, best_distances) = (None, None)
+        for start in range(0, self._vocab_size, tile_size):
+            end = min(start + tile_size, self._vocab_size)
+            tile_distances = self._averagedDistances(sample_points, start, end)
+            (tile_neighbors, tile_distances) = _topCandidates(tile_distances, num_candidates)
+            tile_neighbors += start
+
+            if best_neighbors is None:
+                (best_neighbors, best_distances) = (tile_neighbors, tile_distances)
+            else:
+                merged_neighbors = np.concatenate([best_neighbors, tile_neighbors], axis=1)
+                merged_distances = np.concatenate([best_distances, tile_distances], axis=1)
+                (merged_order, best_distances) = _topCandidates(merged_distances, num_candidates)
+                best_neighbors = np.take_along_axis(merged_neighbors, merged_order, axis=1)
+
+        return _formatNeighbors(
+            best_neighbors,
+            best_distances,
+            batch_input,
+            indices=indices,
+            top_k=top_k,
+            no_self=no_self,
+            with_distances=with_distances,
+            as_matrices=as_matrices
+        )
+
+class NumpyNearestNeighbors(NumpyMultiNearestNeighbors):
+    
+    def __init__(self, embed_array):
+        super().__init__([embed_array])
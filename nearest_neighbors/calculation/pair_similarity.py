@@ -2,35 +2,195 @@ import configparser
 import numpy as np
 import pyemblib
 from hedgepig_logger import log
+import json
+import hashlib
 import threading
+import collections
+import concurrent.futures
 from .. import nn_io
-from ..data_models import AggregatePairwiseSimilarity
+from ..data_models import AggregatePairwiseSimilarity, PairwiseSimilarityProgress
 from ..database import EmbeddingNeighborhoodDatabase
 
 
+# vector stores are opened once per embedding set and shared across requests;
+# each set has its own lock, so building one store (which may mean parsing
+# every replicate file) doesn't hold up lookups in the others
+_vector_stores = {}
+_vector_store_locks = {}
+_vector_stores_lock = threading.Lock()
+
+def _vectorStoreSettings(emb_set, config):
+    emb_set_config = config[emb_set.name]
+    return (
+        emb_set_config['ReplicateTemplate'].format(REPL='*'),
+        emb_set_config['EmbeddingFormat'],
+        config['PairedNeighborhoodAnalysis'].get('EmbeddingCacheDirectory', None)
+    )
+
+def getVectorStore(emb_set, config):
+    """Returns the (cached) EmbeddingVectorStore for an embedding set's
+    replicates, building the on-disk cache for it if needed."""
+    store = _vector_stores.get(emb_set.name, None)
+    if not store is None:
+        return store
+
+    with _vector_stores_lock:
+        emb_set_lock = _vector_store_locks.setdefault(emb_set.name, threading.Lock())
+    with emb_set_lock:
+        if not emb_set.name in _vector_stores:
+            (file_pattern, embedding_format, cache_dir) = _vectorStoreSettings(emb_set, config)
+            _vector_stores[emb_set.name] = nn_io.EmbeddingVectorStore(
+                emb_set,
+                file_pattern,
+                embedding_format,
+                cache_dir=cache_dir
+            )
+        return _vector_stores[emb_set.name]
+
+# background similarity jobs run on a fixed pool of worker threads; jobs are
+# keyed on (group ID, query, target) (or ('batch', batch ID) for batches of
+# pairs), and requests for a job that's already queued or running share the
+# existing one
+_executor = None
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+# the pairs requested in recent batch jobs, by batch ID (so clients can
+# check on a batch by its ID), and the error, if any, that each failed with
+MAX_REMEMBERED_BATCHES = 256
+_batches = collections.OrderedDict()
+
+def _jobSettings(config):
+    analysis_config = config['PairedNeighborhoodAnalysis']
+    return (
+        analysis_config.getint('PairwiseWorkers', 2),
+        analysis_config.getint('PairwiseMaxQueuedJobs', 16)
+    )
+
+def _submit(key, config, on_queued, worker, *args):
+    """Queues worker(*args) on the worker pool as job key, unless it is
+    already queued or running; on_queued() is called (under the jobs lock)
+    just before a new job is queued.  Returns False (and queues nothing) if
+    the job queue is full."""
+    global _executor
+    with _jobs_lock:
+        if key in _jobs:
+            return True
+        (max_workers, max_queued_jobs) = _jobSettings(config)
+        if len(_jobs) >= max_workers + max_queued_jobs:
+            return False
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix='pairwise-similarity'
+            )
+        on_queued()
+        future = _executor.submit(worker, *args)
+        _jobs[key] = future
+    # (outside the lock, as this runs immediately if the job already finished)
+    future.add_done_callback(lambda _: _finishJob(key))
+    return True
+
+def _submitJob(group, query, target, config, db):
+    """Queues a background job computing similarities between query and
+    target, unless one is already queued or running.  Returns False (and
+    queues nothing) if the job queue is full."""
+    return _submit(
+        (group.ID, query, target),
+        config,
+        lambda: db.updatePairwiseSimilarityProgress(group, query, target, True, 0.0, "Waiting to start..."),
+        _pairwiseSimilaritiesWorker, group, query, target, config
+    )
+
+def _finishJob(key):
+    with _jobs_lock:
+        _jobs.pop(key, None)
+
+def _jobInProgress(group, query, target):
+    with _jobs_lock:
+        return (group.ID, query, target) in _jobs
+
+def _batchJobStatus(batch_ID):
+    """Returns "queued" or "running" for a batch job in progress, or None."""
+    with _jobs_lock:
+        future = _jobs.get(('batch', batch_ID), None)
+    if future is None:
+        return None
+    return "running" if future.running() else "queued"
+
+def recoverStaleJobs(db):
+    """Marks any jobs left running by a previous process (e.g., one that
+    was stopped mid-calculation) as interrupted, so they can be restarted.
+    Returns the number of jobs recovered."""
+    return db.resetRunningPairwiseSimilarityProgress("Interrupted; will restart on next request")
+
+def _vectorStoresReady(embedding_sets, config):
+    """Checks whether every embedding set's vector store can be opened
+    without parsing any embedding files."""
+    for emb_set in embedding_sets:
+        if emb_set.name in _vector_stores:
+            continue
+        (file_pattern, embedding_format, cache_dir) = _vectorStoreSettings(emb_set, config)
+        if not nn_io.EmbeddingVectorStore.isCached(file_pattern, embedding_format, cache_dir=cache_dir):
+            return False
+    return True
+
 def calculateAggregatePairwiseSimilarity(group, replicates, query, target, db):
-    cos_sims = []
-    for these_embeds in replicates:
-        query_vec = these_embeds[query]
-        target_vec = these_embeds[target]
+    query_vecs = replicates.vectors(query)
+    target_vecs = replicates.vectors(target)
 
-        query_vec = query_vec / np.linalg.norm(query_vec)
-        target_vec = target_vec / np.linalg.norm(target_vec)
+    query_vecs = query_vecs / np.linalg.norm(query_vecs, axis=1, keepdims=True)
+    target_vecs = target_vecs / np.linalg.norm(target_vecs, axis=1, keepdims=True)
 
-        cos_sim = np.dot(query_vec, target_vec)
-        cos_sims.append(cos_sim)
+    cos_sims = np.sum(query_vecs * target_vecs, axis=1)
 
     sim = AggregatePairwiseSimilarity(
         source=replicates.source,
         key=query,
         neighbor_key=target,
-        mean_similarity=np.mean(cos_sims),
-        std_similarity=np.std(cos_sims)
+        mean_similarity=float(np.mean(cos_sims)),
+        std_similarity=float(np.std(cos_sims))
     )
     db.insertOrUpdate(sim)
 
     return sim
 
+def calculateAggregatePairwiseSimilarities(replicates, pairs):
+    """Batched version of calculateAggregatePairwiseSimilarity: computes the
+    similarities for many (query, target) pairs in one embedding set at once
+    (without saving them).  Each key's vectors are looked up once, and each
+    replicate's similarities are computed as one batched dot product.
+
+    Returns a list of AggregatePairwiseSimilarity objects, in the same order
+    as pairs; pairs missing either key get None similarities."""
+    keys = sorted(set([key for pair in pairs for key in pair]))
+    key_ixes = { key: i for (i, key) in enumerate(keys) }
+    query_ixes = np.array([key_ixes[query] for (query, _) in pairs], dtype=np.int64)
+    target_ixes = np.array([key_ixes[target] for (_, target) in pairs], dtype=np.int64)
+
+    # (replicates x keys x dimension)
+    (vectors, found) = replicates.vectorsForKeys(keys)
+    norms = np.linalg.norm(vectors, axis=2, keepdims=True)
+    norms[norms == 0] = 1
+    vectors = vectors / norms
+
+    # (replicates x pairs)
+    cos_sims = np.einsum('rpd,rpd->rp', vectors[:, query_ixes], vectors[:, target_ixes])
+    means = np.mean(cos_sims, axis=0)
+    stds = np.std(cos_sims, axis=0)
+    present = found[query_ixes] & found[target_ixes]
+
+    sims = []
+    for (i, (query, target)) in enumerate(pairs):
+        sims.append(AggregatePairwiseSimilarity(
+            source=replicates.source,
+            key=query,
+            neighbor_key=target,
+            mean_similarity=float(means[i]) if present[i] else None,
+            std_similarity=float(stds[i]) if present[i] else None
+        ))
+    return sims
+
 def _getExistingAggregatePairwiseSimilarity(group, query, target, db, embedding_sets):
     """Fetches any pre-existing aggregate pairwise similarity calculations for
     the given pair of concepts."""
@@ -55,9 +215,11 @@ def calculateAllAggregatePairwiseSimilaritiesBackground(group, query, target, co
     result isn't available yet) and, if "result" is None, a "progress" key
     containing a PairwiseSimilarityProgress object.
     """
-    # Check if there's an ongoing job
-    progress = db.getPairwiseSimilarityProgress(group, query, target)
-    if progress and progress.running:
+    # Check if there's an ongoing job (progress rows still marked as running
+    # without a job in this process are left over from an earlier one, and
+    # are restarted below)
+    if _jobInProgress(group, query, target):
+        progress = db.getPairwiseSimilarityProgress(group, query, target)
         return {"result": None, "progress": progress}
     
     embedding_sets = list(db.selectFromEmbeddingSets(group_ID=group.ID))
@@ -73,20 +235,34 @@ def calculateAllAggregatePairwiseSimilaritiesBackground(group, query, target, co
             missing = True
             break
 
+    # if all the vector stores are already cached, lookups are cheap enough
+    # to answer directly
+    if missing and _vectorStoresReady(embedding_sets, config):
+        return {"result": calculateAllAggregatePairwiseSimilarities(group, query, target, config, db)}
+
     if missing:
-        progress = db.updatePairwiseSimilarityProgress(group, query, target, True, 0.0, "Computing similarity...")
-        thread = threading.Thread(target=_pairwiseSimilaritiesWorker,
-                                args=(group, query, target, config))
-        thread.start()
+        if _submitJob(group, query, target, config, db):
+            progress = db.getPairwiseSimilarityProgress(group, query, target)
+        else:
+            # too many jobs waiting; the client should ask again later
+            progress = PairwiseSimilarityProgress(group.ID, query, target, False, 0.0,
+                "Server busy, waiting to queue calculation...")
         return {"result": None, "progress": progress}
 
     return {"result": ordered_sims}
     
 def _pairwiseSimilaritiesWorker(group, query, target, config):
-    """Runs in a background thread"""
+    """Runs in a background worker thread"""
     db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'], build=False)
-    calculateAllAggregatePairwiseSimilarities(group, query, target, config, db)
-    db.close()
+    try:
+        calculateAllAggregatePairwiseSimilarities(group, query, target, config, db)
+    except Exception as e:
+        # don't leave the job marked as running
+        db.updatePairwiseSimilarityProgress(group, query, target, False, 0.0,
+            "Calculation failed: {0}".format(e))
+        raise
+    finally:
+        db.close()
     
 def calculateAllAggregatePairwiseSimilarities(group, query, target, config, db):
     embedding_sets = list(db.selectFromEmbeddingSets(group_ID=group.ID))
@@ -95,7 +271,6 @@ def calculateAllAggregatePairwiseSimilarities(group, query, target, config, db):
     # go through and calculate any that are still missing
     for emb_set in embedding_sets:
         if not emb_set.name in sims:
-            emb_set_config = config[emb_set.name]
             log.writeln('Loading embedding replicates for %s...' % emb_set.name)
             db.updatePairwiseSimilarityProgress(group, 
                                                 query, 
@@ -103,11 +278,7 @@ def calculateAllAggregatePairwiseSimilarities(group, query, target, config, db):
                                                 True,
                                                 len(sims) / len(embedding_sets), 
                                                 "Corpus {} of {}...".format(len(sims) + 1, len(embedding_sets)))
-            replicates = nn_io.EmbeddingReplicates(
-                emb_set,
-                emb_set_config['ReplicateTemplate'].format(REPL='*'),
-                emb_set_config['EmbeddingFormat']
-            )
+            replicates = getVectorStore(emb_set, config)
             log.writeln('Found {0:,} replicates.\n'.format(len(replicates)))
 
             if not replicates.hasKey(query) or not replicates.hasKey(target):
@@ -148,6 +319,160 @@ def calculateAllAggregatePairwiseSimilarities(group, query, target, config, db):
 
     return ordered_sims
 
+def _uniquePairs(pairs):
+    return list(dict.fromkeys([tuple(pair) for pair in pairs]))
+
+def _batchID(group, pairs):
+    """Identifies a batch of pairs (independent of the order requested)."""
+    return hashlib.sha1(
+        json.dumps([group.ID, sorted(pairs)]).encode('utf-8')
+    ).hexdigest()[:16]
+
+def _getExistingAggregatePairwiseSimilarities(pairs, db):
+    """Batched version of _getExistingAggregatePairwiseSimilarity: returns a
+    dictionary mapping each pair to {embedding set name: similarity} for the
+    similarities already calculated (in either order)."""
+    sims = { pair: {} for pair in pairs }
+    for sim in db.selectFromAggregatePairwiseSimilarityForPairs(pairs):
+        for pair in [(sim.key, sim.neighbor_key), (sim.neighbor_key, sim.key)]:
+            if pair in sims:
+                sims[pair][sim.source.name] = sim
+    return sims
+
+def _orderedSimilarities(sims, pairs, embedding_sets):
+    return {
+        pair: [
+            sims[pair][emb_set.name]
+                for emb_set in embedding_sets
+                if emb_set.name in sims[pair]
+        ]
+            for pair in pairs
+    }
+
+def calculateAggregatePairwiseSimilaritiesForPairsBackground(group, pairs, config, db):
+    """Batched version of calculateAllAggregatePairwiseSimilaritiesBackground:
+    returns any missing similarities for pairs from a job on the background
+    worker pool, rather than calculating them in the caller's thread.
+
+    Returns a dictionary containing "batch" (an ID for the batch, which can be
+    passed to getAggregatePairwiseSimilaritiesBatch), "result" (as returned
+    by calculateAggregatePairwiseSimilaritiesForPairs, or None if it isn't
+    available yet) and, if "result" is None, "status": one of "queued",
+    "running", or "busy" (if the job queue is full; the client should ask
+    again later)."""
+    pairs = _uniquePairs(pairs)
+    batch_ID = _batchID(group, pairs)
+
+    status = _batchJobStatus(batch_ID)
+    if not status is None:
+        return {"batch": batch_ID, "result": None, "status": status}
+
+    embedding_sets = sorted(db.selectFromEmbeddingSets(group_ID=group.ID), key=lambda es: es.ordering)
+    sims = _getExistingAggregatePairwiseSimilarities(pairs, db)
+    missing = any([
+        not emb_set.name in sims[pair]
+            for pair in pairs
+            for emb_set in embedding_sets
+    ])
+    if not missing:
+        return {"batch": batch_ID, "result": _orderedSimilarities(sims, pairs, embedding_sets)}
+
+    def onQueued():
+        _batches[batch_ID] = (group, pairs, None)
+        _batches.move_to_end(batch_ID)
+        while len(_batches) > MAX_REMEMBERED_BATCHES:
+            _batches.popitem(last=False)
+
+    if _submit(('batch', batch_ID), config, onQueued,
+            _pairwiseBatchWorker, batch_ID, group, pairs, config):
+        status = _batchJobStatus(batch_ID) or "running"
+    else:
+        status = "busy"
+    return {"batch": batch_ID, "result": None, "status": status}
+
+def getAggregatePairwiseSimilaritiesBatch(batch_ID, config, db):
+    """Checks on a batch started by
+    calculateAggregatePairwiseSimilaritiesForPairsBackground, returning the
+    same dictionary as that does (requeueing the batch if its job has been
+    lost), or, if the batch failed, one with "status" "failed" and the
+    "error".  Returns None for unknown (or long-finished) batch IDs."""
+    with _jobs_lock:
+        batch = _batches.get(batch_ID, None)
+    if batch is None:
+        return None
+    (group, pairs, error) = batch
+    if (not error is None) and _batchJobStatus(batch_ID) is None:
+        return {"batch": batch_ID, "result": None, "status": "failed", "error": error}
+    return calculateAggregatePairwiseSimilaritiesForPairsBackground(group, pairs, config, db)
+
+def _pairwiseBatchWorker(batch_ID, group, pairs, config):
+    """Runs in a background worker thread"""
+    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'], build=False)
+    try:
+        calculateAggregatePairwiseSimilaritiesForPairs(group, pairs, config, db)
+    except Exception as e:
+        with _jobs_lock:
+            if batch_ID in _batches:
+                _batches[batch_ID] = (group, pairs, str(e))
+        raise
+    finally:
+        db.close()
+
+def calculateAggregatePairwiseSimilaritiesForPairs(group, pairs, config, db):
+    """Batched version of calculateAllAggregatePairwiseSimilarities, for
+    many (query, target) pairs at once: loads each embedding set's
+    replicates once, computes all of its missing similarities together, and
+    saves them in bulk.
+
+    Returns a dictionary mapping each pair to its list of
+    AggregatePairwiseSimilarity objects (in embedding set order)."""
+    pairs = _uniquePairs(pairs)
+    embedding_sets = sorted(db.selectFromEmbeddingSets(group_ID=group.ID), key=lambda es: es.ordering)
+
+    # find any similarities which have already been calculated (in either order)
+    sims = _getExistingAggregatePairwiseSimilarities(pairs, db)
+
+    for emb_set in embedding_sets:
+        missing = [
+            pair for pair in pairs
+                if not emb_set.name in sims[pair]
+        ]
+        if len(missing) == 0:
+            continue
+
+        log.writeln('Loading embedding replicates for %s...' % emb_set.name)
+        replicates = getVectorStore(emb_set, config)
+        log.writeln('Found {0:,} replicates.\n'.format(len(replicates)))
+
+        t = log.startTimer('Calculating aggregate pairwise similarity for {0:,} pairs...'.format(len(missing)))
+        new_sims = calculateAggregatePairwiseSimilarities(replicates, missing)
+        db.insertOrUpdate(new_sims)
+        log.stopTimer(t, 'Done in {0:.2f}s.')
+        for sim in new_sims:
+            sims[(sim.key, sim.neighbor_key)][emb_set.name] = sim
+
+    return _orderedSimilarities(sims, pairs, embedding_sets)
+
+def readPairs(f):
+    """Reads (query, target) pairs from a tab-separated file."""
+    pairs = []
+    with open(f, 'r') as stream:
+        for line in stream:
+            line = line.strip()
+            if len(line) > 0:
+                (query, target) = line.split('\t')
+                pairs.append((query, target))
+    return pairs
+
+def readKeys(f):
+    keys = []
+    with open(f, 'r') as stream:
+        for line in stream:
+            line = line.strip()
+            if len(line) > 0:
+                keys.append(line)
+    return keys
+
 
 if __name__ == '__main__':
     def _cli():
@@ -155,15 +480,19 @@ if __name__ == '__main__':
         parser = optparse.OptionParser(usage='Usage: %prog')
         parser.add_option('-g', '--group', dest='group',
             help='(required) embedding set group specifier')
-        parser.add_option('-s', '--src', dest='src',
-            help='(required) source specifier (may provide more than one as'
-                 ' comma-separated list)')
         parser.add_option('-c', '--config', dest='configf',
             default='config.ini')
         parser.add_option('-q', '--query', dest='query_key',
-            help='(required) query key')
+            help='query key')
         parser.add_option('-t', '--target', dest='target_key',
-            help='(required) target key')
+            help='target key')
+        parser.add_option('--targets-file', dest='targets_file',
+            help='file listing target keys (one per line) to compare --query against')
+        parser.add_option('--pairs-file', dest='pairs_file',
+            help='tab-separated file of query/target key pairs to compare')
+        parser.add_option('-o', '--output', dest='outputf',
+            help='file to write similarities to (tab-separated)',
+            default=None)
         parser.add_option('-l', '--logfile', dest='logfile',
             help='name of file to write log contents to (empty for stdout)',
             default=None)
@@ -172,23 +501,29 @@ if __name__ == '__main__':
         if not options.group:
             parser.print_help()
             parser.error('Must provide --group')
-        if not options.query_key:
-            parser.print_help()
-            parser.error('Must provide --query')
-        if not options.target_key:
-            parser.print_help()
-            parser.error('Must provide --target')
+        if options.pairs_file:
+            if options.query_key or options.target_key or options.targets_file:
+                parser.error('--pairs-file cannot be combined with --query/--target/--targets-file')
+        else:
+            if not options.query_key:
+                parser.print_help()
+                parser.error('Must provide --query (or --pairs-file)')
+            if (not options.target_key) == (not options.targets_file):
+                parser.print_help()
+                parser.error('Must provide exactly one of --target or --targets-file')
 
-        return args, options
+        return options
 
-    embedfs, options = _cli()
+    options = _cli()
     log.start(options.logfile)
     log.writeConfig([
         ('Group specifier', options.group),
-        ('Source specifier (comma-separated)', options.src),
-        ('Configuraiton file', options.configf),
+        ('Configuration file', options.configf),
         ('Query key', options.query_key),
         ('Target key', options.target_key),
+        ('Target keys file', options.targets_file),
+        ('Key pairs file', options.pairs_file),
+        ('Output file', options.outputf),
     ], 'Aggregate pairwise similarity calculation')
 
 
@@ -200,19 +535,53 @@ if __name__ == '__main__':
 
     log.writeln('Loading embedding neighborhood database...')
     db = EmbeddingNeighborhoodDatabase(analysis_config['DatabaseFile'])
+    groups = list(db.selectFromEmbeddingSetGroups(short_name=options.group))
+    if len(groups) == 0:
+        log.writeln('No embedding set group "{0}" in database.'.format(options.group))
+        log.stop()
+        raise SystemExit(1)
+    group = groups[0]
     log.writeln('Database ready.\n')
 
-    sims = calculateAllAggregatePairwiseSimilarities(
+    if options.pairs_file:
+        log.writeln('Reading key pairs from %s...' % options.pairs_file)
+        pairs = readPairs(options.pairs_file)
+    elif options.targets_file:
+        log.writeln('Reading target keys from %s...' % options.targets_file)
+        pairs = [(options.query_key, target) for target in readKeys(options.targets_file)]
+    else:
+        pairs = [(options.query_key, options.target_key)]
+    log.writeln('Comparing {0:,} pairs.\n'.format(len(pairs)))
+
+    sims_by_pair = calculateAggregatePairwiseSimilaritiesForPairs(
         group,
-        options.query_key,
-        options.target_key,
+        pairs,
         config,
         db
     )
 
-    for sim in sims:
-        log.writeln('Source: {0}'.format(sim.source.name))
-        log.writeln('  Mean similarity: {0:.4f}'.format(sim.mean_similarity))
-        log.writeln('  Similarity std dev: {0:.4f}\n'.format(sim.std_similarity))
+    if options.outputf:
+        log.writeln('Writing similarities to %s...' % options.outputf)
+        with open(options.outputf, 'w') as stream:
+            stream.write('Query\tTarget\tSource\tMeanSimilarity\tStdDevSimilarity\n')
+            for ((query, target), sims) in sims_by_pair.items():
+                for sim in sims:
+                    stream.write('{0}\t{1}\t{2}\t{3}\t{4}\n'.format(
+                        query, target, sim.source.name,
+                        '' if sim.mean_similarity is None else sim.mean_similarity,
+                        '' if sim.std_similarity is None else sim.std_similarity
+                    ))
+        log.writeln('Done.\n')
+    else:
+        for ((query, target), sims) in sims_by_pair.items():
+            log.writeln('{0} / {1}'.format(query, target))
+            for sim in sims:
+                log.writeln('  Source: {0}'.format(sim.source.name))
+                if sim.mean_similarity is None:
+                    log.writeln('    (missing from embeddings)')
+                else:
+                    log.writeln('    Mean similarity: {0:.4f}'.format(sim.mean_similarity))
+                    log.writeln('    Similarity std dev: {0:.4f}'.format(sim.std_similarity))
+            log.writeln()
 
     log.stop()
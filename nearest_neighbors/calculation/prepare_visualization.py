@@ -1,12 +1,13 @@
 import os
 import json
-import numpy as np
+import gzip
+import hashlib
 import pandas as pd
 from io import StringIO
 from sklearn.manifold import TSNE
 import configparser
-import pyemblib
 from hedgepig_logger import log
+from .. import nn_io
 from ..database import EmbeddingNeighborhoodDatabase
 from . import moving_scatterplot as ms
 
@@ -17,7 +18,7 @@ def build_frame(embedding, embedding_set, db, labels, confidence_threshold=0.0,
     Builds a ScatterplotFrame using the given embedding object. 
     
     Args:
-        embedding: A pyemblib embedding object
+        embedding: A pyemblib embedding object (or nn_io.MappedEmbeddings)
         embedding_set: An EmbeddingSet object that can be used to retrieve
             neighbors and confidence values
         db: An EmbeddingNeighborhoodDatabase
@@ -112,7 +113,7 @@ def build_frame(embedding, embedding_set, db, labels, confidence_threshold=0.0,
     frame = ms.ScatterplotFrame(points)
 
     # Compute TSNE and add to the frame
-    hi_d = np.vstack([embedding[id_val] for id_val in frame.get_ids()])
+    hi_d = nn_io.embeddingArray(embedding, frame.get_ids())
     lo_d = TSNE(metric='cosine', n_iter=2000).fit_transform(hi_d)
     frame.set_mat(["x", "y"], lo_d)
     
@@ -148,9 +149,97 @@ def align_frames(frames):
         best_proj = ms.align_projection(base_frame, frame)
         frame.set_mat(["aligned_x", "aligned_y"], best_proj[:,:2])
 
+def _write_atomically(out_path, contents):
+    tmp_path = '{0}.tmp'.format(out_path)
+    with open(tmp_path, "wb") as file:
+        file.write(contents)
+    os.replace(tmp_path, out_path)
+
+def _write_json(obj, out_path):
+    """
+    Writes obj as JSON to out_path, along with a gzip-compressed copy
+    (out_path + '.gz') for the dashboard to serve. Returns the JSON bytes.
+    """
+    contents = json.dumps(ms.round_floats(obj, 4)).encode('utf-8')
+    _write_atomically(out_path, contents)
+    # (written after the JSON, so it's never older than the file it copies)
+    _write_atomically('{0}.gz'.format(out_path),
+        gzip.compress(contents, compresslevel=9, mtime=0))
+    return contents
+
+def write_visualization_frames(data, corpora, out_path, build):
+    """
+    Writes the viewer data for each frame to its own file, plus a manifest
+    listing the frames, so that the dashboard can serve frames one at a time.
+
+    Point attributes that don't change between frames (ID, hover text, color)
+    are stored once, in the manifest's "points" dictionary; each frame file
+    refers to points by their index in it, and holds only the per-frame
+    values, as parallel lists:
+     - points: dictionary index of each point plotted in the frame
+     - x, y, confidence: values for each point
+     - highlight: dictionary indices of each point's nearest neighbors
+
+    Args:
+        data: A list of viewer dictionaries (from to_viewer_dict), one per
+            frame
+        corpora: A list of frame labels
+        out_path: Path of the full visualization file; frame and manifest
+            paths are derived from it (see nn_io)
+        build: An identifier for this version of the data, recorded in the
+            manifest and each frame so mismatched files can be detected
+    """
+    points = {"id": [], "hoverText": [], "color": []}
+    point_indices = {}
+    def point_index(id_val, item=None):
+        if id_val not in point_indices:
+            point_indices[id_val] = len(points["id"])
+            points["id"].append(id_val)
+            points["hoverText"].append(None)
+            points["color"].append(None)
+        ix = point_indices[id_val]
+        if item is not None and points["hoverText"][ix] is None:
+            points["hoverText"][ix] = item["hoverText"]
+            points["color"][ix] = item["color"]
+        return ix
+
+    frame_summaries = []
+    for i, (frame_data, label) in enumerate(zip(data, corpora)):
+        columns = {"points": [], "x": [], "y": [], "confidence": [], "highlight": []}
+        for id_val, item in frame_data.items():
+            columns["points"].append(point_index(id_val, item))
+            columns["x"].append(item["x"])
+            columns["y"].append(item["y"])
+            columns["confidence"].append(item["confidence"])
+            columns["highlight"].append([point_index(neighbor) for neighbor in item["highlight"]])
+        _write_json(dict(build=build, label=label, **columns),
+            nn_io.visualizationFramePath(out_path, i))
+        frame_summaries.append({"label": label, "numPoints": len(columns["points"])})
+
+    # remove any frames left over from a previous, longer visualization
+    i = len(frame_summaries)
+    while os.path.exists(nn_io.visualizationFramePath(out_path, i)):
+        for stale_path in (nn_io.visualizationFramePath(out_path, i),
+                '{0}.gz'.format(nn_io.visualizationFramePath(out_path, i))):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        i += 1
+
+    # (written last, so it never lists frames that aren't there yet)
+    _write_json({
+        "build": build,
+        "frameLabels": corpora,
+        "previewMode": "neighborSimilarity",
+        "frames": frame_summaries,
+        "points": points
+    }, nn_io.visualizationManifestPath(out_path))
+
 def write_visualization_file(frames, corpora, out_path, x_key, y_key):
     """
-    Writes out a JSON file with the given visualization data.
+    Writes out a JSON file with the given visualization data, along with a
+    gzip-compressed copy (out_path + '.gz') for the dashboard to serve, and
+    the same data split into a manifest and per-frame files (see
+    write_visualization_frames).
     """
     data = [frame.to_viewer_dict(x_key=x_key, 
                                  y_key=y_key,
@@ -161,12 +250,13 @@ def write_visualization_file(frames, corpora, out_path, x_key, y_key):
                                      "hoverText": lambda _, item: item["hoverText"]
                                  })
             for frame in frames]
-    with open(out_path, "w") as file:
-        json.dump(ms.round_floats({
-            "data": data,
-            "frameLabels": corpora,
-            "previewMode": "neighborSimilarity"
-        }, 4), file)
+    contents = _write_json({
+        "data": data,
+        "frameLabels": corpora,
+        "previewMode": "neighborSimilarity"
+    }, out_path)
+    write_visualization_frames(data, corpora, out_path,
+        build=hashlib.sha1(contents).hexdigest()[:12])
         
 
 if __name__ == '__main__':
@@ -240,9 +330,9 @@ if __name__ == '__main__':
         emb_path = os.path.join(
             options.input_base,
             visualization_config['EmbeddingFilePattern'].format(CORPUS=corpus))
-        embedding = pyemblib.read(emb_path,
-                                  mode=visualization_config['EmbeddingFormat'],
-                                  errors='replace')
+        embedding = nn_io.readEmbeddings(emb_path,
+                                         mode=visualization_config['EmbeddingFormat'],
+                                         cache_dir=visualization_config.get('EmbeddingCacheDirectory', None))
 
         t = log.startTimer('Building frame and running TSNE...')
         frame = build_frame(embedding, emb_set, db, labels,
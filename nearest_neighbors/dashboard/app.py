@@ -3,18 +3,122 @@ from flask import render_template
 from flask import request
 from flask import jsonify
 from flask import send_from_directory
+from flask import send_file
+from flask import g
 app = Flask(__name__)
 
 import os
+import sqlite3
+import threading
 import configparser
 from nearest_neighbors.database import *
+from nearest_neighbors import nn_io
 from nearest_neighbors.dashboard import packaging
 from nearest_neighbors.dashboard import visualization
+from nearest_neighbors.dashboard import typeahead
+from nearest_neighbors.dashboard.response_cache import ResponseCache
+from nearest_neighbors.dashboard.info_cards import *
 from nearest_neighbors.calculation import pair_similarity
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 
+DEFAULT_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_PAGE_SIZE = 200
+DEFAULT_AUTOCOMPLETE_RESULTS = 10
+MAX_AUTOCOMPLETE_RESULTS = typeahead.TypeaheadIndex.MAX_RESULTS
+MAX_PAIRWISE_BATCH_SIZE = 1000
+IMAGE_CACHE_TTL = 24*60*60
+
+_db_config = config['PairedNeighborhoodAnalysis']
+db_pool = DatabasePool(
+    _db_config['DatabaseFile'],
+    size=_db_config.getint('DatabasePoolSize', 8),
+    immutable=_db_config.getboolean('DatabaseImmutable', False),
+    mmap_size=_db_config.getint('DatabaseMmapSize', 268435456),
+    cache_size=_db_config.getint('DatabaseCacheSize', 65536)
+)
+
+## upgrade the DB schema now (failing fast if it's out of date and can't
+## be upgraded), rather than on the first request; then, as no pairwise
+## similarity jobs survive a restart, clear any left marked as running
+if os.path.exists(_db_config['DatabaseFile']):
+    db_pool.ensureSchema()
+    try:
+        _startup_db = EmbeddingNeighborhoodDatabase(_db_config['DatabaseFile'])
+        pair_similarity.recoverStaleJobs(_startup_db)
+        _startup_db.close()
+    except sqlite3.OperationalError:
+        # read-only DB file
+        pass
+
+def getDB():
+    '''Returns the pooled (read-only) DB connection for the current request,
+    checking one out on first use.
+    '''
+    if not 'db' in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def releaseDB(exception):
+    db = g.pop('db', None)
+    if db is not None:
+        db_pool.release(db)
+
+def _boundedInt(value, default, minimum, maximum=None):
+    '''Parses a request parameter as an int clamped to [minimum, maximum],
+    falling back to default if it's missing or not a number.
+    '''
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = default
+    value = max(minimum, value)
+    if not (maximum is None):
+        value = min(maximum, value)
+    return value
+
+def getDataVersion():
+    '''Identifies the current contents of the DB: the file itself (so
+    swapping in a new DB file is noticed) and its stored data version.
+    '''
+    stat = os.stat(_db_config['DatabaseFile'])
+    try:
+        data_version = getDB().dataVersion()
+    except sqlite3.OperationalError:
+        # DB predates data versioning (and couldn't be upgraded)
+        data_version = stat.st_mtime_ns
+    return (stat.st_dev, stat.st_ino, data_version)
+
+response_cache = ResponseCache(
+    max_entries=_db_config.getint('ResponseCacheSize', 1024),
+    ttl=_db_config.getint('ResponseCacheTTL', 300)
+)
+cached = response_cache.cached(app, getDataVersion)
+
+## rendered plots are memoized separately (by entity and data version), so
+## they aren't pushed out by other responses
+image_cache = ResponseCache(
+    max_entries=_db_config.getint('ImageCacheSize', 256),
+    ttl=IMAGE_CACHE_TTL
+)
+cached_image = image_cache.cached(app, getDataVersion)
+_render_lock = threading.Lock()
+
+## build the autocomplete index up front, so no request waits on it (it's
+## rebuilt when the data version changes)
+if os.path.exists(_db_config['DatabaseFile']):
+    with app.app_context():
+        typeahead.getIndex(getDB(), getDataVersion())
+
+@app.route('/_response_cache_stats')
+def responseCacheStats():
+    return jsonify({
+        'responses': response_cache.stats(),
+        'images': image_cache.stats(),
+    })
+
 @app.route('/')
 def landingPage():
     return send_from_directory('diachronic-concept-viewer/public', 'index.html')
@@ -23,22 +127,58 @@ def landingPage():
 def staticFiles(path):
     return send_from_directory('diachronic-concept-viewer/public', path)
 
+def _sendJSONFile(path):
+    '''Serves the JSON file at path, or its gzipped copy (path + '.gz', as
+    written by prepare_visualization) if the client accepts it and it's not
+    out of date.
+    '''
+    compressed_path = '{0}.gz'.format(path)
+    use_compressed = (
+        'gzip' in request.accept_encodings
+        and os.path.exists(compressed_path)
+        and os.stat(compressed_path).st_mtime >= os.stat(path).st_mtime
+    )
+
+    # (streamed from disk, with ETag/Last-Modified for conditional requests)
+    response = send_file(
+        compressed_path if use_compressed else path,
+        mimetype='application/json',
+        conditional=True
+    )
+    if use_compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/visualization')
 def getVisualizationData():
     vis_path = config['Visualization']['OutputFile']
     if not os.path.exists(vis_path):
         return app.response_class(
             response="The dataset does not exist", status=404)
-    with open(vis_path, "r") as file:
+    return _sendJSONFile(vis_path)
+
+@app.route('/visualization/manifest')
+def getVisualizationManifest():
+    manifest_path = nn_io.visualizationManifestPath(
+        config['Visualization']['OutputFile'])
+    if not os.path.exists(manifest_path):
         return app.response_class(
-            response=file.read(),
-            status=200,
-            mimetype='application/json'
-        )
+            response="The dataset does not exist", status=404)
+    return _sendJSONFile(manifest_path)
+
+@app.route('/visualization/frame/<int:i>')
+def getVisualizationFrame(i):
+    frame_path = nn_io.visualizationFramePath(
+        config['Visualization']['OutputFile'], i)
+    if not os.path.exists(frame_path):
+        return app.response_class(
+            response="Frame {0} does not exist".format(i), status=404)
+    return _sendJSONFile(frame_path)
 
 @app.route('/entities')
 def listAllEntities():
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
     
     rows = list(db.selectAllPreferredEntityNamesWithNeighbors())
     if not rows:
@@ -55,8 +195,23 @@ def listAllEntities():
     
     return jsonify(result)
 
+@app.route('/autocomplete')
+def autocomplete():
+    prefix = request.args.get('q', '')
+    limit = _boundedInt(request.args.get('limit', None), DEFAULT_AUTOCOMPLETE_RESULTS,
+        1, MAX_AUTOCOMPLETE_RESULTS)
+
+    index = typeahead.getIndex(getDB(), getDataVersion())
+
+    result = [
+        {"id": key, "name": name, "match": term}
+            for (key, name, term) in index.lookup(prefix, limit=limit)
+    ]
+    return jsonify(result)
+
 @app.route('/showchanges', methods=['POST'])
 @app.route('/showchanges/<src>/<trg>/<filter_set>/<at_k>', methods=['GET', 'POST'])
+@cached
 def showChanges(src=None, trg=None, filter_set=None, at_k=None):
     if request.method == 'GET':
         getter = request.args.get
@@ -72,7 +227,7 @@ def showChanges(src=None, trg=None, filter_set=None, at_k=None):
     if at_k is None:
         at_k = getter('at_k', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
 
     top_cwd, bottom_cwd = [], []
     rows = db.selectFromEntityOverlapAnalysis(
@@ -115,8 +270,6 @@ def showChanges(src=None, trg=None, filter_set=None, at_k=None):
             'CWD': packaging.prettify(row.CWD, decimals=2)
         })
 
-    db.close()
-
     return render_template(
         'showchanges.html',
         top_cwd=top_cwd,
@@ -128,6 +281,7 @@ def showChanges(src=None, trg=None, filter_set=None, at_k=None):
 
 @app.route('/info', methods=['POST'])
 @app.route('/info/<query_key>', methods=['GET', 'POST'])
+@cached
 def info(query_key=None):
     if request.method == 'GET':
         getter = request.args.get
@@ -142,88 +296,80 @@ def info(query_key=None):
     neighbor_type = getter('neighbor_type', 'ENTITY')
     neighbor_type = EmbeddingType.parse(neighbor_type)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
     hc_threshold = float(config['PairedNeighborhoodAnalysis']['HighConfidenceThreshold'])
     num_neighbors = int(config['PairedNeighborhoodAnalysis']['NumNeighborsToShow'])
 
-    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=1))
-
-    ## (1) get its confidence history
-    confidences = getConfidences(
-        db,
-        embedding_sets,
-        query_key
+    ## use the precomputed card for this entity, if it's up to date
+    card = db.getEntityInfoCard(
+        query_key,
+        neighbor_type=neighbor_type,
+        num_neighbors=num_neighbors
     )
+    if not card is None:
+        if 'gzip' in request.accept_encodings:
+            response = app.response_class(
+                response=card,
+                status=200,
+                mimetype='application/json'
+            )
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = app.response_class(
+                response=decodeInfoCard(card),
+                status=200,
+                mimetype='application/json'
+            )
+        response.vary.add('Accept-Encoding')
+        return response
+
+    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=1))
 
-    ## (2) get the nearest neighbors
-    tables = getNeighborTables(
+    payload = getInfoPayload(
         db,
         embedding_sets,
         query_key,
         neighbor_type,
-        confidences,
-        limit=num_neighbors,
+        num_neighbors=num_neighbors,
         high_confidence_threshold=hc_threshold
     )
 
-    ## (3) get the terms and definitions for the entity
-    term_list, preferred_term = getTerms(
-        db,
-        query_key
-    )
-    definition_list = getDefinitions(
+    return jsonify(payload)
+
+
+@app.route('/info/<query_key>/changes.png')
+@cached_image
+def entityChangePlot(query_key):
+    db = getDB()
+    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=1))
+
+    cwds = getChangeHistory(
         db,
+        embedding_sets,
         query_key
     )
+    if not any(cwds):
+        return app.response_class(
+            response="No change analysis for this entity", status=404)
 
-    ## (4) get its change history
-    cwds = []
-    for i in range(len(embedding_sets)-1):
-        change_src = embedding_sets[i]
-        change_trg = embedding_sets[i+1]
-        filter_set = '.HC_Union_{0}_{1}'.format(change_src.name, change_trg.name)  ## TODO HARD CODED
-        at_k = 5  ## TODO HARD CODED
-
-        rows = db.selectFromEntityOverlapAnalysis(
-            change_src,
-            change_trg,
-            filter_set=filter_set,
-            at_k=at_k,
-            entity_key=query_key
-        )
-        rows = list(rows)
-        if len(rows) == 1:
-            cwds.append(rows[0].CWD)
-        else:
-            cwds.append(None)
-
-    if any(cwds):
-        entity_change_analysis_base64 = packaging.renderImage(
+    # pyplot keeps global state, so render one plot at a time
+    with _render_lock:
+        image = packaging.renderImageBytes(
             visualization.entityChangeAnalysis,
             args=(embedding_sets, cwds),
             kwargs={'figsize': (11,3), 'font_size': 14}
         )
 
-    return jsonify({
-        "id": query_key,
-        "name": preferred_term,
-        "definitions": sorted(definition_list),
-        "confidences": {i: confidences.get(es.ID, None) for i, es in enumerate(embedding_sets)},
-        "otherTerms": sorted(term_list),
-        "frameDescriptions": {
-            i: ("Confidence: {:.3f}".format(confidences[es.ID])
-                if es.ID in confidences else "")
-            for i, es in enumerate(embedding_sets)},
-        "neighbors": {i: [
-            {"id": n["NeighborKey"],
-             "name": n["NeighborString"],
-             "distance": float(n["Distance"])} for n in tables[i]["Rows"]
-        ] for i, es in enumerate(embedding_sets)}
-    })
+    return app.response_class(
+        response=image,
+        status=200,
+        mimetype='image/png'
+    )
 
 
 @app.route('/terms', methods=['POST'])
 @app.route('/terms/<query_key>', methods=['GET', 'POST'])
+@cached
 def terms(query_key=None):
     if request.method == 'GET':
         getter = request.args.get
@@ -233,7 +379,7 @@ def terms(query_key=None):
     if query_key is None:
         query_key = getter('query_key', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
 
     rows = db.selectFromEntityTerms(
         query_key
@@ -254,6 +400,7 @@ def terms(query_key=None):
 
 @app.route('/search', methods=['POST'])
 @app.route('/search/<query>', methods=['GET', 'POST'])
+@cached
 def search(query=None):
     if request.method == 'GET':
         getter = request.args.get
@@ -262,15 +409,22 @@ def search(query=None):
 
     if query is None:
         query = getter('query', None)
+    page = _boundedInt(getter('page', None), 1, 1)
+    page_size = _boundedInt(getter('page_size', None), DEFAULT_SEARCH_PAGE_SIZE,
+        1, MAX_SEARCH_PAGE_SIZE)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
 
-    rows = db.searchInEntityTerms(
-        query
-    )
+    # fetch one extra row to check if there is another page
+    rows = list(db.searchInEntityTerms(
+        query,
+        limit=page_size+1,
+        offset=(page-1)*page_size
+    ))
+    has_next_page = len(rows) > page_size
 
     table_rows = []
-    for row in rows:
+    for row in rows[:page_size]:
         table_rows.append({
             'Key': row.entity_key,
             'Term': row.term,
@@ -279,18 +433,22 @@ def search(query=None):
     return render_template(
         'search.html',
         query=query,
-        rows=table_rows
+        rows=table_rows,
+        page=page,
+        page_size=page_size,
+        has_next_page=has_next_page
     )
 
 
 @app.route('/_get_aggregate_nearest_neighbors_membership')
+@cached
 def getAggregateNearestNeighborsMembership():
     query_key = request.args.get('query_key', None)
     current_corpora = request.args.get('current_corpora', '')
 
     current_corpora = set(current_corpora.split(','))
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
 
     rows = db.findAggregateNearestNeighborsMembership(query_key)
 
@@ -304,6 +462,102 @@ def getAggregateNearestNeighborsMembership():
     return jsonify(table_rows)
 
 
+def _pairwiseBatchResponse(batch_info, embedding_sets):
+    '''JSON response for a batch of pairwise similarities: 200 with the
+    similarity trajectories once they're all available, 202 while they're
+    being calculated, or 503 if the calculation couldn't be queued.
+    '''
+    response = {
+        "batch": batch_info["batch"],
+        "status": batch_info.get("status", "complete"),
+        "result": None
+    }
+    if batch_info["result"] is None:
+        if "error" in batch_info:
+            response["error"] = batch_info["error"]
+        status = 503 if response["status"] == "busy" else 202
+        return jsonify(response), status
+
+    response["result"] = []
+    for ((query, target), sims) in batch_info["result"].items():
+        sims_by_source = { sim.source.ID: sim for sim in sims }
+        response["result"].append({
+            "query": query,
+            "target": target,
+            "similarities": [{
+                "label": emb_set.name,
+                "meanSimilarity": sims_by_source[emb_set.ID].mean_similarity if emb_set.ID in sims_by_source else None,
+                "stdSimilarity": sims_by_source[emb_set.ID].std_similarity if emb_set.ID in sims_by_source else None,
+            } for emb_set in embedding_sets]
+        })
+    return jsonify(response)
+
+@app.route('/pairwise/batch', methods=['GET', 'POST'])
+def pairwiseBatch():
+    '''Similarity trajectories for many entity pairs at once: either a list
+    of [query, target] pairs (JSON body {"pairs": [...]}) or one query
+    against a list of targets ({"query": ..., "targets": [...]}, or
+    ?query=...&targets=a,b,c).
+
+    Any missing similarities are calculated by a job on the background
+    worker pool; until they're ready, the response has no result, and its
+    "batch" ID can be polled at /pairwise/batch/<batch ID> (or the same
+    request repeated).
+    '''
+    if request.method == 'GET':
+        body = {
+            'query': request.args.get('query', None),
+            'targets': [t for t in request.args.get('targets', '').split(',') if len(t) > 0]
+        }
+    else:
+        body = request.get_json(silent=True) or {}
+
+    if body.get('pairs', None):
+        pairs = [tuple(pair) for pair in body['pairs']]
+        if any([len(pair) != 2 for pair in pairs]):
+            return app.response_class(
+                response="Pairs must be [query, target] lists", status=400)
+    elif body.get('query', None) and body.get('targets', None):
+        pairs = [(body['query'], target) for target in body['targets']]
+    else:
+        return app.response_class(
+            response="Must provide pairs, or a query and targets", status=400)
+    if len(pairs) > MAX_PAIRWISE_BATCH_SIZE:
+        return app.response_class(
+            response="At most {0:,} pairs may be requested at once".format(MAX_PAIRWISE_BATCH_SIZE),
+            status=400)
+
+    # (this only reads saved similarities; the background job calculating
+    # any missing ones opens its own writable connection)
+    db = getDB()
+    group = db.getOrCreateEmbeddingSetGroup('CORD-19')
+    embedding_sets = sorted(db.selectFromEmbeddingSets(group_ID=group.ID), key=lambda es: es.ordering)
+    batch_info = pair_similarity.calculateAggregatePairwiseSimilaritiesForPairsBackground(
+        group,
+        pairs,
+        config,
+        db
+    )
+
+    return _pairwiseBatchResponse(batch_info, embedding_sets)
+
+@app.route('/pairwise/batch/<batch_ID>')
+def pairwiseBatchStatus(batch_ID):
+    db = getDB()
+    batch_info = pair_similarity.getAggregatePairwiseSimilaritiesBatch(
+        batch_ID,
+        config,
+        db
+    )
+    if batch_info is None:
+        return app.response_class(
+            response="Batch {0} not found".format(batch_ID), status=404)
+    group = db.getOrCreateEmbeddingSetGroup('CORD-19')
+    embedding_sets = sorted(db.selectFromEmbeddingSets(group_ID=group.ID), key=lambda es: es.ordering)
+
+    return _pairwiseBatchResponse(batch_info, embedding_sets)
+
+
 @app.route('/pairwise', methods=['POST'])
 @app.route('/pairwise/<query>/<target>', methods=['GET', 'POST'])
 def pairwise(query=None, target=None):
@@ -317,19 +571,22 @@ def pairwise(query=None, target=None):
     if target is None:
         target = getter('target', None)
 
-    db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+    db = getDB()
     num_neighbors = int(config['PairedNeighborhoodAnalysis']['NumNeighborsToShow'])
-    group = db.getOrCreateEmbeddingSetGroup('CORD-19')
-    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=group.ID))
 
     ## (1) get pairwise similarity data
+    # (this writes progress and results, so needs its own writable connection)
+    write_db = EmbeddingNeighborhoodDatabase(config['PairedNeighborhoodAnalysis']['DatabaseFile'], build=False)
+    group = write_db.getOrCreateEmbeddingSetGroup('CORD-19')
     similarity_info = pair_similarity.calculateAllAggregatePairwiseSimilaritiesBackground(
         group,
         query,
         target,
         config,
-        db
+        write_db
     )
+    write_db.close()
+    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=group.ID))
     if not similarity_info["result"]:
         # Return progress
         progress_obj = similarity_info["progress"]
@@ -409,86 +666,3 @@ def pairwise(query=None, target=None):
         ]   
         }
     })
-
-
-
-
-## TODO: change to single query
-def getNeighborTables(db, embedding_sets, query_key, neighbor_type, confidences,
-        limit=10, high_confidence_threshold=0.5):
-    tables = []
-    TABLES_PER_ROW = 3
-    for i in range(len(embedding_sets)):
-        embedding_set = embedding_sets[i]
-        filter_set='.HC_{0}'.format(embedding_set.name)
-        rows = db.selectFromAggregateNearestNeighbors(
-            embedding_set,
-            embedding_set,
-            filter_set,
-            query_key,
-            neighbor_type=neighbor_type,
-            limit=limit
-        )
-
-        table_rows = []
-        for row in rows:
-            table_rows.append({
-                'QueryKey': query_key,
-                'NeighborKey': row.neighbor_key,
-                'NeighborString': row.neighbor_string,
-                'Distance': packaging.prettify(row.mean_distance, decimals=3)
-            })
-
-        confidence = confidences.get(embedding_set.ID, None)
-        if confidence is None:
-            table_class = 'no_data'
-        else:
-            if confidence >= high_confidence_threshold:
-                table_class = 'high_confidence'
-            else:
-                table_class = 'low_confidence'
-
-        tables.append({
-            'Corpus': embedding_set.name,
-            'Confidence': confidence,
-            'Class': table_class,
-            'Rows': table_rows,
-            'NumRows' : limit,
-            'IsGridRowStart': (i % TABLES_PER_ROW) == 0,
-            'IsGridRowEnd': (i % TABLES_PER_ROW) == (TABLES_PER_ROW - 1),
-        })
-    return tables
-
-## TODO: change to single query
-def getConfidences(db, embedding_sets, query_key):
-    confidences = {}
-    for embedding_set in embedding_sets:
-        rows = db.selectFromInternalConfidence(
-            src=embedding_set,
-            at_k=5,
-            key=query_key
-        )
-        for row in rows:
-            confidences[embedding_set.ID] = row.confidence
-    return confidences
-
-def getTerms(db, query_key):
-    all_terms = db.selectFromEntityTerms(
-        query_key
-    )
-    term_list, preferred_term = [], ''
-    for term in all_terms:
-        if term.preferred == 1:
-            preferred_term = term.term
-        else:
-            term_list.append(term.term)
-    return term_list, preferred_term
-
-def getDefinitions(db, query_key):
-    all_definitions = db.selectFromEntityDefinitions(
-        query_key
-    )
-    return [
-        defn.definition
-            for defn in all_definitions
-    ]
@@ -0,0 +1,269 @@
+'''
+Assembly of the dashboard's per-entity /info payloads, and a build step
+that precomputes them for every entity as compressed "cards" in the
+analysis DB, so /info can be served with a single keyed read.
+
+Cards are tied to the DB's data version: any later change to the analysis
+data leaves them stale (and ignored by /info) until they are rebuilt.
+'''
+
+import json
+import gzip
+import configparser
+from hedgepig_logger import log
+from nearest_neighbors.database import *
+from nearest_neighbors.dashboard import packaging
+
+def getNeighborTables(db, embedding_sets, query_key, neighbor_type, confidences,
+        limit=10, high_confidence_threshold=0.5):
+    rows_by_source = { embedding_set.ID: [] for embedding_set in embedding_sets }
+    rows = db.selectFromAggregateNearestNeighborsBySubset(
+        [
+            (embedding_set, embedding_set, '.HC_{0}'.format(embedding_set.name))
+                for embedding_set in embedding_sets
+        ],
+        query_key,
+        neighbor_type=neighbor_type,
+        limit=limit
+    )
+    for row in rows:
+        rows_by_source[row.source.ID].append(row)
+
+    tables = []
+    TABLES_PER_ROW = 3
+    for i in range(len(embedding_sets)):
+        embedding_set = embedding_sets[i]
+
+        table_rows = []
+        for row in rows_by_source[embedding_set.ID]:
+            table_rows.append({
+                'QueryKey': query_key,
+                'NeighborKey': row.neighbor_key,
+                'NeighborString': row.neighbor_string,
+                'Distance': packaging.prettify(row.mean_distance, decimals=3)
+            })
+
+        confidence = confidences.get(embedding_set.ID, None)
+        if confidence is None:
+            table_class = 'no_data'
+        else:
+            if confidence >= high_confidence_threshold:
+                table_class = 'high_confidence'
+            else:
+                table_class = 'low_confidence'
+
+        tables.append({
+            'Corpus': embedding_set.name,
+            'Confidence': confidence,
+            'Class': table_class,
+            'Rows': table_rows,
+            'NumRows' : limit,
+            'IsGridRowStart': (i % TABLES_PER_ROW) == 0,
+            'IsGridRowEnd': (i % TABLES_PER_ROW) == (TABLES_PER_ROW - 1),
+        })
+    return tables
+
+def getConfidences(db, embedding_sets, query_key):
+    confidences = {}
+    rows = db.selectFromInternalConfidence(
+        src=list(embedding_sets),
+        at_k=5,
+        key=query_key
+    )
+    for row in rows:
+        confidences[row.source.ID] = row.confidence
+    return confidences
+
+def getTerms(db, query_key):
+    all_terms = db.selectFromEntityTerms(
+        query_key
+    )
+    term_list, preferred_term = [], ''
+    for term in all_terms:
+        if term.preferred == 1:
+            preferred_term = term.term
+        else:
+            term_list.append(term.term)
+    return term_list, preferred_term
+
+def getDefinitions(db, query_key):
+    all_definitions = db.selectFromEntityDefinitions(
+        query_key
+    )
+    return [
+        defn.definition
+            for defn in all_definitions
+    ]
+
+def getChangeHistory(db, embedding_sets, query_key):
+    '''Returns the CWD of query_key between each consecutive pair of
+    embedding sets (None where there is no analysis).'''
+    cwds = []
+    for i in range(len(embedding_sets)-1):
+        change_src = embedding_sets[i]
+        change_trg = embedding_sets[i+1]
+        filter_set = '.HC_Union_{0}_{1}'.format(change_src.name, change_trg.name)  ## TODO HARD CODED
+        at_k = 5  ## TODO HARD CODED
+
+        rows = db.selectFromEntityOverlapAnalysis(
+            change_src,
+            change_trg,
+            filter_set=filter_set,
+            at_k=at_k,
+            entity_key=query_key
+        )
+        rows = list(rows)
+        if len(rows) == 1:
+            cwds.append(rows[0].CWD)
+        else:
+            cwds.append(None)
+    return cwds
+
+def getInfoPayload(db, embedding_sets, query_key, neighbor_type,
+        num_neighbors=10, high_confidence_threshold=0.5):
+    '''Assembles the JSON-ready /info payload for query_key.'''
+    ## (1) get its confidence history
+    confidences = getConfidences(
+        db,
+        embedding_sets,
+        query_key
+    )
+
+    ## (2) get the nearest neighbors
+    tables = getNeighborTables(
+        db,
+        embedding_sets,
+        query_key,
+        neighbor_type,
+        confidences,
+        limit=num_neighbors,
+        high_confidence_threshold=high_confidence_threshold
+    )
+
+    ## (3) get the terms and definitions for the entity
+    term_list, preferred_term = getTerms(
+        db,
+        query_key
+    )
+    definition_list = getDefinitions(
+        db,
+        query_key
+    )
+
+    return {
+        "id": query_key,
+        "name": preferred_term,
+        "definitions": sorted(definition_list),
+        "confidences": {i: confidences.get(es.ID, None) for i, es in enumerate(embedding_sets)},
+        "otherTerms": sorted(term_list),
+        "frameDescriptions": {
+            i: ("Confidence: {:.3f}".format(confidences[es.ID])
+                if es.ID in confidences else "")
+            for i, es in enumerate(embedding_sets)},
+        "neighbors": {i: [
+            {"id": n["NeighborKey"],
+             "name": n["NeighborString"],
+             "distance": float(n["Distance"])} for n in tables[i]["Rows"]
+        ] for i, es in enumerate(embedding_sets)}
+    }
+
+def encodeInfoCard(payload):
+    '''Serializes payload to gzip-compressed JSON (deterministically, so
+    rebuilding unchanged data gives identical cards).'''
+    return gzip.compress(
+        json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+        compresslevel=9,
+        mtime=0
+    )
+
+def decodeInfoCard(card):
+    return gzip.decompress(card)
+
+def buildInfoCards(db, neighbor_type=EmbeddingType.ENTITY, num_neighbors=10,
+        batch_size=1000):
+    '''Precomputes info cards for every entity with nearest neighbors in db,
+    for the current version of its data.  Returns the number of cards built.
+    '''
+    data_version = db.dataVersion()
+    embedding_sets = list(db.selectFromEmbeddingSets(group_ID=1))
+    keys = list(db.selectAllEntityKeysWithNeighbors())
+
+    log.track(message='  >> Built {0}/{1:,} info cards'.format('{0:,}', len(keys)), writeInterval=1000)
+    batch = []
+    for key in keys:
+        payload = getInfoPayload(
+            db,
+            embedding_sets,
+            key,
+            neighbor_type,
+            num_neighbors=num_neighbors
+        )
+        batch.append(EntityInfoCard(
+            entity_key=key,
+            neighbor_type=neighbor_type,
+            num_neighbors=num_neighbors,
+            data_version=data_version,
+            card=encodeInfoCard(payload)
+        ))
+        if len(batch) >= batch_size:
+            db.insertOrUpdate(batch)
+            batch = []
+        log.tick()
+    if len(batch) > 0:
+        db.insertOrUpdate(batch)
+    log.flushTracker()
+
+    return len(keys)
+
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog')
+        parser.add_option('-c', '--config', dest='configf',
+            default='config.ini')
+        parser.add_option('--neighbor-type', dest='neighbor_type',
+            help='type of nearest neighbors to show (default: %default)',
+            default='ENTITY')
+        parser.add_option('--batch-size', dest='batch_size',
+            type='int', default=1000,
+            help='number of cards to write to the DB at a time (default: %default)')
+        parser.add_option('-l', '--logfile', dest='logfile',
+            help='name of file to write log contents to (empty for stdout)',
+            default=None)
+        (options, args) = parser.parse_args()
+        # error check
+        _ = EmbeddingType.parse(options.neighbor_type)
+        return options
+
+    options = _cli()
+    log.start(options.logfile)
+    log.writeConfig([
+        ('Configuration file', options.configf),
+        ('Nearest neighbor type', options.neighbor_type),
+        ('Batch size', options.batch_size),
+    ], 'Precomputing dashboard entity info cards')
+
+    log.writeln('Reading configuration file from %s...' % options.configf)
+    config = configparser.ConfigParser()
+    config.read(options.configf)
+    config = config['PairedNeighborhoodAnalysis']
+    log.writeln('Done.\n')
+
+    log.writeln('Loading embedding neighborhood database...')
+    db = EmbeddingNeighborhoodDatabase(config['DatabaseFile'])
+    log.writeln('Database ready.\n')
+
+    log.writeln('Building info cards...')
+    num_cards = buildInfoCards(
+        db,
+        neighbor_type=EmbeddingType.parse(options.neighbor_type),
+        num_neighbors=int(config['NumNeighborsToShow']),
+        batch_size=options.batch_size
+    )
+    num_stale = db.deleteStaleEntityInfoCards()
+    log.writeln('Built {0:,} cards (removed {1:,} stale cards).\n'.format(num_cards, num_stale))
+
+    db.close()
+
+    log.stop()
@@ -10,9 +10,11 @@ def prettify(value, decimals=2):
         fmt = '{0}'
     return fmt.format(value)
 
-def renderImage(func, args, kwargs):
+def renderImageBytes(func, args, kwargs):
     stream = BytesIO()
     func(*args, outf=stream, **kwargs)
-    stream.seek(0)
-    base64_data = base64.b64encode(stream.getvalue())
+    return stream.getvalue()
+
+def renderImage(func, args, kwargs):
+    base64_data = base64.b64encode(renderImageBytes(func, args, kwargs))
     return base64_data.decode('utf8')
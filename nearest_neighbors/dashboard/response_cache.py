@@ -0,0 +1,114 @@
+'''
+Bounded LRU+TTL cache of dashboard responses, keyed on the request and
+invalidated whenever the underlying data changes version.
+'''
+
+import time
+import threading
+import functools
+import collections
+from flask import request
+
+class ResponseCache:
+    '''Thread-safe LRU cache of (body, status, headers) responses.
+
+    Entries expire after ttl seconds, and are ignored (and dropped) if they
+    were stored under a different data version than the one current when
+    they are looked up.  A max_entries of 0 disables caching.
+    '''
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            (entry_version, stored_at, value) = entry
+            if entry_version != version or (time.monotonic() - stored_at) > self.ttl:
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, version, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'maxEntries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': (self.hits / lookups) if lookups > 0 else None,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def cached(self, app, version_func):
+        '''Decorator for Flask view functions: serves successful responses
+        from the cache, keyed on route, arguments, and whether the client
+        accepts gzip; version_func() gives the current data version.
+        '''
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if self.max_entries <= 0:
+                    return view(*args, **kwargs)
+
+                key = (
+                    request.endpoint,
+                    request.path,
+                    tuple(sorted(request.args.items(multi=True))),
+                    tuple(sorted(request.form.items(multi=True))),
+                    'gzip' in request.accept_encodings
+                )
+                version = version_func()
+
+                value = self.get(key, version)
+                if not value is None:
+                    (body, status, headers) = value
+                    response = app.response_class(response=body, status=status, headers=headers)
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                response = app.make_response(view(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.put(key, version, (
+                        response.get_data(),
+                        response.status_code,
+                        list(response.headers.items())
+                    ))
+                response.headers['X-Cache'] = 'MISS'
+                return response
+            return wrapper
+        return decorator
@@ -0,0 +1,175 @@
+'''
+In-memory prefix index over entity terms, for server-side autocomplete
+in the dashboard's entity picker.
+'''
+
+import re
+import heapq
+import bisect
+import threading
+
+_WORD_START = re.compile(r'\b\w', re.UNICODE)
+_NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+def _normalize(string):
+    '''Case-folds string and collapses punctuation and whitespace to single
+    spaces.'''
+    return _NON_WORD.sub(' ', string.casefold()).strip()
+
+class TypeaheadIndex:
+    '''Sorted prefix index over entity terms.
+
+    Each term is indexed from its start and from the start of each of its
+    words (so "pneu" finds "Viral pneumonia"), along with the entity key
+    itself.  Lookups binary search the sorted index for the prefix range,
+    and rank the matches in it; prefixes with more than MAX_SCAN matching
+    entries (i.e., short ones) have their top matches ranked in advance,
+    when the index is built.
+    '''
+
+    # maximum number of index entries ranked at lookup time
+    MAX_SCAN = 1000
+    # maximum number of matches returned per lookup
+    MAX_RESULTS = 50
+
+    def __init__(self):
+        self._index_strings = []
+        self._index_entries = []
+        self._entries = []
+        self._names = {}
+        self._top_matches = {}
+
+    def __len__(self):
+        return len(self._names)
+
+    @staticmethod
+    def build(entity_terms):
+        '''Builds an index from an iterable of EntityTerm objects.  The
+        preferred term (or, failing that, the first term seen) for each
+        entity is used as its display name.
+        '''
+        index = TypeaheadIndex()
+        pending = []
+        seen_entities = set()
+        for ent_term in entity_terms:
+            key, term = ent_term.entity_key, ent_term.term
+            if (not key in index._names) or ent_term.preferred:
+                index._names[key] = term
+            entry_ID = len(index._entries)
+            index._entries.append((key, term, bool(ent_term.preferred)))
+            normalized = _normalize(term)
+            for match in _WORD_START.finditer(normalized):
+                pending.append((normalized[match.start():], entry_ID))
+            if not key in seen_entities:
+                seen_entities.add(key)
+                pending.append((_normalize(key), len(index._entries)))
+                index._entries.append((key, key, False))
+
+        pending.sort()
+        index._index_strings = [string for (string, _) in pending]
+        index._index_entries = [entry_ID for (_, entry_ID) in pending]
+        index._rankLongRanges()
+        return index
+
+    def _rankLongRanges(self, prefix='', start=0, end=None):
+        '''Ranks the matches for every prefix with more than MAX_SCAN index
+        entries, from the top matches for each of its one character longer
+        extensions (so that each index entry is only ranked once).
+
+        Returns the top MAX_RESULTS candidates for the entries from start to
+        end, which all begin with prefix.
+        '''
+        if end is None:
+            end = len(self._index_strings)
+        if end - start <= TypeaheadIndex.MAX_SCAN:
+            return self._topCandidates(self._candidates(start, end), TypeaheadIndex.MAX_RESULTS)
+
+        candidates = {}
+        length = len(prefix) + 1
+        i = start
+        while i < end:
+            if len(self._index_strings[i]) < length:
+                self._candidates(i, i+1, candidates)
+                i += 1
+                continue
+            next_prefix = self._index_strings[i][:length]
+            next_end = bisect.bisect_right(self._index_strings,
+                next_prefix + '\U0010ffff', i, end)
+            for (key, (rank, term)) in self._rankLongRanges(next_prefix, i, next_end):
+                if (not key in candidates) or rank < candidates[key][0]:
+                    candidates[key] = (rank, term)
+            i = next_end
+
+        top_candidates = self._topCandidates(candidates, TypeaheadIndex.MAX_RESULTS)
+        if len(prefix) > 0:
+            self._top_matches[prefix] = self._matches(top_candidates)
+        return top_candidates
+
+    def _candidates(self, start, end, candidates=None):
+        '''Gets the best-ranked term matched by index entries start to end
+        for each entity, as { entity key: (rank, term) }; preferred terms,
+        then shorter terms, rank first.
+        '''
+        if candidates is None:
+            candidates = {}
+        for i in range(start, end):
+            (key, term, preferred) = self._entries[self._index_entries[i]]
+            rank = (not preferred, len(term), term)
+            if (not key in candidates) or rank < candidates[key][0]:
+                candidates[key] = (rank, term)
+        return candidates
+
+    @staticmethod
+    def _topCandidates(candidates, limit):
+        return heapq.nsmallest(limit, candidates.items(), key=lambda item: item[1][0])
+
+    def _matches(self, top_candidates):
+        return [
+            (key, self._names.get(key, term), term)
+                for (key, (rank, term)) in top_candidates
+        ]
+
+    def lookup(self, prefix, limit=10):
+        '''Returns up to limit (at most MAX_RESULTS) matches for prefix, as
+        (entity key, display name, matched term) tuples; one match per
+        entity, ranking preferred terms, then shorter terms, first.
+        '''
+        prefix = _normalize(prefix)
+        if len(prefix) == 0:
+            return []
+        limit = min(limit, TypeaheadIndex.MAX_RESULTS)
+
+        start = bisect.bisect_left(self._index_strings, prefix)
+        end = bisect.bisect_right(self._index_strings, prefix + '\U0010ffff', start)
+        if end - start > TypeaheadIndex.MAX_SCAN:
+            return self._top_matches[prefix][:limit]
+        return self._matches(self._topCandidates(self._candidates(start, end), limit))
+
+## (data version, TypeaheadIndex) for the current index, replaced as a
+## whole so it can be read without locking
+_current = (None, None)
+_build_lock = threading.Lock()
+
+def getIndex(db, version=None):
+    '''Returns the process-wide TypeaheadIndex, (re)building it from db
+    (an EmbeddingNeighborhoodDatabase) if it hasn't been built yet or was
+    built for a data version other than version.
+
+    While one caller rebuilds the index, others keep getting the previous
+    one rather than waiting for the rebuild.
+    '''
+    global _current
+    (index_version, index) = _current
+    if (not index is None) and index_version == version:
+        return index
+
+    if not _build_lock.acquire(blocking=(index is None)):
+        return index
+    try:
+        (index_version, index) = _current
+        if index is None or index_version != version:
+            index = TypeaheadIndex.build(db.selectAllEntityTermsWithNeighbors())
+            _current = (version, index)
+        return index
+    finally:
+        _build_lock.release()
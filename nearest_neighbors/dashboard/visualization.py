@@ -47,7 +47,7 @@ def entityChangeAnalysis(corpora, cwds, outf=None, figsize=(5,5), font_size=18):
         outf,
         format='png',
         bbox_inches='tight',
-        extra_artists=[]
+        bbox_extra_artists=[]
     )
 
     plt.close()
@@ -102,7 +102,7 @@ def pairwiseSimilarityAnalysis(corpora, means, stds, outf=None, figsize=(5,5), f
         outf,
         format='png',
         bbox_inches='tight',
-        extra_artists=[]
+        bbox_extra_artists=[]
     )
 
     plt.close()
@@ -159,7 +159,7 @@ def internalConfidenceAnalysis(corpora, confidences, threshold, outf=None, figsi
         outf,
         format='png',
         bbox_inches='tight',
-        extra_artists=[]
+        bbox_extra_artists=[]
     )
 
     plt.close()
@@ -109,6 +109,20 @@ class EntityDefinition:
         self.entity_key = entity_key
         self.definition = definition
 
+class EntityInfoCard:
+    entity_key = None
+    neighbor_type = None
+    num_neighbors = None
+    data_version = None
+    card = None
+
+    def __init__(self, entity_key, neighbor_type, num_neighbors, data_version, card):
+        self.entity_key = entity_key
+        self.neighbor_type = neighbor_type
+        self.num_neighbors = num_neighbors
+        self.data_version = data_version
+        self.card = card
+
 class AggregatePairwiseSimilarity:
     source = None
     key = None
@@ -1,6 +1,11 @@
 import sqlite3
 import os
-import math
+import re
+import json
+import queue
+import pathlib
+import threading
+import contextlib
 from .data_models import *
 
 class EmbeddingType:
@@ -22,10 +27,235 @@ class EmbeddingType:
         else:
             raise ValueError('EmbeddingType "%s" not known' % string)
 
+class ConflictPolicy:
+    '''How to handle rows that already exist in the database with
+    different values when bulk loading.'''
+    SKIP = 'skip'
+    OVERWRITE = 'overwrite'
+    FAIL = 'fail'
+
+    @staticmethod
+    def choices():
+        return [ConflictPolicy.SKIP, ConflictPolicy.OVERWRITE, ConflictPolicy.FAIL]
+
+    @staticmethod
+    def parse(string):
+        policy = string.strip().lower()
+        if not policy in ConflictPolicy.choices():
+            raise ValueError('ConflictPolicy "%s" not known' % string)
+        return policy
+
+## confidence-weighted deltas (CWD) for entity overlap analyses, joined
+## with the internal confidences of both sides and the preferred term for
+## the entity; materialized in the ConfidenceWeightedDeltas table
+_CWD_SELECT = '''
+SELECT
+    eoa.Source,
+    eoa.Target,
+    eoa.FilterSet,
+    eoa.AtK,
+    eoa.EntityKey,
+    eoa.ENSimilarity,
+    ic_src.Confidence AS SourceInternalConfidence,
+    ic_trg.Confidence AS TargetInternalConfidence,
+    (
+        ic_src.Confidence
+        * ic_trg.Confidence
+        * (1 - eoa.ENSimilarity)
+    ) AS ConfidenceWeightedDelta,
+    et.Term
+FROM
+    EntityOverlapAnalysis AS eoa
+INNER JOIN
+    EntityTerms AS et
+ON
+    et.EntityKey = eoa.EntityKey
+INNER JOIN
+    InternalConfidence AS ic_src
+ON
+    ic_src.EntityKey = eoa.EntityKey
+    AND ic_src.AtK = eoa.AtK
+    AND ic_src.Source = eoa.Source
+INNER JOIN
+    InternalConfidence AS ic_trg
+ON
+    ic_trg.EntityKey = eoa.EntityKey
+    AND ic_trg.AtK = eoa.AtK
+    AND ic_trg.Source = eoa.Target
+WHERE
+    et.Preferred=1
+    {0}
+'''
+
+## ordered schema migrations, as (version, description, statements);
+## applied in order to any database whose schema version is lower, so
+## existing DB files are upgraded in place when opened
+_MIGRATIONS = [
+    (
+        1,
+        'Covering indexes for dashboard queries',
+        [
+            '''
+            CREATE INDEX IF NOT EXISTS IX_EntityTerms_EntityKey_Preferred
+            ON EntityTerms (EntityKey, Preferred, Term)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_EntityTerms_Preferred_EntityKey
+            ON EntityTerms (Preferred, EntityKey, Term)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_AggregateNearestNeighborSubsets_NeighborID
+            ON AggregateNearestNeighborSubsets (NeighborID, Target, FilterSet)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_AggregateNearestNeighbors_EntityKey
+            ON AggregateNearestNeighbors (EntityKey, Source)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_InternalConfidence_Covering
+            ON InternalConfidence (Source, AtK, EntityKey, Confidence)
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_AggregatePairwiseSimilarity_Keys
+            ON AggregatePairwiseSimilarity (EntityKey, NeighborKey)
+            ''',
+            # refresh query planner statistics for the new indexes
+            'ANALYZE',
+        ]
+    ),
+    (
+        2,
+        'Materialized confidence-weighted deltas',
+        [
+            '''
+            CREATE TABLE IF NOT EXISTS ConfidenceWeightedDeltas
+            (
+                Source int,
+                Target int,
+                FilterSet text,
+                AtK int,
+                EntityKey text,
+                ENSimilarity real,
+                SourceInternalConfidence real,
+                TargetInternalConfidence real,
+                ConfidenceWeightedDelta real,
+                Term text,
+                UNIQUE(Source, Target, FilterSet, AtK, EntityKey, Term),
+                CONSTRAINT FK_Source
+                    FOREIGN KEY (Source)
+                    REFERENCES EmbeddingSets(ID),
+                CONSTRAINT FK_Target
+                    FOREIGN KEY (Target)
+                    REFERENCES EmbeddingSets(ID)
+            )
+            ''',
+            '''
+            CREATE INDEX IF NOT EXISTS IX_ConfidenceWeightedDeltas_CWD
+            ON ConfidenceWeightedDeltas (Source, Target, FilterSet, AtK, ConfidenceWeightedDelta)
+            ''',
+            # populate from any analyses already in the DB
+            '''
+            REPLACE INTO ConfidenceWeightedDeltas
+            {0}
+            '''.format(_CWD_SELECT.format('')),
+        ]
+    ),
+    (
+        3,
+        'Full-text search index over entity terms',
+        [
+            ## external-content FTS5 table over EntityTerms (rows are
+            ## matched by rowid); kept in sync by insertOrUpdateIntoEntityTerms
+            '''
+            CREATE VIRTUAL TABLE IF NOT EXISTS EntityTermsSearch
+            USING fts5(
+                EntityKey,
+                Term,
+                content='EntityTerms',
+                tokenize='unicode61 remove_diacritics 2',
+                prefix='2 3'
+            )
+            ''',
+            '''
+            INSERT INTO EntityTermsSearch(EntityTermsSearch) VALUES ('rebuild')
+            ''',
+        ]
+    ),
+    (
+        4,
+        'Data version counter and precomputed entity info cards',
+        [
+            ## single-row counter, bumped whenever analysis data is written;
+            ## anything derived from the DB contents can be keyed on it
+            '''
+            CREATE TABLE IF NOT EXISTS DataVersion
+            (
+                ID int PRIMARY KEY CHECK (ID = 0),
+                Version int
+            )
+            ''',
+            '''
+            INSERT OR IGNORE INTO DataVersion VALUES (0, 1)
+            ''',
+            ## gzip-compressed JSON payloads for the dashboard's /info route;
+            ## a card is only valid while its DataVersion is current
+            '''
+            CREATE TABLE IF NOT EXISTS EntityInfoCards
+            (
+                EntityKey text,
+                NeighborType int,
+                NumNeighbors int,
+                DataVersion int,
+                Card blob,
+                UNIQUE(EntityKey, NeighborType)
+            )
+            ''',
+        ]
+    ),
+    (
+        5,
+        'Entity key index for refreshing confidence-weighted deltas',
+        [
+            ## materializeConfidenceWeightedDeltas deletes by entity key
+            ## after every terminology load
+            '''
+            CREATE INDEX IF NOT EXISTS IX_ConfidenceWeightedDeltas_EntityKey
+            ON ConfidenceWeightedDeltas (EntityKey)
+            ''',
+        ]
+    ),
+]
+
+## schema version of a fully migrated database
+LATEST_SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+def _ftsPrefixQuery(query_string):
+    '''Converts free text from a search box into an FTS5 query matching
+    rows containing every word as a prefix (e.g., "covid pneu" ->
+    "covid"* "pneu"*).
+    '''
+    tokens = re.findall(r'\w+', query_string)
+    return ' '.join([
+        '"{0}"*'.format(token)
+            for token in tokens
+    ])
+
 class EmbeddingNeighborhoodDatabase:
     
-    def __init__(self, fpath, build=True):
-        self._connection = sqlite3.connect(fpath)
+    def __init__(self, fpath, build=True, read_only=False, immutable=False,
+            check_same_thread=True):
+        if read_only:
+            # read-only connections can't create or migrate the schema
+            uri = '{0}?mode=ro{1}'.format(
+                pathlib.Path(fpath).absolute().as_uri(),
+                '&immutable=1' if immutable else ''
+            )
+            self._connection = sqlite3.connect(uri, uri=True,
+                check_same_thread=check_same_thread)
+            build = False
+        else:
+            self._connection = sqlite3.connect(fpath,
+                check_same_thread=check_same_thread)
         self._cursor = self._connection.cursor()
         if build:
             self._build()
@@ -214,9 +444,72 @@ class EmbeddingNeighborhoodDatabase:
         )
         ''')
 
+        ## the SchemaMigrations table records which schema migrations have
+        ## been applied to this DB
+        self._cursor.execute('''
+        CREATE TABLE IF NOT EXISTS SchemaMigrations
+        (
+            Version int NOT NULL,
+            Description text,
+            AppliedAt text DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(Version)
+        )
+        ''')
+
         ## flush all changes to DB
         self._connection.commit()
 
+        self.migrate()
+
+    def schemaVersion(self):
+        self._cursor.execute('SELECT MAX(Version) FROM SchemaMigrations')
+        (version,) = self._cursor.fetchone()
+        return 0 if version is None else version
+
+    def migrate(self):
+        '''Applies any pending schema migrations, each in its own
+        transaction.  Returns the list of versions applied.
+        '''
+        current_version = self.schemaVersion()
+        applied = []
+        for (version, description, statements) in _MIGRATIONS:
+            if version <= current_version:
+                continue
+            ## sqlite3 only opens transactions implicitly before DML, so
+            ## DDL would otherwise be applied (and kept) statement by
+            ## statement; open one explicitly, whatever the isolation level
+            if self._connection.in_transaction:
+                self._connection.commit()
+            try:
+                self._cursor.execute('BEGIN')
+                for statement in statements:
+                    self._cursor.execute(statement)
+                self._cursor.execute(
+                    '''
+                    INSERT INTO SchemaMigrations (Version, Description) VALUES (
+                        ?, ?
+                    )
+                    ''',
+                    (version, description)
+                )
+                self._connection.commit()
+            except sqlite3.Error:
+                self._connection.rollback()
+                raise
+            applied.append(version)
+        return applied
+
+    def dataVersion(self):
+        self._cursor.execute('SELECT Version FROM DataVersion')
+        (version,) = self._cursor.fetchone()
+        return version
+
+    def _bumpDataVersion(self):
+        '''Marks the analysis data as changed (in the current transaction),
+        invalidating anything built from the previous version.
+        '''
+        self._cursor.execute('UPDATE DataVersion SET Version = Version + 1')
+
     def insertOrUpdate(self, objects, *args, **kwargs):
         if (not type(objects) is list) and (not type(objects) is tuple):
             objects = [objects]
@@ -230,13 +523,15 @@ class EmbeddingNeighborhoodDatabase:
         elif type(objects[0]) is InternalConfidence:
             self.insertOrUpdateIntoInternalConfidence(objects, *args, **kwargs)
         elif type(objects[0]) is AggregateNearestNeighbor:
-            self.insertOrUpdateIntoAggregateNearestNeighbors(objects, *args, **kwargs)
+            return self.insertOrUpdateIntoAggregateNearestNeighbors(objects, *args, **kwargs)
         elif type(objects[0]) is EntityTerm:
             self.insertOrUpdateIntoEntityTerms(objects, *args, **kwargs)
         elif type(objects[0]) is EntityDefinition:
             self.insertOrUpdateIntoEntityDefinitions(objects, *args, **kwargs)
         elif type(objects[0]) is AggregatePairwiseSimilarity:
             self.insertOrUpdateIntoAggregatePairwiseSimilarity(objects, *args, **kwargs)
+        elif type(objects[0]) is EntityInfoCard:
+            self.insertOrUpdateIntoEntityInfoCards(objects, *args, **kwargs)
 
     def insertOrUpdateIntoEmbeddingSetGroups(self, groups):
         if (not type(groups) is list) and (not type(groups) is tuple):
@@ -341,6 +636,8 @@ class EmbeddingNeighborhoodDatabase:
                 # set the ID of the group to the ID of the new row
                 e_set.ID = self._cursor.lastrowid
 
+            self._bumpDataVersion()
+
         if len(existing_rows) > 0:
             self._cursor.executemany(
                 '''
@@ -398,6 +695,12 @@ class EmbeddingNeighborhoodDatabase:
             rows
         )
 
+        # keep the materialized CWDs up to date
+        for (src, trg, filter_set, at_k) in set([row[:4] for row in rows]):
+            self.materializeConfidenceWeightedDeltas(src=src, trg=trg,
+                filter_set=filter_set, at_k=at_k, commit=False)
+
+        self._bumpDataVersion()
         self._connection.commit()
 
     def insertOrUpdateIntoInternalConfidence(self, confidences):
@@ -426,101 +729,263 @@ class EmbeddingNeighborhoodDatabase:
             rows
         )
 
+        # keep the materialized CWDs up to date for analyses using these
+        # confidences, on either side
+        for (src, at_k) in set([row[:2] for row in rows]):
+            self.materializeConfidenceWeightedDeltas(src=src, at_k=at_k, commit=False)
+            self.materializeConfidenceWeightedDeltas(trg=src, at_k=at_k, commit=False)
+
+        self._bumpDataVersion()
         self._connection.commit()
 
-    def insertOrUpdateIntoAggregateNearestNeighbors(self, nbrs, neighbor_type=EmbeddingType.ENTITY):
+    def materializeConfidenceWeightedDeltas(self, src=None, trg=None, filter_set=None,
+            at_k=None, entity_keys=None, commit=True):
+        '''(Re)computes the ConfidenceWeightedDeltas table from
+        EntityOverlapAnalysis, InternalConfidence and EntityTerms, for all
+        analyses matching the given source/target/filter set/k/entity keys
+        (or all analyses, if none are given).
+        '''
+        if type(src) is EmbeddingSet:
+            src = src.ID
+        if type(trg) is EmbeddingSet:
+            trg = trg.ID
+
+        conditions, args = [], []
+        for (column, value) in [('Source', src), ('Target', trg), ('FilterSet', filter_set), ('AtK', at_k)]:
+            if not (value is None):
+                conditions.append('{0}=?'.format(column))
+                args.append(value)
+        if not (entity_keys is None):
+            self._cursor.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS MaterializeEntityKeys
+            (
+                EntityKey text PRIMARY KEY
+            )
+            ''')
+            self._cursor.execute('DELETE FROM MaterializeEntityKeys')
+            self._cursor.executemany(
+                'INSERT OR IGNORE INTO MaterializeEntityKeys VALUES (?)',
+                [(key,) for key in entity_keys]
+            )
+            conditions.append('EntityKey IN (SELECT EntityKey FROM MaterializeEntityKeys)')
+
+        self._cursor.execute(
+            '''
+            DELETE FROM ConfidenceWeightedDeltas
+            {0}
+            '''.format(
+                '' if len(conditions) == 0 else 'WHERE {0}'.format(' AND '.join(conditions))
+            ),
+            args
+        )
+        self._cursor.execute(
+            '''
+            INSERT OR REPLACE INTO ConfidenceWeightedDeltas
+            {0}
+            '''.format(_CWD_SELECT.format(''.join([
+                'AND eoa.{0} '.format(cond) for cond in conditions
+            ]))),
+            args
+        )
+
+        if commit:
+            self._connection.commit()
+
+    def insertOrUpdateIntoAggregateNearestNeighbors(self, nbrs, neighbor_type=EmbeddingType.ENTITY,
+            conflict_policy=ConflictPolicy.FAIL, max_reported_conflicts=10):
+        '''Bulk loads neighbors into AggregateNearestNeighbors, and links
+        them to their source/target pair in AggregateNearestNeighborSubsets.
+
+        Rows are staged in a temporary table and merged with set-based SQL.
+        A neighbor already stored with a different MeanDistance (beyond
+        floating point error) is a conflict, handled per conflict_policy:
+          skip :: keep the saved distance
+          overwrite :: replace it with the one provided
+          fail :: roll back the whole load and raise ValueError
+
+        As neighbors are stored once per source (the same neighbor may be
+        staged for several targets or filter sets), a neighbor already
+        stored with a different NeighborType cannot be saved; the load is
+        rolled back with ValueError.
+
+        Returns a summary dictionary with the number of staged rows, counts
+        of inserted, existing and conflicting neighbors (each counted once,
+        however many times it was staged), and (up to
+        max_reported_conflicts) examples of conflicts as (key, neighbor
+        key, source ID, saved distance, provided distance) tuples.
+        '''
         if (not type(nbrs) is list) and (not type(nbrs) is tuple):
             nbrs = [nbrs]
+        conflict_policy = ConflictPolicy.parse(conflict_policy)
 
         # first flush source and target embedding sets to the DB
         self._saveLinkedEmbeddingSets(nbrs, lambda n: n.source)
         self._saveLinkedEmbeddingSets(nbrs, lambda n: n.target)
-        
-        ## since each neighbor relationship may or may not need to be added to
-        ## the AggregateNearestNeighbors table as well as to
-        ## AggregateNearestNeighborSubsets, process rows one by one
-        for nbr in nbrs:
-            
-            ## (1) check if it's already in AggregateNearestNeighbors
-            query = '''
-            SELECT ID, MeanDistance FROM AggregateNearestNeighbors
-            WHERE
-                Source=?
-                AND EntityKey=?
-                AND NeighborKey=?
-                AND NeighborType=?
-            '''
-            args = [
-                nbr.source.ID,
-                nbr.key,
-                nbr.neighbor_key,
-                neighbor_type
-            ]
-            self._cursor.execute(query, args)
-
-            nbr_info = self._cursor.fetchone()
 
-            ## (2.1) if it isn't, add it to AggregateNearestNeighbors
-            if nbr_info is None:
-                row = (
+        ## (1) stage all of the rows in a temporary table
+        self._cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS StagedAggregateNearestNeighbors
+        (
+            Source int,
+            Target int,
+            FilterSet text,
+            EntityKey text,
+            NeighborKey text,
+            NeighborType int,
+            MeanDistance real
+        )
+        ''')
+        self._cursor.execute('DELETE FROM StagedAggregateNearestNeighbors')
+        self._cursor.executemany(
+            '''
+            INSERT INTO StagedAggregateNearestNeighbors VALUES (
+                ?, ?, ?, ?, ?, ?, ?
+            )
+            ''',
+            [
+                (
                     nbr.source.ID,
+                    nbr.target.ID,
+                    nbr.filter_set,
                     nbr.key,
                     nbr.neighbor_key,
                     neighbor_type,
                     nbr.mean_distance
                 )
-                self._cursor.execute(
-                    '''
-                    INSERT INTO
-                        AggregateNearestNeighbors
-                        (
-                            Source, EntityKey, NeighborKey, NeighborType, MeanDistance
-                        )
-                    VALUES (
-                        ?, ?, ?, ?, ?
-                    )
-                    ''',
-                    row
-                )
-
-                # pull the ID of the new row
-                nbr_ID = self._cursor.lastrowid
+                    for nbr in nbrs
+            ]
+        )
 
-            ## (2.2) if it is, just make sure the distance is the same, as a sanity check
-            else:
-                (nbr_ID, mean_dist) = nbr_info
-                # fuzzy equality check to account for floating point errors
-                if not math.isclose(mean_dist, nbr.mean_distance, abs_tol=0.001):
-                    print('[WARNING] Conflict in record for {0} <-> {1} in {2}'.format(nbr.key, nbr.neighbor_key, nbr.source))
-                    print('  Saved distance: {0}'.format(mean_dist))
-                    print('  Distance provided: {0}'.format(nbr.mean_distance))
-                    yn, acceptable = '', set(['y', 'n'])
-                    while not yn.strip().lower() in acceptable:
-                        yn = input('Proceed? [y/n] ')
-                    if yn.strip().lower() == 'n':
-                        print('Rolling back and aborting.')
-                        self._connection.rollback()
-                        exit(1)
-
-            ## (3) finally, add the source/target relationship to
-            ##     AggregateNearestNeighborSubsets
-            row = (
-                nbr.source.ID,
-                nbr.target.ID,
-                nbr.filter_set,
-                nbr_ID
+        ## (2) find neighbors that are already saved, and the ones among them
+        ##     with a different distance (fuzzy check to account for floating
+        ##     point errors); saved rows are unique per key, so count them by
+        ##     ID in case the same neighbor was staged more than once
+        self._cursor.execute('''
+        SELECT
+            COUNT(DISTINCT CASE
+                WHEN ann.NeighborType = s.NeighborType THEN ann.ID
+            END),
+            COUNT(DISTINCT CASE
+                WHEN ann.NeighborType = s.NeighborType
+                    AND ABS(ann.MeanDistance - s.MeanDistance) > 0.001
+                THEN ann.ID
+            END),
+            COUNT(DISTINCT CASE
+                WHEN ann.NeighborType <> s.NeighborType THEN ann.ID
+            END)
+        FROM
+            StagedAggregateNearestNeighbors AS s
+            INNER JOIN AggregateNearestNeighbors AS ann
+                ON ann.Source = s.Source
+                AND ann.EntityKey = s.EntityKey
+                AND ann.NeighborKey = s.NeighborKey
+        ''')
+        (num_existing, num_conflicts, num_type_mismatches) = self._cursor.fetchone()
+        if num_type_mismatches > 0:
+            self._connection.rollback()
+            raise ValueError(
+                '{0:,} neighbor records are already saved with a different'
+                ' neighbor type than {1}; rolled back'.format(
+                    num_type_mismatches, neighbor_type
+                )
             )
-            self._cursor.execute(
-                '''
-                REPLACE INTO AggregateNearestNeighborSubsets VALUES (
-                    ?, ?, ?, ?
+        self._cursor.execute('''
+        SELECT COUNT(*) FROM (
+            SELECT DISTINCT Source, EntityKey, NeighborKey
+            FROM StagedAggregateNearestNeighbors
+        )
+        ''')
+        num_staged_neighbors = self._cursor.fetchone()[0]
+        self._cursor.execute(
+            '''
+            SELECT DISTINCT
+                s.EntityKey,
+                s.NeighborKey,
+                s.Source,
+                ann.MeanDistance,
+                s.MeanDistance
+            FROM
+                StagedAggregateNearestNeighbors AS s
+                INNER JOIN AggregateNearestNeighbors AS ann
+                    ON ann.Source = s.Source
+                    AND ann.EntityKey = s.EntityKey
+                    AND ann.NeighborKey = s.NeighborKey
+                    AND ann.NeighborType = s.NeighborType
+            WHERE
+                ABS(ann.MeanDistance - s.MeanDistance) > 0.001
+            LIMIT ?
+            ''',
+            (max_reported_conflicts,)
+        )
+        summary = {
+            'staged': len(nbrs),
+            'inserted': num_staged_neighbors - num_existing,
+            'existing': num_existing,
+            'conflicts': num_conflicts,
+            'conflict_policy': conflict_policy,
+            'conflict_examples': self._cursor.fetchall()
+        }
+
+        if num_conflicts > 0 and conflict_policy == ConflictPolicy.FAIL:
+            self._connection.rollback()
+            raise ValueError(
+                '{0:,} neighbor records conflict with saved distances'
+                ' (e.g., {1}); rolled back'.format(
+                    num_conflicts, summary['conflict_examples'][0]
                 )
-                ''',
-                row
             )
 
+        ## (3) merge into AggregateNearestNeighbors
+        if conflict_policy == ConflictPolicy.OVERWRITE:
+            on_conflict = '''
+            DO UPDATE SET
+                NeighborType = excluded.NeighborType,
+                MeanDistance = excluded.MeanDistance
+            WHERE
+                ABS(MeanDistance - excluded.MeanDistance) > 0.001
+            '''
+        else:
+            on_conflict = 'DO NOTHING'
+        self._cursor.execute('''
+        INSERT INTO
+            AggregateNearestNeighbors
+            (
+                Source, EntityKey, NeighborKey, NeighborType, MeanDistance
+            )
+        SELECT
+            Source, EntityKey, NeighborKey, NeighborType, MeanDistance
+        FROM
+            StagedAggregateNearestNeighbors
+        WHERE
+            true
+        ON CONFLICT (Source, EntityKey, NeighborKey)
+        {0}
+        '''.format(on_conflict))
+
+        ## (4) finally, add the source/target relationships to
+        ##     AggregateNearestNeighborSubsets
+        self._cursor.execute('''
+        REPLACE INTO AggregateNearestNeighborSubsets
+        SELECT
+            s.Source,
+            s.Target,
+            s.FilterSet,
+            ann.ID
+        FROM
+            StagedAggregateNearestNeighbors AS s
+            INNER JOIN AggregateNearestNeighbors AS ann
+                ON ann.Source = s.Source
+                AND ann.EntityKey = s.EntityKey
+                AND ann.NeighborKey = s.NeighborKey
+                AND ann.NeighborType = s.NeighborType
+        ''')
+
+        self._cursor.execute('DELETE FROM StagedAggregateNearestNeighbors')
+        self._bumpDataVersion()
         self._connection.commit()
 
+        return summary
+
     def insertOrUpdateIntoEntityTerms(self, ent_terms):
         if (not type(ent_terms) is list) and (not type(ent_terms) is tuple):
             ent_terms = [ent_terms]
@@ -534,15 +999,37 @@ class EmbeddingNeighborhoodDatabase:
                 for et in ent_terms
         ]
 
+        # (upsert rather than replace, so that existing rows keep their rowid
+        # in the EntityTermsSearch index)
+        self._cursor.execute('SELECT COALESCE(MAX(rowid), 0) FROM EntityTerms')
+        (last_rowid,) = self._cursor.fetchone()
         self._cursor.executemany(
             '''
-            REPLACE INTO EntityTerms VALUES (
+            INSERT INTO EntityTerms VALUES (
                 ?, ?, ?
             )
+            ON CONFLICT (EntityKey, Term) DO UPDATE SET
+                Preferred = excluded.Preferred
             ''',
             rows
         )
 
+        # index any new terms for search
+        self._cursor.execute(
+            '''
+            INSERT INTO EntityTermsSearch (rowid, EntityKey, Term)
+            SELECT rowid, EntityKey, Term FROM EntityTerms WHERE rowid > ?
+            ''',
+            (last_rowid,)
+        )
+
+        # preferred terms are included in the materialized CWDs
+        self.materializeConfidenceWeightedDeltas(
+            entity_keys=set([row[0] for row in rows]),
+            commit=False
+        )
+
+        self._bumpDataVersion()
         self._connection.commit()
 
     def insertOrUpdateIntoEntityDefinitions(self, ent_defns):
@@ -566,6 +1053,7 @@ class EmbeddingNeighborhoodDatabase:
             rows
         )
 
+        self._bumpDataVersion()
         self._connection.commit()
 
     def insertOrUpdateIntoAggregatePairwiseSimilarity(self, sims):
@@ -597,6 +1085,46 @@ class EmbeddingNeighborhoodDatabase:
 
         self._connection.commit()
 
+    def insertOrUpdateIntoEntityInfoCards(self, cards):
+        if (not type(cards) is list) and (not type(cards) is tuple):
+            cards = [cards]
+
+        rows = [
+            (
+                c.entity_key,
+                c.neighbor_type,
+                c.num_neighbors,
+                c.data_version,
+                c.card
+            )
+                for c in cards
+        ]
+
+        self._cursor.executemany(
+            '''
+            REPLACE INTO EntityInfoCards VALUES (
+                ?, ?, ?, ?, ?
+            )
+            ''',
+            rows
+        )
+
+        self._connection.commit()
+
+    def deleteStaleEntityInfoCards(self):
+        '''Removes cards built from an older version of the analysis data.
+        Returns the number of cards removed.
+        '''
+        self._cursor.execute(
+            '''
+            DELETE FROM EntityInfoCards
+            WHERE DataVersion <> (SELECT Version FROM DataVersion)
+            '''
+        )
+        num_deleted = self._cursor.rowcount
+        self._connection.commit()
+        return num_deleted
+
 
     def getOrCreateEmbeddingSetGroup(self, short_name):
         groups = list(self.selectFromEmbeddingSetGroups(short_name=short_name))
@@ -680,6 +1208,21 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
+    def _embeddingSetsByID(self, embedding_set_IDs, known=None):
+        '''Returns a map from ID to EmbeddingSet for embedding_set_IDs,
+        re-using any EmbeddingSet objects in known and querying for the rest.
+        '''
+        embedding_sets_by_ID = {
+            e_set.ID: e_set
+                for e_set in (known or [])
+                if type(e_set) is EmbeddingSet
+        }
+        missing = set(embedding_set_IDs) - set(embedding_sets_by_ID.keys())
+        if len(missing) > 0:
+            for e_set in self.selectFromEmbeddingSets(ids=missing):
+                embedding_sets_by_ID[e_set.ID] = e_set
+        return embedding_sets_by_ID
+
     def selectFromEmbeddingSets(self, ids=None, group_ID=None, name=None):
         if ids:
             try:
@@ -755,39 +1298,23 @@ class EmbeddingNeighborhoodDatabase:
 
         base_query = '''
         SELECT
-            eoa.*,
-            ic_src.Confidence AS SourceInternalConfidence,
-            ic_trg.Confidence AS TargetInternalConfidence,
-            (
-                ic_src.Confidence
-                * ic_trg.Confidence
-                * (1 - eoa.ENSimilarity)
-            ) AS ConfidenceWeightedDelta,
-            et.Term
+            Source,
+            Target,
+            FilterSet,
+            AtK,
+            EntityKey,
+            ENSimilarity,
+            SourceInternalConfidence,
+            TargetInternalConfidence,
+            ConfidenceWeightedDelta,
+            Term
         FROM
-            EntityOverlapAnalysis AS eoa
-        INNER JOIN
-            EntityTerms AS et
-        ON
-            et.EntityKey = eoa.EntityKey
-        INNER JOIN
-            InternalConfidence AS ic_src
-        ON
-            ic_src.EntityKey = eoa.EntityKey
-            AND ic_src.AtK = eoa.AtK
-            AND ic_src.Source = eoa.Source
-        INNER JOIN
-            InternalConfidence AS ic_trg
-        ON
-            ic_trg.EntityKey = eoa.EntityKey
-            AND ic_trg.AtK = eoa.AtK
-            AND ic_trg.Source = eoa.Target
+            ConfidenceWeightedDeltas
         WHERE
-            eoa.Source=?
-            AND eoa.Target=?
-            AND eoa.FilterSet=?
-            AND eoa.AtK=?
-            AND et.Preferred=1
+            Source=?
+            AND Target=?
+            AND FilterSet=?
+            AND AtK=?
             {0}
         ORDER BY {1}
         LIMIT {2}
@@ -801,19 +1328,19 @@ class EmbeddingNeighborhoodDatabase:
         ]
 
         if not (source_confidence_threshold is None):
-            src_conf_cond = 'AND ic_src.Confidence >= ?'
+            src_conf_cond = 'AND SourceInternalConfidence >= ?'
             args.append(source_confidence_threshold)
         else:
             src_conf_cond = ''
 
         if not (target_confidence_threshold is None):
-            trg_conf_cond = 'AND ic_trg.Confidence >= ?'
+            trg_conf_cond = 'AND TargetInternalConfidence >= ?'
             args.append(target_confidence_threshold)
         else:
             trg_conf_cond = ''
 
         if not (entity_key is None):
-            entity_key_cond = 'AND eoa.EntityKey = ?'
+            entity_key_cond = 'AND EntityKey = ?'
             args.append(entity_key)
         else:
             entity_key_cond = ''
@@ -868,8 +1395,14 @@ class EmbeddingNeighborhoodDatabase:
 
 
     def selectFromInternalConfidence(self, src=None, at_k=None, key=None):
-        if type(src) is EmbeddingSet:
-            src = src.ID
+        # src may be a single source or a list of them (fetched in one query)
+        if type(src) in (list, tuple, set):
+            sources = list(src)
+            src = [s.ID if type(s) is EmbeddingSet else s for s in sources]
+        else:
+            sources = [src]
+            if type(src) is EmbeddingSet:
+                src = src.ID
 
         query = '''
         SELECT
@@ -880,7 +1413,12 @@ class EmbeddingNeighborhoodDatabase:
         '''
 
         where_conds, args = [], []
-        if not (src is None):
+        if type(src) is list:
+            where_conds.append('Source IN ({0})'.format(
+                ','.join(['?' for _ in src])
+            ))
+            args.extend(src)
+        elif not (src is None):
             where_conds.append('Source=?')
             args.append(src)
         if not (at_k is None):
@@ -903,11 +1441,10 @@ class EmbeddingNeighborhoodDatabase:
         raw_rows = list(self._cursor)
 
         if len(raw_rows) > 0:
-            embedding_set_IDs = set([
-                row[0] for row in raw_rows
-            ])
-            embedding_sets = self.selectFromEmbeddingSets(ids=embedding_set_IDs)
-            embedding_sets_by_ID = { e_set.ID: e_set for e_set in embedding_sets }
+            embedding_sets_by_ID = self._embeddingSetsByID(
+                [row[0] for row in raw_rows],
+                known=sources
+            )
 
             for row in raw_rows:
                 (
@@ -1010,6 +1547,128 @@ class EmbeddingNeighborhoodDatabase:
                 )
                 yield ret_obj
 
+    def selectFromAggregateNearestNeighborsBySubset(self, subsets, key,
+            neighbor_type=EmbeddingType.ENTITY, limit=10):
+        '''Batched version of selectFromAggregateNearestNeighbors: gets the
+        top limit neighbors of key for each (source, target, filter set)
+        triple in subsets, in a single query.
+
+        Yields AggregateNearestNeighbor objects ordered by subset (in the
+        order given) and then by distance.
+        '''
+        subsets = list(subsets)
+        if len(subsets) == 0:
+            return
+
+        requested, args, known = [], [], []
+        for (i, (src, trg, filter_set)) in enumerate(subsets):
+            known.extend([src, trg])
+            if type(src) is EmbeddingSet:
+                src = src.ID
+            if type(trg) is EmbeddingSet:
+                trg = trg.ID
+            requested.append('(?, ?, ?, ?)')
+            args.extend([i, src, trg, filter_set])
+
+        ## rank neighbors within each requested subset, then keep the top
+        ## limit of each and attach their preferred terms
+        query = '''
+        WITH
+            Requested(Ordering, Source, Target, FilterSet) AS (
+                VALUES {0}
+            ),
+            RankedNeighbors AS (
+                SELECT
+                    req.Ordering,
+                    ann.Source,
+                    anns.Target,
+                    anns.FilterSet,
+                    ann.EntityKey,
+                    ann.NeighborKey,
+                    ann.MeanDistance,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY req.Ordering
+                        ORDER BY ann.MeanDistance ASC
+                    ) AS NeighborRank
+                FROM
+                    Requested AS req
+                    INNER JOIN
+                        AggregateNearestNeighbors AS ann
+                        ON
+                            ann.Source = req.Source
+                    INNER JOIN
+                        AggregateNearestNeighborSubsets AS anns
+                        ON
+                            anns.NeighborID = ann.ID
+                            AND anns.Target = req.Target
+                            AND anns.FilterSet = req.FilterSet
+                WHERE
+                    ann.EntityKey=?
+                    AND ann.NeighborType=?
+            )
+        SELECT
+            rn.Source,
+            rn.Target,
+            rn.FilterSet,
+            rn.EntityKey,
+            rn.NeighborKey,
+            rn.MeanDistance,
+            et_query.Term as QueryTerm,
+            et_nbr.Term as NeighborTerm
+        FROM
+            RankedNeighbors AS rn
+            LEFT OUTER JOIN
+                EntityTerms AS et_query
+                ON
+                    et_query.EntityKey = rn.EntityKey
+                    AND et_query.Preferred = 1
+            LEFT OUTER JOIN
+                EntityTerms AS et_nbr
+                ON
+                    et_nbr.EntityKey = rn.NeighborKey
+                    AND et_nbr.Preferred = 1
+        WHERE
+            rn.NeighborRank <= ?
+        ORDER BY rn.Ordering, rn.NeighborRank
+        '''.format(', '.join(requested))
+
+        args.extend([key, neighbor_type, limit])
+
+        self._cursor.execute(query, args)
+        raw_rows = list(self._cursor)
+
+        if len(raw_rows) > 0:
+            embedding_set_IDs = []
+            for row in raw_rows:
+                embedding_set_IDs.extend([row[0], row[1]])
+            embedding_sets_by_ID = self._embeddingSetsByID(
+                embedding_set_IDs,
+                known=known
+            )
+
+            for row in raw_rows:
+                (
+                    source_ID,
+                    target_ID,
+                    filter_set,
+                    entity_key,
+                    neighbor_key,
+                    mean_distance,
+                    query_term,
+                    neighbor_term
+                ) = row
+                ret_obj = AggregateNearestNeighbor(
+                    source=embedding_sets_by_ID[source_ID],
+                    target=embedding_sets_by_ID[target_ID],
+                    filter_set=filter_set,
+                    key=entity_key,
+                    string=query_term,
+                    neighbor_key=neighbor_key,
+                    neighbor_string=neighbor_term,
+                    mean_distance=mean_distance
+                )
+                yield ret_obj
+
     def selectAllIDsFromAggregateNearestNeighbors(self, src, trg, filter_set,
             neighbor_type=EmbeddingType.ENTITY):
         """Selects all neighbor sets for the given source and target corpus.
@@ -1131,7 +1790,7 @@ class EmbeddingNeighborhoodDatabase:
 
     def selectAllPreferredEntityNamesWithNeighbors(self):
         query = '''
-        SELECT
+        SELECT DISTINCT
             ann.EntityKey as EntityKey,
             et_query.Term as EntityName
         FROM
@@ -1157,6 +1816,36 @@ class EmbeddingNeighborhoodDatabase:
             )
             yield ret_obj
 
+    def selectAllEntityTermsWithNeighbors(self):
+        """Selects all terms (preferred and otherwise) for entities that have
+        nearest neighbors."""
+        query = '''
+        SELECT
+            et.EntityKey,
+            et.Term,
+            et.Preferred
+        FROM
+            EntityTerms AS et
+        WHERE
+            et.EntityKey IN (
+                SELECT EntityKey FROM AggregateNearestNeighbors
+            )
+        '''
+
+        self._cursor.execute(query)
+        for row in self._cursor:
+            (
+                entity_key,
+                term,
+                preferred
+            ) = row
+            ret_obj = EntityTerm(
+                entity_key=entity_key,
+                term=term,
+                preferred=preferred
+            )
+            yield ret_obj
+
     def selectFromEntityDefinitions(self, key):
         query = '''
         SELECT
@@ -1182,18 +1871,33 @@ class EmbeddingNeighborhoodDatabase:
             yield ret_obj
 
 
-    def searchInEntityTerms(self, query_string):
+    def searchInEntityTerms(self, query_string, limit=50, offset=0):
+        '''Full-text search over entity keys and terms, matching every word
+        in query_string as a prefix.  Results are ranked by BM25 and
+        returned a page (of at most limit rows) at a time.
+        '''
+        fts_query = _ftsPrefixQuery(query_string)
+        if len(fts_query) == 0:
+            return
+
         query = '''
         SELECT
-            *
+            et.EntityKey,
+            et.Term,
+            et.Preferred
         FROM
-            EntityTerms
+            EntityTermsSearch AS ets
+            INNER JOIN
+                EntityTerms AS et
+                ON
+                    et.rowid = ets.rowid
         WHERE
-            EntityKey LIKE ?
-            OR Term LIKE ?
+            EntityTermsSearch MATCH ?
+        ORDER BY bm25(EntityTermsSearch)
+        LIMIT ? OFFSET ?
         '''
 
-        args = [query_string, query_string]
+        args = [fts_query, limit, offset]
 
         self._cursor.execute(query, args)
         for row in self._cursor:
@@ -1263,6 +1967,102 @@ class EmbeddingNeighborhoodDatabase:
                 )
                 yield ret_obj
 
+    def selectFromAggregatePairwiseSimilarityForPairs(self, pairs):
+        '''Batched version of selectFromAggregatePairwiseSimilarity: gets all
+        saved similarities for any of the (query key, target) pairs given, in
+        either order (as similarity is symmetric).
+        '''
+        ## pass the pairs in as a single JSON array parameter (rather than
+        ## through a temporary table), so that this is a pure read; and match
+        ## them in either order (as two joins, so that both can use the
+        ## AggregatePairwiseSimilarity key index)
+        self._cursor.execute(
+            '''
+            WITH RequestedPairs (EntityKey, NeighborKey) AS (
+                SELECT DISTINCT
+                    json_extract(value, '$[0]'),
+                    json_extract(value, '$[1]')
+                FROM
+                    json_each(?)
+            )
+            SELECT
+                aps.*
+            FROM
+                RequestedPairs AS rp
+                INNER JOIN
+                    AggregatePairwiseSimilarity AS aps
+                    ON
+                        aps.EntityKey = rp.EntityKey
+                        AND aps.NeighborKey = rp.NeighborKey
+            UNION
+            SELECT
+                aps.*
+            FROM
+                RequestedPairs AS rp
+                INNER JOIN
+                    AggregatePairwiseSimilarity AS aps
+                    ON
+                        aps.EntityKey = rp.NeighborKey
+                        AND aps.NeighborKey = rp.EntityKey
+            ''',
+            (json.dumps([[query_key, target] for (query_key, target) in pairs]),)
+        )
+        raw_rows = list(self._cursor)
+
+        if len(raw_rows) > 0:
+            embedding_sets_by_ID = self._embeddingSetsByID(
+                [row[0] for row in raw_rows]
+            )
+
+            for row in raw_rows:
+                (
+                    source_ID,
+                    key,
+                    neighbor_key,
+                    mean_similarity,
+                    std_similarity
+                ) = row
+                ret_obj = AggregatePairwiseSimilarity(
+                    source=embedding_sets_by_ID[source_ID],
+                    key=key,
+                    neighbor_key=neighbor_key,
+                    mean_similarity=mean_similarity,
+                    std_similarity=std_similarity
+                )
+                yield ret_obj
+
+    def getEntityInfoCard(self, key, neighbor_type=EmbeddingType.ENTITY,
+            num_neighbors=None):
+        '''Returns the current (compressed) info card for key, or None if
+        there isn't one built from the current version of the data (and, if
+        given, with num_neighbors neighbors per table).
+        '''
+        query = '''
+        SELECT
+            c.Card
+        FROM
+            EntityInfoCards AS c
+            INNER JOIN
+                DataVersion AS v
+                ON
+                    v.Version = c.DataVersion
+        WHERE
+            c.EntityKey=?
+            AND c.NeighborType=?
+            {0}
+        '''
+
+        args = [key, neighbor_type]
+        if not (num_neighbors is None):
+            num_neighbors_cond = 'AND c.NumNeighbors=?'
+            args.append(num_neighbors)
+        else:
+            num_neighbors_cond = ''
+
+        self._cursor.execute(query.format(num_neighbors_cond), args)
+        row = self._cursor.fetchone()
+        return None if row is None else row[0]
+
     def getPairwiseSimilarityProgress(self, group, query_key, target):
         """Gets the current progress toward generating pairwise similarities for
         the given pair of entities, if it exists."""
@@ -1326,4 +2126,148 @@ class EmbeddingNeighborhoodDatabase:
         self._connection.commit()
         
         return PairwiseSimilarityProgress(group, query_key, target, running, progress, progress_message)
+
+    def resetRunningPairwiseSimilarityProgress(self, progress_message):
+        """Marks all pairwise similarity calculations recorded as running as
+        stopped; returns the number reset."""
+        self._cursor.execute(
+            '''
+            UPDATE PairwiseSimilarityProgress SET
+                Running = 0,
+                ProgressMessage = ?
+            WHERE
+                Running = 1
+            ''',
+            (progress_message,)
+        )
+        num_reset = self._cursor.rowcount
+        self._connection.commit()
+        return num_reset
     
+
+
+class DatabasePool:
+    '''Thread-safe pool of read-only EmbeddingNeighborhoodDatabase
+    connections to a single DB file, for reuse across requests.
+
+    The schema is brought up to date (through a regular connection) the
+    first time a connection is needed, or on an explicit call to
+    ensureSchema(); if the file can't be written and its schema is out of
+    date, RuntimeError is raised rather than serving queries against
+    missing tables.  Only set immutable if nothing will write to the DB
+    file while the pool is in use (SQLite then skips all locking and
+    change detection).
+    '''
+    def __init__(self, fpath, size=8, immutable=False, mmap_size=268435456,
+            cache_size=65536):
+        self._fpath = fpath
+        self._size = size
+        self._immutable = immutable
+        self._mmap_size = mmap_size
+        self._cache_size = cache_size
+
+        self._available = queue.LifoQueue()
+        self._num_connections = 0
+        self._lock = threading.Lock()
+        self._migrated = False
+
+    def _migrate(self):
+        try:
+            # (built separately from opening, so that the connection is
+            # closed even if building or migrating the schema fails)
+            db = EmbeddingNeighborhoodDatabase(self._fpath, build=False)
+            try:
+                db._build()
+                db._connection.commit()
+            finally:
+                db._connection.close()
+        except sqlite3.OperationalError:
+            # read-only file; check whether it's usable as it is
+            db = EmbeddingNeighborhoodDatabase(self._fpath, read_only=True)
+            try:
+                version = db.schemaVersion()
+            except sqlite3.OperationalError:
+                # predates schema versioning
+                version = 0
+            finally:
+                db._connection.close()
+            if version < LATEST_SCHEMA_VERSION:
+                raise RuntimeError(
+                    'Database {0} has schema version {1} (latest is {2}) and '
+                    'could not be upgraded, as it is not writable; upgrade it '
+                    'with "python -m nearest_neighbors.database {0}" from an '
+                    'account that can write to it'.format(
+                        self._fpath, version, LATEST_SCHEMA_VERSION
+                    )
+                )
+        self._migrated = True
+
+    def ensureSchema(self):
+        '''Brings the DB's schema up to date, if that hasn't already been
+        done; raises RuntimeError if it is out of date and can't be.
+        '''
+        with self._lock:
+            if not self._migrated:
+                self._migrate()
+
+    def _connect(self):
+        db = EmbeddingNeighborhoodDatabase(self._fpath, read_only=True,
+            immutable=self._immutable, check_same_thread=False)
+        # (PRAGMA values can't be bound as parameters)
+        db._cursor.execute('PRAGMA mmap_size = {0:d}'.format(self._mmap_size))
+        # negative cache_size is in KiB, rather than pages
+        db._cursor.execute('PRAGMA cache_size = -{0:d}'.format(self._cache_size))
+        db._cursor.execute('PRAGMA query_only = 1')
+        return db
+
+    def acquire(self):
+        '''Checks out a connection, opening a new one if none are free and
+        the pool isn't full (otherwise, waits for one to be released).
+        '''
+        self.ensureSchema()
+        with self._lock:
+            try:
+                return self._available.get_nowait()
+            except queue.Empty:
+                if self._num_connections < self._size:
+                    self._num_connections += 1
+                    return self._connect()
+        return self._available.get()
+
+    def release(self, db):
+        self._available.put(db)
+
+    @contextlib.contextmanager
+    def connection(self):
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def closeAll(self):
+        with self._lock:
+            while True:
+                try:
+                    db = self._available.get_nowait()
+                except queue.Empty:
+                    break
+                db._connection.close()
+                self._num_connections -= 1
+
+
+if __name__ == '__main__':
+    def _cli():
+        import optparse
+        parser = optparse.OptionParser(usage='Usage: %prog DB_FILE')
+        (options, args) = parser.parse_args()
+        if len(args) != 1:
+            parser.print_help()
+            parser.error('Must provide DB_FILE')
+        return args[0]
+
+    dbf = _cli()
+    # opening the DB applies any pending migrations
+    db = EmbeddingNeighborhoodDatabase(dbf)
+    print('Schema of {0} is at version {1}'.format(dbf, db.schemaVersion()))
+    db.close()
@@ -5,11 +5,15 @@ I/O methods for embedding sets, neighbor files, and node map files
 import os
 import glob
 import codecs
+import hashlib
+from collections.abc import Mapping
+import numpy as np
 import pyemblib
 
 class EmbeddingReplicates:
-    def __init__(self, source, file_pattern, embedding_format, lazy=True):
+    def __init__(self, source, file_pattern, embedding_format, lazy=True, cache_dir=None):
         self.source = source
+        self._cache_dir = cache_dir
 
         # detect number of replicates
         self._embedfs = glob.glob(file_pattern)
@@ -44,13 +48,253 @@ class EmbeddingReplicates:
         return len(self._embedfs)
 
     def _loadEmbeddingsFile(self, index):
-        embedf = self._embedfs[self._embedf_index]
-        embeds = pyemblib.read(embedf, mode=self._mode, errors='replace')
+        embedf = self._embedfs[index]
+        embeds = readEmbeddings(embedf, mode=self._mode, cache_dir=self._cache_dir)
         return embeds
 
     def hasKey(self, key):
         return key in self._keys
 
+class MappedEmbeddings(Mapping):
+    '''Read-only, dictionary-style view of embeddings stored as a
+    (memory-mapped) float32 matrix plus a key -> row index.
+
+    Supports the same lookups as pyemblib.Embeddings; use rows() to pull
+    the vectors for many keys at once.
+    '''
+    def __init__(self, keys, matrix):
+        self._index = {
+            key: i
+                for (i, key) in enumerate(keys)
+        }
+        self.matrix = matrix
+
+    def __getitem__(self, key):
+        return self.matrix[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def has(self, key):
+        return key in self._index
+
+    @property
+    def size(self):
+        return self.matrix.shape[1]
+    @property
+    def dimension(self):
+        return self.size
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def rows(self, keys):
+        '''Returns an in-memory array of the vectors for keys, in order.
+        '''
+        return self.matrix[[self._index[key] for key in keys]]
+
+def _embeddingCachePaths(f, mode, cache_dir):
+    f = os.path.abspath(f)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(f), '.embedding_cache')
+    path_hash = hashlib.sha1(f.encode('utf-8')).hexdigest()[:12]
+    prefix = os.path.join(cache_dir, '%s.%s' % (os.path.basename(f), path_hash))
+    stem = '%s.%s.%d' % (prefix, mode, os.stat(f).st_mtime_ns)
+    return prefix, '%s.npy' % stem, '%s.keys' % stem
+
+def _writeEmbeddingCache(embeds, prefix, matrixf, keysf):
+    keys = list(embeds.keys())
+    if any(['\n' in key for key in keys]):
+        return False
+    matrix = np.empty((len(keys), embeds.size), dtype=np.float32)
+    for i in range(len(keys)):
+        matrix[i] = embeds[keys[i]]
+
+    os.makedirs(os.path.dirname(matrixf), exist_ok=True)
+    # clear out caches of older versions of this file
+    for stale in glob.glob('%s.*' % glob.escape(prefix)):
+        os.remove(stale)
+    with codecs.open(keysf, 'w', 'utf-8') as stream:
+        for key in keys:
+            stream.write('%s\n' % key)
+    # write the matrix last (and atomically), as it marks the cache complete
+    tmpf = '%s.tmp' % matrixf
+    with open(tmpf, 'wb') as stream:
+        np.save(stream, matrix)
+    os.replace(tmpf, matrixf)
+    return True
+
+def _readEmbeddingCache(matrixf, keysf):
+    with open(keysf, 'r', encoding='utf-8', newline='\n') as stream:
+        keys = stream.read().split('\n')[:-1]
+    matrix = np.load(matrixf, mmap_mode='r')
+    return MappedEmbeddings(keys, matrix)
+
+def readEmbeddings(f, mode=pyemblib.Mode.Binary, errors='replace', cache_dir=None, use_cache=True):
+    '''Read a word2vec-format embedding file, via a float32 .npy + key index
+    cache keyed on the file's path and modification time.
+
+    The first read of a file parses it with pyemblib and writes the cache
+    (to cache_dir, by default .embedding_cache/ next to f); later reads
+    memory-map the cached matrix.  Returns a MappedEmbeddings, or, if the
+    cache could not be used, the pyemblib.Embeddings read from f.
+    '''
+    if not use_cache:
+        return pyemblib.read(f, mode=mode, errors=errors)
+
+    (prefix, matrixf, keysf) = _embeddingCachePaths(f, mode, cache_dir)
+    if os.path.isfile(matrixf) and os.path.isfile(keysf):
+        return _readEmbeddingCache(matrixf, keysf)
+
+    embeds = pyemblib.read(f, mode=mode, errors=errors)
+    try:
+        cached = _writeEmbeddingCache(embeds, prefix, matrixf, keysf)
+    except OSError:
+        cached = False
+    if cached:
+        return _readEmbeddingCache(matrixf, keysf)
+    else:
+        return embeds
+
+def embeddingArray(embeds, keys):
+    '''Returns the embedding matrix for keys (in order) from either a
+    MappedEmbeddings or a pyemblib.Embeddings object.
+    '''
+    if isinstance(embeds, MappedEmbeddings):
+        return embeds.rows(keys)
+    else:
+        return np.array([
+            embeds[k] for k in keys
+        ])
+
+def _sortedKeyIndexPaths(matrixf):
+    stem = matrixf[:-len('.npy')]
+    return '%s.sorted_keys.npy' % stem, '%s.sorted_rows.npy' % stem
+
+class _SortedKeyIndex:
+    '''Key lookups against a cached embedding matrix, using a sorted,
+    memory-mapped key array (so that lookups only touch O(log N) pages,
+    and the key set never has to be loaded into memory).
+    '''
+    def __init__(self, matrixf, keysf):
+        (sorted_keysf, sorted_rowsf) = _sortedKeyIndexPaths(matrixf)
+        if not (os.path.isfile(sorted_keysf) and os.path.isfile(sorted_rowsf)):
+            _writeSortedKeyIndex(keysf, sorted_keysf, sorted_rowsf)
+        self._keys = np.load(sorted_keysf, mmap_mode='r')
+        self._rows = np.load(sorted_rowsf, mmap_mode='r')
+        self.matrix = np.load(matrixf, mmap_mode='r')
+
+    def get(self, key):
+        i = int(np.searchsorted(self._keys, key))
+        if i < len(self._keys) and self._keys[i] == key:
+            return self.matrix[self._rows[i]]
+        return None
+
+    def getMany(self, keys):
+        '''Returns an in-memory (len(keys) x dimension) array of the vectors
+        for keys, and a boolean mask of which keys were found (rows for
+        missing keys are zeros).
+        '''
+        keys = np.array(keys, dtype=str)
+        if len(self._keys) == 0 or len(keys) == 0:
+            return np.zeros((len(keys), self.matrix.shape[1]), dtype=self.matrix.dtype), np.zeros(len(keys), dtype=bool)
+        ixes = np.minimum(np.searchsorted(self._keys, keys), len(self._keys)-1)
+        found = (self._keys[ixes] == keys)
+        vectors = np.array(self.matrix[self._rows[ixes]])
+        vectors[~found] = 0
+        return vectors, found
+
+def _writeSortedKeyIndex(keysf, sorted_keysf, sorted_rowsf):
+    with open(keysf, 'r', encoding='utf-8', newline='\n') as stream:
+        keys = np.array(stream.read().split('\n')[:-1], dtype=str)
+    order = np.argsort(keys, kind='stable')
+    for (f, array) in [(sorted_keysf, keys[order]), (sorted_rowsf, order.astype(np.int64))]:
+        tmpf = '%s.tmp' % f
+        with open(tmpf, 'wb') as stream:
+            np.save(stream, array)
+        os.replace(tmpf, f)
+
+class EmbeddingVectorStore:
+    '''Point-lookup store over a set of embedding replicates, for reading
+    a handful of vectors without parsing every replicate file.
+
+    Built on the embedding cache (see readEmbeddings), plus a sorted key
+    index for each replicate; both persist across runs.  Looking up a key
+    touches O(replicates) matrix rows.
+    '''
+    def __init__(self, source, file_pattern, embedding_format, cache_dir=None):
+        self.source = source
+        self._embedfs = sorted(glob.glob(file_pattern))
+        self._replicates = []
+        for embedf in self._embedfs:
+            (_, matrixf, keysf) = _embeddingCachePaths(embedf, embedding_format, cache_dir)
+            if not (os.path.isfile(matrixf) and os.path.isfile(keysf)):
+                embeds = readEmbeddings(embedf, mode=embedding_format, cache_dir=cache_dir)
+                if not isinstance(embeds, MappedEmbeddings):
+                    # cache could not be written; fall back to in-memory lookups
+                    self._replicates.append(embeds)
+                    continue
+            self._replicates.append(_SortedKeyIndex(matrixf, keysf))
+
+    @staticmethod
+    def isCached(file_pattern, embedding_format, cache_dir=None):
+        '''Returns True if all replicates matching file_pattern have been
+        cached (i.e., a store can be opened without parsing any files).
+        '''
+        embedfs = glob.glob(file_pattern)
+        for embedf in embedfs:
+            (_, matrixf, keysf) = _embeddingCachePaths(embedf, embedding_format, cache_dir)
+            if not (os.path.isfile(matrixf) and os.path.isfile(keysf)):
+                return False
+        return len(embedfs) > 0
+
+    def __len__(self):
+        return len(self._replicates)
+
+    def hasKey(self, key):
+        for replicate in self._replicates:
+            if replicate.get(key) is None:
+                return False
+        return True
+
+    def vectors(self, key):
+        '''Returns a (replicates x dimension) array of the vectors for key.
+        '''
+        vectors = []
+        for replicate in self._replicates:
+            vector = replicate.get(key)
+            if vector is None:
+                raise KeyError(key)
+            vectors.append(vector)
+        return np.array(vectors)
+
+    def vectorsForKeys(self, keys):
+        '''Returns a (replicates x len(keys) x dimension) array of the vectors
+        for keys, and a boolean mask of which keys are present in every
+        replicate (vectors for missing keys are zeros).
+        '''
+        all_vectors, all_found = [], np.ones(len(keys), dtype=bool)
+        for replicate in self._replicates:
+            if isinstance(replicate, _SortedKeyIndex):
+                (vectors, found) = replicate.getMany(keys)
+            else:
+                # in-memory replicate (cache couldn't be written)
+                found = np.array([key in replicate for key in keys], dtype=bool)
+                dimension = len(next(iter(replicate.values())))
+                vectors = np.array([
+                    replicate[key] if found[i] else np.zeros(dimension)
+                        for (i, key) in enumerate(keys)
+                ], dtype=np.float32).reshape((len(keys), dimension))
+            all_vectors.append(vectors)
+            all_found &= found
+        return np.array(all_vectors), all_found
+
 def writeNodeMap(emb, f):
     ordered = tuple([
         k.strip()
@@ -104,6 +348,40 @@ def writeNeighborFileLine(stream, node_ID, neighbors, with_distances=False):
         ]
     ]))
 
+def writeNeighborFileLines(stream, node_IDs, neighbors, distances=None, neighbor_counts=None):
+    '''Batched version of writeNeighborFileLine: writes one line for each
+    node in node_IDs, with neighbors given as a (batch size x k) matrix of
+    neighbor IDs (and, if writing distances, a matching distances matrix).
+
+    If neighbor_counts is given, only the first neighbor_counts[i] neighbors
+    are written for row i (e.g., for padded rows).
+    '''
+    num_neighbors = len(neighbors[0]) if len(neighbors) > 0 else 0
+    if distances is None:
+        cells = np.empty((len(node_IDs), 1 + num_neighbors), dtype=object)
+        cells[:, 0] = node_IDs
+        cells[:, 1:] = neighbors
+        cell_format, cells_per_neighbor = '%s', 1
+    else:
+        cells = np.empty((len(node_IDs), 1 + 2*num_neighbors), dtype=object)
+        cells[:, 0] = node_IDs
+        cells[:, 1::2] = neighbors
+        cells[:, 2::2] = distances
+        cell_format, cells_per_neighbor = '%s||%.6f', 2
+
+    # format each line with a single template application
+    templates, lines = {}, []
+    for (i, row) in enumerate(cells.tolist()):
+        row_neighbors = num_neighbors if neighbor_counts is None else neighbor_counts[i]
+        if not row_neighbors in templates:
+            templates[row_neighbors] = '%s\n' % ','.join(
+                ['%s'] + [cell_format for _ in range(row_neighbors)]
+            )
+        lines.append(templates[row_neighbors] % tuple(
+            row[:1 + cells_per_neighbor*row_neighbors]
+        ))
+    stream.write(''.join(lines))
+
 def readNeighborFile(f, k=None, node_map=None, with_distances=False, query_node_map=None):
     '''Read a neighbor file into a dictionary mapping
     { node: [neighbor list] }
@@ -147,6 +425,170 @@ def readNeighborFile(f, k=None, node_map=None, with_distances=False, query_node_
                 neighbors[node_ID] = neighbor_info
     return neighbors
 
+class NeighborFileFormat:
+    TEXT = 'text'
+    BINARY = 'binary'
+    BOTH = 'both'
+
+    @staticmethod
+    def choices():
+        return [NeighborFileFormat.TEXT, NeighborFileFormat.BINARY, NeighborFileFormat.BOTH]
+
+def binaryNeighborFilePath(f):
+    '''Path of the binary neighbor file stored alongside text neighbor file f.
+    '''
+    return '%s.npz' % f
+
+def visualizationManifestPath(f):
+    '''Path of the frame manifest stored alongside visualization file f.
+    '''
+    return '%s.manifest.json' % os.path.splitext(f)[0]
+
+def visualizationFramePath(f, i):
+    '''Path of the i'th per-frame file stored alongside visualization file f.
+    '''
+    return '%s.frame-%d.json' % (os.path.splitext(f)[0], i)
+
+def _nodeMapArrays(node_map):
+    node_IDs = np.array(list(node_map.keys()), dtype=np.int64)
+    node_keys = np.array([node_map[node_ID] for node_ID in node_IDs], dtype=str)
+    return node_IDs, node_keys
+
+def _nodeMapFromArrays(node_IDs, node_keys):
+    return {
+        int(node_ID): str(key)
+            for (node_ID, key) in zip(node_IDs, node_keys)
+    }
+
+def writeBinaryNeighborFile(f, query_IDs, neighbors, distances=None,
+        node_map=None, query_node_map=None, append=False):
+    '''Write neighbors in binary columnar format (NumPy .npz), with:
+      query_IDs :: node IDs of the queries, one per row
+      neighbors :: int32 (queries x k) matrix of neighbor node IDs,
+                   with rows padded at the end with -1 if needed
+      distances :: (optional) float32 matrix of distances to neighbors
+    along with the node ID <-> key map for neighbors (and queries, if
+    different), if provided.
+
+    If append is True and f already exists, its rows (and node maps) are
+    kept, and the new ones added after them.
+    '''
+    query_IDs = np.asarray(query_IDs, dtype=np.int64)
+    neighbors = np.asarray(neighbors, dtype=np.int32)
+    if not (distances is None):
+        distances = np.asarray(distances, dtype=np.float32)
+    node_map = dict(node_map) if node_map else {}
+    query_node_map = dict(query_node_map) if query_node_map else {}
+
+    if append and os.path.isfile(f):
+        existing = readBinaryNeighborArrays(f)
+        # pad to a common number of neighbors
+        width = max(existing['neighbors'].shape[1], neighbors.shape[1])
+        padded_neighbors, padded_distances = [], []
+        for (nbrs, dists) in [
+                    (existing['neighbors'], existing.get('distances', None)),
+                    (neighbors, distances)
+                ]:
+            padding = width - nbrs.shape[1]
+            padded_neighbors.append(np.pad(nbrs, ((0,0), (0,padding)), constant_values=-1))
+            if not (dists is None):
+                padded_distances.append(np.pad(dists, ((0,0), (0,padding)), constant_values=np.nan))
+        query_IDs = np.concatenate([existing['query_IDs'], query_IDs])
+        neighbors = np.concatenate(padded_neighbors)
+        if len(padded_distances) == 2:
+            distances = np.concatenate(padded_distances)
+        else:
+            distances = None
+        for (existing_map, new_map) in [
+                    (existing.get('node_map', {}), node_map),
+                    (existing.get('query_node_map', {}), query_node_map)
+                ]:
+            for (k,v) in existing_map.items():
+                new_map.setdefault(k, v)
+
+    arrays = {
+        'query_IDs': query_IDs,
+        'neighbors': neighbors
+    }
+    if not (distances is None):
+        arrays['distances'] = distances
+    if node_map:
+        (arrays['node_map_IDs'], arrays['node_map_keys']) = _nodeMapArrays(node_map)
+    if query_node_map:
+        (arrays['query_node_map_IDs'], arrays['query_node_map_keys']) = _nodeMapArrays(query_node_map)
+
+    with open(f, 'wb') as stream:
+        np.savez(stream, **arrays)
+
+def readBinaryNeighborArrays(f):
+    '''Read the raw contents of a binary neighbor file as a dictionary with
+    query_IDs, neighbors, and (if present) distances, node_map and
+    query_node_map.
+    '''
+    contents = {}
+    with np.load(f, allow_pickle=False) as data:
+        contents['query_IDs'] = data['query_IDs']
+        contents['neighbors'] = data['neighbors']
+        if 'distances' in data:
+            contents['distances'] = data['distances']
+        if 'node_map_IDs' in data:
+            contents['node_map'] = _nodeMapFromArrays(data['node_map_IDs'], data['node_map_keys'])
+        if 'query_node_map_IDs' in data:
+            contents['query_node_map'] = _nodeMapFromArrays(data['query_node_map_IDs'], data['query_node_map_keys'])
+    return contents
+
+def readBinaryNeighborFile(f, k=None, node_map=None, with_distances=False, query_node_map=None):
+    '''Binary-format equivalent of readNeighborFile, returning
+    { node: [neighbor list] }
+
+    As for readNeighborFile, node IDs are only mapped to labels through the
+    node_map/query_node_map supplied (the maps stored in the file when it
+    was written can be read with readBinaryNeighborArrays).
+    '''
+    contents = readBinaryNeighborArrays(f)
+
+    neighbor_IDs = contents['neighbors']
+    distances = contents.get('distances', None)
+    if with_distances and distances is None:
+        raise ValueError('Binary neighbor file %s does not contain distances' % f)
+    if k:
+        neighbor_IDs = neighbor_IDs[:, :k]
+        if with_distances:
+            distances = distances[:, :k]
+    neighbor_counts = (neighbor_IDs >= 0).sum(axis=1).tolist()
+
+    # map node IDs to keys for the whole matrix at once (unmapped IDs are
+    # kept as-is, as in readNeighborFile)
+    if node_map:
+        max_ID = max(int(neighbor_IDs.max(initial=0)), max(node_map.keys()))
+        keys_by_ID = np.array(list(range(max_ID + 1)), dtype=object)
+        for (node_ID, key) in node_map.items():
+            keys_by_ID[node_ID] = key
+        mapped_neighbors = keys_by_ID[np.maximum(neighbor_IDs, 0)].tolist()
+    else:
+        mapped_neighbors = neighbor_IDs.tolist()
+
+    # (query IDs are mapped exactly as in readNeighborFile: when queries
+    # have their own map, IDs missing from it are never looked up in the
+    # neighbor map, as query and neighbor IDs may overlap)
+    if not node_map:
+        query_remap = lambda key: key
+    elif query_node_map:
+        query_remap = lambda key: query_node_map.get(key, key)
+    else:
+        query_remap = lambda key: node_map.get(key, key)
+
+    neighbors = {}
+    query_IDs = contents['query_IDs'].tolist()
+    if with_distances:
+        distances = distances.tolist()
+    for i in range(len(query_IDs)):
+        row_neighbors = mapped_neighbors[i][:neighbor_counts[i]]
+        if with_distances:
+            row_neighbors = list(zip(row_neighbors, distances[i][:neighbor_counts[i]]))
+        neighbors[query_remap(query_IDs[i])] = row_neighbors
+    return neighbors
+
 def readStringMap(f, lower_keys=False):
     _map = {}
     with open(f, 'r') as stream:
@@ -198,6 +640,18 @@ def loadPairedNeighbors(src, i, trg, config, k, aggregate=False,
         query_node_map = readNodeMap(query_vocab)
     else: query_node_map = None
 
+    # prefer the binary version of the neighbor file, if it has been written
+    # (labeled with the configured vocab files, as for the text version)
+    binary_neighbor_file = binaryNeighborFilePath(neighbor_file)
+    if os.path.isfile(binary_neighbor_file):
+        return readBinaryNeighborFile(
+            binary_neighbor_file,
+            k=k,
+            node_map=node_map,
+            with_distances=with_distances,
+            query_node_map=query_node_map
+        )
+
     neighbors = readNeighborFile(
         neighbor_file,
         k=k,
@@ -0,0 +1,443 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+import nearest_neighbors.database
+from nearest_neighbors.database import *
+from nearest_neighbors.database import _ftsPrefixQuery, _CWD_SELECT, _MIGRATIONS
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dbf = os.path.join(self._tmpdir.name, 'test.db')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _appliedVersions(self, db):
+        db._cursor.execute('SELECT Version FROM SchemaMigrations ORDER BY Version')
+        return [version for (version,) in db._cursor.fetchall()]
+
+    def testNewDatabaseIsMigrated(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        self.assertEqual(db.schemaVersion(), LATEST_SCHEMA_VERSION)
+        self.assertEqual(self._appliedVersions(db),
+            [version for (version, _, _) in _MIGRATIONS])
+        db.close()
+
+    def testMigrateIsIdempotent(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        self.assertEqual(db.migrate(), [])
+        db.close()
+        # reopening doesn't reapply anything either
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        self.assertEqual(self._appliedVersions(db),
+            [version for (version, _, _) in _MIGRATIONS])
+        db.close()
+
+    def testUpgradesOlderDatabase(self):
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        db.insertOrUpdateIntoEntityTerms([EntityTerm('C001', 'Viral pneumonia', 1)])
+        # roll the schema back to version 2
+        db._cursor.execute('DELETE FROM SchemaMigrations WHERE Version > 2')
+        for statement in [
+                    'DROP TABLE EntityTermsSearch',
+                    'DROP TABLE DataVersion',
+                    'DROP TABLE EntityInfoCards',
+                    'DROP INDEX IX_ConfidenceWeightedDeltas_EntityKey',
+                ]:
+            db._cursor.execute(statement)
+        db.close()
+
+        db = EmbeddingNeighborhoodDatabase(self.dbf, build=False)
+        self.assertEqual(db.schemaVersion(), 2)
+        self.assertEqual(db.migrate(), list(range(3, LATEST_SCHEMA_VERSION+1)))
+        self.assertEqual(db.schemaVersion(), LATEST_SCHEMA_VERSION)
+        # existing data is carried into the new tables
+        self.assertEqual([row.entity_key for row in db.searchInEntityTerms('pneu')], ['C001'])
+        self.assertEqual(db.dataVersion(), 1)
+        db.close()
+
+    def testFailedMigrationRollsBack(self):
+        failing = (LATEST_SCHEMA_VERSION + 1, 'Fails partway', [
+            'CREATE TABLE PartiallyMigrated (ID int)',
+            'CREATE INDEX IX_Missing ON MissingTable (ID)',
+        ])
+        for isolation_level in ['', None]:
+            db = EmbeddingNeighborhoodDatabase(self.dbf)
+            db._connection.isolation_level = isolation_level
+            with mock.patch.object(nearest_neighbors.database, '_MIGRATIONS', _MIGRATIONS + [failing]):
+                with self.assertRaises(sqlite3.OperationalError):
+                    db.migrate()
+            # none of the failed migration's DDL is kept
+            db._cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'PartiallyMigrated'")
+            self.assertEqual(db._cursor.fetchone()[0], 0)
+            self.assertEqual(db.schemaVersion(), LATEST_SCHEMA_VERSION)
+            db.close()
+
+class DatabasePoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dbf = os.path.join(self._tmpdir.name, 'test.db')
+        db = EmbeddingNeighborhoodDatabase(self.dbf)
+        db._cursor.execute('DELETE FROM SchemaMigrations WHERE Version > 2')
+        db.close()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _unwritable(self):
+        '''Patches the DB class so that only read-only opens succeed.'''
+        open_database = EmbeddingNeighborhoodDatabase
+        def openReadOnly(fpath, *args, read_only=False, **kwargs):
+            if not read_only:
+                raise sqlite3.OperationalError('attempt to write a readonly database')
+            return open_database(fpath, *args, read_only=read_only, **kwargs)
+        return mock.patch.object(nearest_neighbors.database,
+            'EmbeddingNeighborhoodDatabase', side_effect=openReadOnly)
+
+    def testMigratesOnFirstUse(self):
+        pool = DatabasePool(self.dbf, size=2)
+        with pool.connection() as db:
+            self.assertEqual(db.schemaVersion(), LATEST_SCHEMA_VERSION)
+            # connections are read-only
+            with self.assertRaises(sqlite3.OperationalError):
+                db._cursor.execute('DELETE FROM EntityTerms')
+        pool.closeAll()
+
+    def testReusesConnections(self):
+        pool = DatabasePool(self.dbf, size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        pool.release(first)
+        pool.release(second)
+        pool.closeAll()
+
+    def testRefusesOutOfDateUnwritableDatabase(self):
+        pool = DatabasePool(self.dbf)
+        with self._unwritable():
+            with self.assertRaisesRegex(RuntimeError, 'python -m nearest_neighbors.database'):
+                pool.ensureSchema()
+            with self.assertRaises(RuntimeError):
+                pool.acquire()
+
+    def testClosesConnectionsOnFailure(self):
+        connect = sqlite3.connect
+        for (schema_version_error, expected_error) in [
+                    (None, RuntimeError),
+                    (sqlite3.DatabaseError('file is not a database'), sqlite3.DatabaseError),
+                ]:
+            connections = []
+            def trackedConnect(*args, **kwargs):
+                connections.append(connect(*args, **kwargs))
+                return connections[-1]
+            pool = DatabasePool(self.dbf)
+            with mock.patch.object(sqlite3, 'connect', side_effect=trackedConnect), \
+                    mock.patch.object(EmbeddingNeighborhoodDatabase, 'migrate',
+                        side_effect=sqlite3.OperationalError('attempt to write a readonly database')), \
+                    mock.patch.object(EmbeddingNeighborhoodDatabase, 'schemaVersion',
+                        side_effect=schema_version_error, return_value=2):
+                with self.assertRaises(expected_error):
+                    pool.ensureSchema()
+            # both the writable and the read-only connection were closed
+            self.assertEqual(len(connections), 2)
+            for connection in connections:
+                with self.assertRaises(sqlite3.ProgrammingError):
+                    connection.execute('SELECT 1')
+
+    def testUsesUpToDateUnwritableDatabase(self):
+        EmbeddingNeighborhoodDatabase(self.dbf).close()
+        pool = DatabasePool(self.dbf)
+        with self._unwritable():
+            pool.ensureSchema()
+            with pool.connection() as db:
+                self.assertEqual(db.schemaVersion(), LATEST_SCHEMA_VERSION)
+        pool.closeAll()
+
+class EntityTermSearchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = EmbeddingNeighborhoodDatabase(':memory:')
+        self.db.insertOrUpdateIntoEntityTerms([
+            EntityTerm('C001', 'Viral pneumonia', 1),
+            EntityTerm('C001', 'Pneumonia due to virus', 0),
+            EntityTerm('C002', 'COVID-19 pneumonia', 1),
+            EntityTerm('C003', 'Influenza', 1),
+        ])
+
+    def tearDown(self):
+        self.db.close()
+
+    def _search(self, query_string, **kwargs):
+        return set([
+            (row.entity_key, row.term)
+                for row in self.db.searchInEntityTerms(query_string, **kwargs)
+        ])
+
+    def testPrefixQuery(self):
+        self.assertEqual(_ftsPrefixQuery('covid pneu'), '"covid"* "pneu"*')
+        # punctuation can't inject FTS5 syntax
+        self.assertEqual(_ftsPrefixQuery('covid-19 "OR'), '"covid"* "19"* "OR"*')
+        self.assertEqual(_ftsPrefixQuery(' -- '), '')
+
+    def testMatchesEveryWordAsPrefix(self):
+        self.assertEqual(self._search('pneu'), {
+            ('C001', 'Viral pneumonia'),
+            ('C001', 'Pneumonia due to virus'),
+            ('C002', 'COVID-19 pneumonia'),
+        })
+        self.assertEqual(self._search('covid pneu'), {('C002', 'COVID-19 pneumonia')})
+        self.assertEqual(self._search('C003'), {('C003', 'Influenza')})
+
+    def testEmptyQuery(self):
+        self.assertEqual(self._search(''), set())
+        self.assertEqual(self._search('!!'), set())
+
+    def testPaging(self):
+        pages = [
+            self._search('pneu', limit=2, offset=0),
+            self._search('pneu', limit=2, offset=2),
+        ]
+        self.assertEqual(len(pages[0]), 2)
+        self.assertEqual(len(pages[1]), 1)
+        self.assertEqual(pages[0] | pages[1], self._search('pneu'))
+
+    def testNewTermsAreIndexed(self):
+        self.db.insertOrUpdateIntoEntityTerms([
+            EntityTerm('C001', 'Viral pneumonia', 0),
+            EntityTerm('C004', 'Pneumothorax', 1),
+        ])
+        self.assertEqual(self._search('pneumo'), {
+            ('C001', 'Viral pneumonia'),
+            ('C001', 'Pneumonia due to virus'),
+            ('C002', 'COVID-19 pneumonia'),
+            ('C004', 'Pneumothorax'),
+        })
+        self.assertEqual(self._search('viral'), {('C001', 'Viral pneumonia')})
+
+class BulkLoadNeighborsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = EmbeddingNeighborhoodDatabase(':memory:')
+        group = EmbeddingSetGroup('test')
+        self.src = EmbeddingSet(group, 'corpus1', 1)
+        self.trg = EmbeddingSet(group, 'corpus2', 2)
+        self.db.insertOrUpdate([self.src, self.trg])
+        self.first_summary = self.db.insertOrUpdateIntoAggregateNearestNeighbors([
+            self._neighbor('C001', 'C002', 0.1),
+            self._neighbor('C001', 'C003', 0.2),
+            self._neighbor('C002', 'C001', 0.1),
+        ])
+
+    def tearDown(self):
+        self.db.close()
+
+    def _neighbor(self, key, neighbor_key, mean_distance, filter_set='.HC'):
+        return AggregateNearestNeighbor(self.src, self.trg, filter_set, key,
+            neighbor_key, mean_distance)
+
+    def _load(self, conflict_policy):
+        return self.db.insertOrUpdateIntoAggregateNearestNeighbors([
+            # unchanged (within floating point error)
+            self._neighbor('C001', 'C002', 0.1000001),
+            # conflicting
+            self._neighbor('C001', 'C003', 0.5),
+            # new, and an existing neighbor linked to a new filter set
+            self._neighbor('C003', 'C001', 0.3),
+            self._neighbor('C002', 'C001', 0.1, filter_set='.All'),
+        ], conflict_policy=conflict_policy, max_reported_conflicts=5)
+
+    def _saved(self):
+        self.db._cursor.execute('''
+        SELECT EntityKey, NeighborKey, MeanDistance FROM AggregateNearestNeighbors
+        ''')
+        return dict([
+            ((key, neighbor_key), distance)
+                for (key, neighbor_key, distance) in self.db._cursor.fetchall()
+        ])
+
+    def _numLinks(self):
+        self.db._cursor.execute('SELECT COUNT(*) FROM AggregateNearestNeighborSubsets')
+        return self.db._cursor.fetchone()[0]
+
+    def _assertSummary(self, summary, conflict_policy):
+        self.assertEqual(
+            dict([(k, v) for (k, v) in summary.items() if k != 'conflict_examples']),
+            {
+                'staged': 4,
+                'inserted': 1,
+                'existing': 3,
+                'conflicts': 1,
+                'conflict_policy': conflict_policy,
+            }
+        )
+        self.assertEqual(summary['conflict_examples'],
+            [('C001', 'C003', self.src.ID, 0.2, 0.5)])
+
+    def testFirstLoad(self):
+        self.assertEqual(self.first_summary['inserted'], 3)
+        self.assertEqual(self.first_summary['existing'], 0)
+        self.assertEqual(self.first_summary['conflicts'], 0)
+        self.assertEqual(self._numLinks(), 3)
+
+    def testSkip(self):
+        self._assertSummary(self._load(ConflictPolicy.SKIP), ConflictPolicy.SKIP)
+        self.assertEqual(self._saved(), {
+            ('C001', 'C002'): 0.1,
+            ('C001', 'C003'): 0.2,
+            ('C002', 'C001'): 0.1,
+            ('C003', 'C001'): 0.3,
+        })
+        self.assertEqual(self._numLinks(), 5)
+
+    def testOverwrite(self):
+        self._assertSummary(self._load(ConflictPolicy.OVERWRITE), ConflictPolicy.OVERWRITE)
+        self.assertEqual(self._saved(), {
+            ('C001', 'C002'): 0.1,
+            ('C001', 'C003'): 0.5,
+            ('C002', 'C001'): 0.1,
+            ('C003', 'C001'): 0.3,
+        })
+
+    def testFailRollsBack(self):
+        data_version = self.db.dataVersion()
+        with self.assertRaises(ValueError):
+            self._load(ConflictPolicy.FAIL)
+        self.assertEqual(self._saved(), {
+            ('C001', 'C002'): 0.1,
+            ('C001', 'C003'): 0.2,
+            ('C002', 'C001'): 0.1,
+        })
+        self.assertEqual(self._numLinks(), 3)
+        self.assertEqual(self.db.dataVersion(), data_version)
+
+    def testDuplicatesCountedOnce(self):
+        # the same neighbors staged for several filter sets, and twice over
+        summary = self.db.insertOrUpdateIntoAggregateNearestNeighbors([
+            self._neighbor('C001', 'C003', 0.5),
+            self._neighbor('C001', 'C003', 0.5, filter_set='.All'),
+            self._neighbor('C003', 'C001', 0.3),
+            self._neighbor('C003', 'C001', 0.3, filter_set='.All'),
+            self._neighbor('C003', 'C001', 0.3),
+        ], conflict_policy=ConflictPolicy.SKIP)
+        self.assertEqual(summary['staged'], 5)
+        self.assertEqual(summary['inserted'], 1)
+        self.assertEqual(summary['existing'], 1)
+        self.assertEqual(summary['conflicts'], 1)
+        self.assertEqual(summary['conflict_examples'],
+            [('C001', 'C003', self.src.ID, 0.2, 0.5)])
+        self.assertEqual(self._numLinks(), 6)
+
+    def testMixedNeighborTypes(self):
+        # new neighbors of another type are saved alongside the entities...
+        summary = self.db.insertOrUpdateIntoAggregateNearestNeighbors([
+            self._neighbor('T001', 'T002', 0.4),
+        ], neighbor_type=EmbeddingType.TERM)
+        self.assertEqual((summary['inserted'], summary['existing']), (1, 0))
+        self.assertEqual(self._numLinks(), 4)
+        # ...but ones saved as entities can't be reloaded as another type
+        data_version = self.db.dataVersion()
+        with self.assertRaises(ValueError):
+            self.db.insertOrUpdateIntoAggregateNearestNeighbors([
+                self._neighbor('C001', 'C002', 0.1),
+                self._neighbor('C004', 'C001', 0.6),
+            ], neighbor_type=EmbeddingType.TERM, conflict_policy=ConflictPolicy.OVERWRITE)
+        self.db._cursor.execute('''
+        SELECT EntityKey, NeighborType FROM AggregateNearestNeighbors
+        WHERE EntityKey IN ('C001', 'C004')
+        ''')
+        self.assertEqual(self.db._cursor.fetchall(), [('C001', EmbeddingType.ENTITY)] * 2)
+        self.assertEqual(self._numLinks(), 4)
+        self.assertEqual(self.db.dataVersion(), data_version)
+
+    def testParsePolicy(self):
+        self.assertEqual(ConflictPolicy.parse(' Overwrite '), ConflictPolicy.OVERWRITE)
+        with self.assertRaises(ValueError):
+            ConflictPolicy.parse('merge')
+
+class ConfidenceWeightedDeltaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.db = EmbeddingNeighborhoodDatabase(':memory:')
+        group = EmbeddingSetGroup('test')
+        self.src = EmbeddingSet(group, 'corpus1', 1)
+        self.trg = EmbeddingSet(group, 'corpus2', 2)
+        self.db.insertOrUpdate([self.src, self.trg])
+
+        # loaded in the opposite order to their dependencies, so every
+        # insert has to refresh the materialized rows
+        self.db.insertOrUpdateIntoEntityTerms([
+            EntityTerm('C001', 'Viral pneumonia', 1),
+            EntityTerm('C002', 'Influenza', 1),
+        ])
+        self.db.insertOrUpdate([
+            EntityOverlapAnalysis(self.src, self.trg, '.HC', 5, 'C001', EN_similarity=0.25),
+            EntityOverlapAnalysis(self.src, self.trg, '.HC', 5, 'C002', EN_similarity=0.75),
+            EntityOverlapAnalysis(self.src, self.trg, '.HC', 5, 'C003', EN_similarity=0.5),
+        ])
+        self.db.insertOrUpdateIntoInternalConfidence([
+            InternalConfidence(self.src, 5, 'C001', 0.5),
+            InternalConfidence(self.trg, 5, 'C001', 1.0),
+            InternalConfidence(self.src, 5, 'C002', 1.0),
+            InternalConfidence(self.trg, 5, 'C002', 0.5),
+            InternalConfidence(self.src, 5, 'C003', 1.0),
+            InternalConfidence(self.trg, 5, 'C003', 1.0),
+        ])
+
+    def tearDown(self):
+        self.db.close()
+
+    def _materialized(self):
+        return dict([
+            (row.key, (row.CWD, row.string))
+                for row in self.db.selectFromEntityOverlapAnalysis(
+                    self.src, self.trg, '.HC', 5, limit=100)
+        ])
+
+    def _assertMatchesUnmaterialized(self):
+        self.db._cursor.execute(_CWD_SELECT.format(''))
+        expected = sorted(self.db._cursor.fetchall())
+        self.db._cursor.execute('SELECT * FROM ConfidenceWeightedDeltas')
+        self.assertEqual(sorted(self.db._cursor.fetchall()), expected)
+
+    def testMaterialized(self):
+        # (C003 has no preferred term)
+        self.assertEqual(self._materialized(), {
+            'C001': (0.5 * 1.0 * 0.75, 'Viral pneumonia'),
+            'C002': (1.0 * 0.5 * 0.25, 'Influenza'),
+        })
+        self._assertMatchesUnmaterialized()
+
+    def testRefreshedOnUpdates(self):
+        self.db.insertOrUpdateIntoEntityTerms([
+            EntityTerm('C002', 'Influenza', 0),
+            EntityTerm('C002', 'Flu', 1),
+            EntityTerm('C003', 'Pneumothorax', 1),
+        ])
+        self.db.insertOrUpdateIntoInternalConfidence([
+            InternalConfidence(self.trg, 5, 'C001', 0.5),
+        ])
+        self.assertEqual(self._materialized(), {
+            'C001': (0.5 * 0.5 * 0.75, 'Viral pneumonia'),
+            'C002': (1.0 * 0.5 * 0.25, 'Flu'),
+            'C003': (1.0 * 1.0 * 0.5, 'Pneumothorax'),
+        })
+        self._assertMatchesUnmaterialized()
+
+    def testEntityKeyRefreshUsesIndex(self):
+        self.db._cursor.execute('''
+        EXPLAIN QUERY PLAN
+        DELETE FROM ConfidenceWeightedDeltas
+        WHERE EntityKey IN (SELECT EntityKey FROM MaterializeEntityKeys)
+        ''')
+        plan = ' '.join([row[-1] for row in self.db._cursor.fetchall()])
+        self.assertIn('IX_ConfidenceWeightedDeltas_EntityKey', plan)
+
+if __name__ == '__main__':
+    unittest.main()
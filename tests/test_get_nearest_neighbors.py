@@ -0,0 +1,40 @@
+import multiprocessing as mp
+import unittest
+from nearest_neighbors.calculation import get_nearest_neighbors
+
+def _reportingWorker(worker_ID, stats_q):
+    stats_q.put((worker_ID, 10, 2, 0.5, 1.0))
+
+def _crashingWorker(worker_ID, stats_q):
+    raise SystemExit(3)
+
+def _silentWorker(worker_ID, stats_q):
+    pass
+
+class WorkerThroughputTests(unittest.TestCase):
+
+    def _run(self, targets):
+        stats_q = mp.Queue()
+        workers = [
+            mp.Process(target=target, args=(i+1, stats_q))
+                for (i, target) in enumerate(targets)
+        ]
+        for p in workers:
+            p.start()
+        for p in workers:
+            p.join()
+        get_nearest_neighbors._reportWorkerThroughput(stats_q, workers, timeout=1)
+
+    def testAllWorkersReport(self):
+        self._run([_reportingWorker, _reportingWorker])
+
+    def testCrashedWorkerRaises(self):
+        with self.assertRaisesRegex(RuntimeError, 'worker 2 exited with code 3'):
+            self._run([_reportingWorker, _crashingWorker])
+
+    def testMissingReportRaises(self):
+        with self.assertRaisesRegex(RuntimeError, 'only 1 of 2 workers'):
+            self._run([_reportingWorker, _silentWorker])
+
+if __name__ == '__main__':
+    unittest.main()
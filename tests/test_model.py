@@ -0,0 +1,170 @@
+import pickle
+import unittest
+from unittest import mock
+import numpy as np
+from nearest_neighbors.calculation import model
+
+def _bruteForceNeighbors(embed_arrays, batch_input, top_k, no_self=True):
+    '''Reference kNN: full sort of the mean cosine distance over replicates,
+    row by row (as in the original TensorFlow model).'''
+    distances = np.mean([
+        1 - np.matmul(
+            arr[batch_input] / np.linalg.norm(arr[batch_input], axis=1, keepdims=True),
+            (arr / np.linalg.norm(arr, axis=1, keepdims=True)).T
+        )
+            for arr in embed_arrays
+    ], axis=0)
+    neighbors = []
+    for (i, query) in enumerate(batch_input):
+        sorted_neighbors = np.argsort(distances[i])
+        if no_self and sorted_neighbors[0] == query:
+            sorted_neighbors = sorted_neighbors[1:]
+        neighbors.append([
+            (int(ix), float(distances[i][ix]))
+                for ix in sorted_neighbors[:top_k]
+        ])
+    return neighbors
+
+class NeighborSelectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+
+    def testTopCandidatesMatchesFullSort(self):
+        distances = self.rng.rand(7, 50)
+        for num_candidates in [1, 5, 50, 80]:
+            (neighbors, sorted_distances) = model._topCandidates(distances, num_candidates)
+            expected = np.argsort(distances, axis=1)[:, :num_candidates]
+            np.testing.assert_array_equal(neighbors, expected)
+            np.testing.assert_array_equal(sorted_distances,
+                np.take_along_axis(distances, expected, axis=1))
+
+    def testSelectNeighborsMatchesFullSort(self):
+        distances = self.rng.rand(6, 30)
+        batch_input = [0, 3, 5, 10, 11, 29]
+        # make the query the closest point for most (but not all) rows
+        for (i, query) in enumerate(batch_input[:-1]):
+            distances[i, query] = -1
+        for top_k in [None, 1, 5, 29]:
+            for no_self in [True, False]:
+                full = model._selectNeighbors(distances, batch_input, top_k=None,
+                    no_self=no_self, with_distances=True)
+                actual = model._selectNeighbors(distances, batch_input, top_k=top_k,
+                    no_self=no_self, with_distances=True)
+                expected = [row if top_k is None else row[:top_k] for row in full]
+                self.assertEqual(
+                    [[(int(n), float(d)) for (n, d) in row] for row in actual],
+                    [[(int(n), float(d)) for (n, d) in row] for row in expected]
+                )
+
+    def testMatrixOutputMatchesLists(self):
+        distances = self.rng.rand(4, 6)
+        distances[0, 0] = -1
+        # queries as indices (the first of which is its own closest point),
+        # or as embeddings, which are never dropped as the query itself
+        for (indices, batch_input, num_dropped) in [
+                    (True, [0, 1, 2, 3], 1),
+                    (False, [self.rng.rand(4, 3) for _ in range(2)], 0),
+                ]:
+            lists = model._selectNeighbors(distances, batch_input, indices=indices,
+                top_k=6, with_distances=True)
+            (neighbor_matrix, distance_matrix) = model._selectNeighbors(distances,
+                batch_input, indices=indices, top_k=6, as_matrices=True)
+            self.assertEqual(sum([6 - len(row) for row in lists]), num_dropped)
+            for (i, row) in enumerate(lists):
+                self.assertEqual(neighbor_matrix[i][:len(row)].tolist(), [n for (n, _) in row])
+                np.testing.assert_allclose(distance_matrix[i][:len(row)], [d for (_, d) in row], rtol=1e-6)
+                # rows with fewer than k neighbors are padded
+                self.assertTrue((neighbor_matrix[i][len(row):] == -1).all())
+
+    def testNumpyBackendMatchesBruteForce(self):
+        embed_arrays = [self.rng.normal(size=(40, 8)) for _ in range(3)]
+        batch_input = list(range(0, 40, 3))
+        nn = model.NumpyMultiNearestNeighbors(embed_arrays)
+        actual = nn.nearestNeighbors(batch_input, top_k=5, with_distances=True)
+        expected = _bruteForceNeighbors(embed_arrays, batch_input, 5)
+        for (actual_row, expected_row) in zip(actual, expected):
+            self.assertEqual([int(n) for (n, _) in actual_row], [n for (n, _) in expected_row])
+            np.testing.assert_allclose([d for (_, d) in actual_row],
+                [d for (_, d) in expected_row], atol=1e-5)
+
+class _ReplicateNeighborsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        self.embed_arrays = [rng.normal(size=(200, 16)) for _ in range(2)]
+        self.batch_input = list(range(0, 200, 7))
+
+    def _assertSameNeighbors(self, actual, expected):
+        for (actual_row, expected_row) in zip(actual, expected):
+            self.assertEqual([int(n) for (n, _) in actual_row], [int(n) for (n, _) in expected_row])
+            np.testing.assert_allclose([d for (_, d) in actual_row],
+                [d for (_, d) in expected_row], atol=1e-5)
+        self.assertEqual(len(actual), len(expected))
+
+class TiledNeighborsTests(_ReplicateNeighborsTestCase):
+
+    def testTileSize(self):
+        nn = model.NumpyMultiNearestNeighbors(self.embed_arrays, memory_budget=0.001)
+        # never smaller than the carried-over candidates, or larger than the vocab
+        self.assertEqual(nn._tileSize(1000, 11), 11)
+        self.assertEqual(nn._tileSize(1, 11), 65)
+        self.assertEqual(model.NumpyMultiNearestNeighbors(self.embed_arrays)._tileSize(1000, 11), 200)
+
+    def testTiledMatchesUntiled(self):
+        untiled = model.NumpyMultiNearestNeighbors(self.embed_arrays)
+        expected = _bruteForceNeighbors(self.embed_arrays, self.batch_input, 10)
+        self._assertSameNeighbors(
+            untiled.nearestNeighbors(self.batch_input, top_k=10, with_distances=True),
+            expected)
+        # budgets giving tiles from the minimum (k+1 columns) up to the vocab
+        for memory_budget in [0.0001, 0.005, 0.02, 100]:
+            tiled = model.NumpyMultiNearestNeighbors(self.embed_arrays, memory_budget=memory_budget)
+            self._assertSameNeighbors(
+                tiled.nearestNeighbors(self.batch_input, top_k=10, with_distances=True),
+                expected)
+
+class FusedReplicatesTests(_ReplicateNeighborsTestCase):
+
+    def testFusedMatchesPerReplicate(self):
+        expected = _bruteForceNeighbors(self.embed_arrays, self.batch_input, 10)
+        for memory_budget in [None, 0.02]:
+            fused = model.NumpyMultiNearestNeighbors(self.embed_arrays,
+                memory_budget=memory_budget, fused=True)
+            self._assertSameNeighbors(
+                fused.nearestNeighbors(self.batch_input, top_k=10, with_distances=True),
+                expected)
+
+    def testFusedWithEmbeddingInputs(self):
+        # queries given as vectors rather than vocabulary indices
+        batch_vectors = [arr[self.batch_input] for arr in self.embed_arrays]
+        unfused = model.NumpyMultiNearestNeighbors(self.embed_arrays)
+        fused = model.NumpyMultiNearestNeighbors(self.embed_arrays, fused=True)
+        self._assertSameNeighbors(
+            fused.nearestNeighbors(batch_vectors, indices=False, top_k=10, no_self=False,
+                with_distances=True),
+            unfused.nearestNeighbors(batch_vectors, indices=False, top_k=10, no_self=False,
+                with_distances=True))
+
+    def testTensorFlowBackendRejectsFused(self):
+        with self.assertRaises(ValueError):
+            model.buildMultiNearestNeighbors(self.embed_arrays,
+                backend=model.Backend.TENSORFLOW, fused=True)
+
+class SharedEmbeddingMatricesTests(_ReplicateNeighborsTestCase):
+
+    def testAttachedCopyDoesNotOwnBlock(self):
+        shared = model.SharedEmbeddingMatrices(self.embed_arrays)
+        try:
+            with mock.patch.object(model.resource_tracker, 'unregister') as unregister:
+                attached = pickle.loads(pickle.dumps(shared))
+            # releasing the block is left to the creating process alone
+            unregister.assert_called_once_with(shared._shm._name, 'shared_memory')
+            np.testing.assert_array_equal(attached.matrix, shared.matrix)
+            attached.close()
+            self.assertEqual(shared.matrix.shape, (2, 200, 16))
+        finally:
+            shared.close()
+
+if __name__ == '__main__':
+    unittest.main()
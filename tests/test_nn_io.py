@@ -0,0 +1,200 @@
+import os
+import codecs
+import tempfile
+import unittest
+import numpy as np
+import pyemblib
+from nearest_neighbors import nn_io
+
+def _writeEmbeddingFile(f, embeds):
+    '''Writes {key: vector} to f in word2vec text format.'''
+    dimension = len(next(iter(embeds.values())))
+    with codecs.open(f, 'w', 'utf-8') as stream:
+        stream.write('%d %d\n' % (len(embeds), dimension))
+        for (key, vector) in embeds.items():
+            stream.write('%s %s\n' % (key, ' '.join(['%f' % v for v in vector])))
+
+class BinaryNeighborFileTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+
+        # query and neighbor node IDs overlap, as with --draw-queries-from
+        self.node_map = {0: 'N0', 1: 'N1', 2: 'N2'}
+        self.query_node_map = {0: 'Q0', 1: 'Q1'}
+        self.query_IDs = np.array([0, 1, 5])
+        self.neighbors = np.array([[1, 2], [2, 0], [0, -1]])
+        self.distances = np.array([[0.25, 0.5], [0.125, 0.75], [0.5, np.nan]])
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _writeText(self, f):
+        counts = (self.neighbors >= 0).sum(axis=1)
+        with codecs.open(f, 'w', 'utf-8') as stream:
+            stream.write('# File format is:\n# <word vocab index>,<NN 1>,<NN 2>,...\n')
+            nn_io.writeNeighborFileLines(stream, self.query_IDs, self.neighbors,
+                distances=self.distances, neighbor_counts=counts)
+
+    def _writeBinary(self, f, **kwargs):
+        nn_io.writeBinaryNeighborFile(f, self.query_IDs, self.neighbors,
+            distances=self.distances, **kwargs)
+
+    def testRoundTrip(self):
+        f = os.path.join(self.dir, 'neighbors.npz')
+        self._writeBinary(f, node_map=self.node_map)
+        stored_node_map = nn_io.readBinaryNeighborArrays(f)['node_map']
+        self.assertEqual(stored_node_map, self.node_map)
+        neighbors = nn_io.readBinaryNeighborFile(f, node_map=stored_node_map,
+            with_distances=True)
+        self.assertEqual(neighbors, {
+            'N0': [('N1', 0.25), ('N2', 0.5)],
+            'N1': [('N2', 0.125), ('N0', 0.75)],
+            5: [('N0', 0.5)],
+        })
+
+    def testAppend(self):
+        f = os.path.join(self.dir, 'neighbors.npz')
+        nn_io.writeBinaryNeighborFile(f, [0], [[1]], distances=[[0.5]])
+        nn_io.writeBinaryNeighborFile(f, [1], [[2, 0]], distances=[[0.25, 0.75]], append=True)
+        neighbors = nn_io.readBinaryNeighborFile(f, with_distances=True)
+        self.assertEqual(neighbors, {0: [(1, 0.5)], 1: [(2, 0.25), (0, 0.75)]})
+
+    def testMatchesTextFile(self):
+        textf = os.path.join(self.dir, 'neighbors')
+        binaryf = nn_io.binaryNeighborFilePath(textf)
+        self._writeText(textf)
+        # maps stored at compute time differ from the ones supplied at read
+        # time; the supplied ones must win
+        self._writeBinary(binaryf, node_map={0: 'stale'})
+        for (node_map, query_node_map) in [
+                    (None, None),
+                    (self.node_map, None),
+                    (self.node_map, self.query_node_map),
+                ]:
+            for k in [None, 1]:
+                expected = nn_io.readNeighborFile(textf, k=k, node_map=node_map,
+                    with_distances=True, query_node_map=query_node_map)
+                actual = nn_io.readBinaryNeighborFile(binaryf, k=k,
+                    node_map=node_map, with_distances=True,
+                    query_node_map=query_node_map)
+                self.assertEqual(actual, expected)
+
+    def testDefaultsToNodeIDs(self):
+        # without a node_map, both formats give the raw node IDs, even if
+        # the binary file has a map stored in it
+        textf = os.path.join(self.dir, 'neighbors')
+        binaryf = nn_io.binaryNeighborFilePath(textf)
+        self._writeText(textf)
+        self._writeBinary(binaryf, node_map=self.node_map, query_node_map=self.query_node_map)
+        expected = {
+            0: [(1, 0.25), (2, 0.5)],
+            1: [(2, 0.125), (0, 0.75)],
+            5: [(0, 0.5)],
+        }
+        self.assertEqual(nn_io.readNeighborFile(textf, with_distances=True), expected)
+        self.assertEqual(nn_io.readBinaryNeighborFile(binaryf, with_distances=True), expected)
+
+    def testUnmappedQueriesAreNotLabeledAsNeighbors(self):
+        f = os.path.join(self.dir, 'neighbors.npz')
+        self._writeBinary(f)
+        neighbors = nn_io.readBinaryNeighborFile(f, node_map={5: 'N5', **self.node_map},
+            with_distances=True, query_node_map=self.query_node_map)
+        self.assertEqual(set(neighbors.keys()), {'Q0', 'Q1', 5})
+
+class EmbeddingCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.embedf = os.path.join(self.dir, 'embeddings.txt')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _read(self):
+        return nn_io.readEmbeddings(self.embedf, mode=pyemblib.Mode.Text,
+            cache_dir=self.cache_dir)
+
+    def testCachedMatchesParsed(self):
+        _writeEmbeddingFile(self.embedf, {'a': [1.0, 0.5], 'caf\u00e9': [0.25, -1.0]})
+        parsed = nn_io.readEmbeddings(self.embedf, mode=pyemblib.Mode.Text, use_cache=False)
+        # first read writes the cache, second memory-maps it
+        for embeds in [self._read(), self._read()]:
+            self.assertIsInstance(embeds, nn_io.MappedEmbeddings)
+            self.assertEqual(set(embeds.keys()), set(parsed.keys()))
+            for key in parsed.keys():
+                np.testing.assert_array_equal(embeds[key], parsed[key])
+            np.testing.assert_array_equal(nn_io.embeddingArray(embeds, ['caf\u00e9', 'a']),
+                nn_io.embeddingArray(parsed, ['caf\u00e9', 'a']))
+
+    def testInvalidatedWhenFileChanges(self):
+        _writeEmbeddingFile(self.embedf, {'a': [1.0, 0.5]})
+        self._read()
+        cache_files = set(os.listdir(self.cache_dir))
+
+        _writeEmbeddingFile(self.embedf, {'a': [2.0, 0.0], 'c': [0.0, 1.0]})
+        stat = os.stat(self.embedf)
+        os.utime(self.embedf, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        embeds = self._read()
+        self.assertEqual(set(embeds.keys()), {'a', 'c'})
+        np.testing.assert_array_equal(embeds['a'], [2.0, 0.0])
+        # the cache for the old version is cleared out
+        self.assertEqual(len(set(os.listdir(self.cache_dir)) & cache_files), 0)
+
+class EmbeddingVectorStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.replicates = [
+            {'a': [1.0, 0.0], 'b': [0.0, 1.0], 'c': [0.5, 0.5]},
+            {'a': [2.0, 0.0], 'c': [0.25, 0.75], 'b': [0.0, 2.0]},
+            {'c': [1.0, 1.0], 'a': [3.0, 0.0], 'd': [0.0, 3.0]},
+        ]
+        for (i, replicate) in enumerate(self.replicates):
+            _writeEmbeddingFile(os.path.join(self.dir, 'replicate.%d.txt' % i), replicate)
+        self.pattern = os.path.join(self.dir, 'replicate.*.txt')
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _store(self):
+        return nn_io.EmbeddingVectorStore('src', self.pattern, pyemblib.Mode.Text,
+            cache_dir=self.cache_dir)
+
+    def testLookups(self):
+        self.assertFalse(nn_io.EmbeddingVectorStore.isCached(self.pattern,
+            pyemblib.Mode.Text, cache_dir=self.cache_dir))
+        store = self._store()
+        self.assertTrue(nn_io.EmbeddingVectorStore.isCached(self.pattern,
+            pyemblib.Mode.Text, cache_dir=self.cache_dir))
+
+        self.assertEqual(len(store), 3)
+        self.assertTrue(store.hasKey('a'))
+        self.assertFalse(store.hasKey('b'))
+        self.assertFalse(store.hasKey('zz'))
+        np.testing.assert_array_equal(store.vectors('c'),
+            [self.replicates[i]['c'] for i in range(3)])
+        with self.assertRaises(KeyError):
+            store.vectors('d')
+
+    def testBatchLookupsMatchSingleLookups(self):
+        # reopening uses the persisted cache and sorted key indexes
+        self._store()
+        store = self._store()
+        keys = ['c', 'zz', 'a', 'b', 'a']
+        (vectors, found) = store.vectorsForKeys(keys)
+        self.assertEqual(vectors.shape, (3, len(keys), 2))
+        np.testing.assert_array_equal(found, [True, False, True, False, True])
+        for (j, key) in enumerate(keys):
+            if found[j]:
+                np.testing.assert_array_equal(vectors[:, j], store.vectors(key))
+        # missing keys come back as zeros
+        np.testing.assert_array_equal(vectors[:, 1], np.zeros((3, 2)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import tempfile
+import threading
+import unittest
+import configparser
+from unittest import mock
+import numpy as np
+import pyemblib
+from nearest_neighbors.data_models import EmbeddingSet, EmbeddingSetGroup
+from nearest_neighbors.database import EmbeddingNeighborhoodDatabase
+from nearest_neighbors.calculation import pair_similarity
+from tests.test_nn_io import _writeEmbeddingFile
+
+def _config(names):
+    config = configparser.ConfigParser()
+    config['PairedNeighborhoodAnalysis'] = {}
+    for name in names:
+        config[name] = {
+            'ReplicateTemplate': '/nonexistent/%s.{REPL}.bin' % name,
+            'EmbeddingFormat': 'bin',
+        }
+    return config
+
+class GetVectorStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (dict(pair_similarity._vector_stores), dict(pair_similarity._vector_store_locks))
+        pair_similarity._vector_stores.clear()
+        pair_similarity._vector_store_locks.clear()
+
+    def tearDown(self):
+        pair_similarity._vector_stores.clear()
+        pair_similarity._vector_stores.update(self._saved[0])
+        pair_similarity._vector_store_locks.clear()
+        pair_similarity._vector_store_locks.update(self._saved[1])
+
+    def testSlowBuildDoesNotBlockOtherEmbeddingSets(self):
+        (slow, fast) = (EmbeddingSet(None, 'slow', 0), EmbeddingSet(None, 'fast', 1))
+        config = _config(['slow', 'fast'])
+        building, release = threading.Event(), threading.Event()
+        num_built = []
+
+        def build(source, *args, **kwargs):
+            num_built.append(source.name)
+            if source.name == 'slow':
+                building.set()
+                release.wait(5)
+            return mock.sentinel.store
+
+        with mock.patch.object(pair_similarity.nn_io, 'EmbeddingVectorStore', side_effect=build):
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(pair_similarity.getVectorStore(slow, config)))
+                    for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            self.assertTrue(building.wait(5))
+
+            # another set's store is built (and served) while 'slow' builds
+            self.assertIs(pair_similarity.getVectorStore(fast, config), mock.sentinel.store)
+            self.assertIs(pair_similarity.getVectorStore(fast, config), mock.sentinel.store)
+
+            release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(results, [mock.sentinel.store, mock.sentinel.store])
+        # each store is only built once
+        self.assertEqual(sorted(num_built), ['fast', 'slow'])
+
+class PairwiseBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.dir = self._tmpdir.name
+        rng = np.random.RandomState(0)
+        keys = ['a', 'b', 'c', 'd']
+
+        self.config = configparser.ConfigParser()
+        self.config['PairedNeighborhoodAnalysis'] = {
+            'DatabaseFile': os.path.join(self.dir, 'test.db'),
+            'EmbeddingCacheDirectory': os.path.join(self.dir, 'cache'),
+        }
+        db = EmbeddingNeighborhoodDatabase(self.config['PairedNeighborhoodAnalysis']['DatabaseFile'])
+        self.group = EmbeddingSetGroup('test')
+        for (ordering, name) in enumerate(['corpus1', 'corpus2']):
+            os.mkdir(os.path.join(self.dir, name))
+            for i in range(3):
+                # 'd' is missing from corpus2
+                _writeEmbeddingFile(os.path.join(self.dir, name, '%d.txt' % i), {
+                    key: rng.normal(size=4)
+                        for key in keys
+                        if not (name == 'corpus2' and key == 'd')
+                })
+            self.config[name] = {
+                'ReplicateTemplate': os.path.join(self.dir, name, '{REPL}.txt'),
+                'EmbeddingFormat': pyemblib.Mode.Text,
+            }
+            db.insertOrUpdate(EmbeddingSet(self.group, name, ordering+1))
+        db.close()
+
+        self.pairs = [('a', 'b'), ('c', 'a'), ('a', 'd')]
+        self._saved_stores = dict(pair_similarity._vector_stores)
+        pair_similarity._vector_stores.clear()
+
+    def tearDown(self):
+        pair_similarity._vector_stores.clear()
+        pair_similarity._vector_stores.update(self._saved_stores)
+        self._tmpdir.cleanup()
+
+    def _db(self):
+        return EmbeddingNeighborhoodDatabase(self.config['PairedNeighborhoodAnalysis']['DatabaseFile'], build=False)
+
+    def _waitForBatch(self, batch_ID):
+        with pair_similarity._jobs_lock:
+            future = pair_similarity._jobs.get(('batch', batch_ID), None)
+        if not future is None:
+            future.exception(timeout=10)
+
+    def testBatchMatchesSinglePairs(self):
+        db = self._db()
+        for emb_set in db.selectFromEmbeddingSets(group_ID=self.group.ID):
+            replicates = pair_similarity.getVectorStore(emb_set, self.config)
+            batch_sims = pair_similarity.calculateAggregatePairwiseSimilarities(replicates, self.pairs)
+            for ((query, target), batch_sim) in zip(self.pairs, batch_sims):
+                self.assertEqual((batch_sim.key, batch_sim.neighbor_key), (query, target))
+                if replicates.hasKey(query) and replicates.hasKey(target):
+                    sim = pair_similarity.calculateAggregatePairwiseSimilarity(
+                        self.group, replicates, query, target, db)
+                    self.assertAlmostEqual(batch_sim.mean_similarity, sim.mean_similarity, places=5)
+                    self.assertAlmostEqual(batch_sim.std_similarity, sim.std_similarity, places=5)
+                else:
+                    self.assertIsNone(batch_sim.mean_similarity)
+        db.close()
+
+    def testBackgroundBatch(self):
+        # saved similarities are looked up without writing to the DB
+        db = EmbeddingNeighborhoodDatabase(self.config['PairedNeighborhoodAnalysis']['DatabaseFile'], read_only=True)
+        info = pair_similarity.calculateAggregatePairwiseSimilaritiesForPairsBackground(
+            self.group, self.pairs, self.config, db)
+        self.assertIsNone(info['result'])
+        self.assertIn(info['status'], ['queued', 'running'])
+        # the same pairs, in any order, are the same batch
+        self.assertEqual(pair_similarity._batchID(self.group, self.pairs[::-1]), info['batch'])
+
+        self._waitForBatch(info['batch'])
+        done = pair_similarity.getAggregatePairwiseSimilaritiesBatch(info['batch'], self.config, db)
+        self.assertEqual(done['batch'], info['batch'])
+        self.assertEqual(set(done['result'].keys()), set(self.pairs))
+        self.assertEqual([len(sims) for sims in done['result'].values()], [2, 2, 2])
+        self.assertFalse(db._connection.in_transaction)
+        self.assertIsNone(pair_similarity.getAggregatePairwiseSimilaritiesBatch('unknown', self.config, db))
+        db.close()
+
+    def testLookupDoesNotCommit(self):
+        db = self._db()
+        data_version = db.dataVersion()
+        db._bumpDataVersion()
+        list(db.selectFromAggregatePairwiseSimilarityForPairs(self.pairs))
+        # the caller's pending write is left uncommitted
+        self.assertTrue(db._connection.in_transaction)
+        db._connection.rollback()
+        self.assertEqual(db.dataVersion(), data_version)
+        self.assertEqual(list(db._connection.execute('SELECT name FROM sqlite_temp_master')), [])
+        db.close()
+
+    def testFailedBatch(self):
+        db = self._db()
+        with mock.patch.object(pair_similarity, 'calculateAggregatePairwiseSimilaritiesForPairs',
+                side_effect=ValueError('boom')):
+            info = pair_similarity.calculateAggregatePairwiseSimilaritiesForPairsBackground(
+                self.group, self.pairs, self.config, db)
+            self._waitForBatch(info['batch'])
+        failed = pair_similarity.getAggregatePairwiseSimilaritiesBatch(info['batch'], self.config, db)
+        self.assertEqual((failed['status'], failed['error']), ('failed', 'boom'))
+        db.close()
+
+    def testBusy(self):
+        db = self._db()
+        with mock.patch.object(pair_similarity, '_jobSettings', return_value=(0, 0)):
+            info = pair_similarity.calculateAggregatePairwiseSimilaritiesForPairsBackground(
+                self.group, self.pairs, self.config, db)
+        self.assertEqual((info['result'], info['status']), (None, 'busy'))
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import unittest
+import numpy as np
+from nearest_neighbors.analysis import paired_neighborhood_overlap as pno
+
+def _setOverlap(neighbors_1, neighbors_2):
+    '''Reference (set-based) version of getNeighborhoodOverlap.'''
+    overlap_percentages = {}
+    for key in set(neighbors_1.keys()).union(set(neighbors_2.keys())):
+        nbrs_1 = set([nbr_ID for (nbr_ID, dist) in neighbors_1.get(key, [])])
+        nbrs_2 = set([nbr_ID for (nbr_ID, dist) in neighbors_2.get(key, [])])
+        overlap_percentages[key] = len(nbrs_1 & nbrs_2) / max(len(nbrs_1), len(nbrs_2))
+    return overlap_percentages
+
+def _setOverlapDistributions(neighbor_sets_1, neighbor_sets_2, self_paired=False):
+    '''Reference (set-based) version of pairedOverlapDistributions.'''
+    samples = {}
+    for i in range(len(neighbor_sets_1)):
+        for j in range((i+1) if self_paired else 0, len(neighbor_sets_2)):
+            for (key, perc) in _setOverlap(neighbor_sets_1[i], neighbor_sets_2[j]).items():
+                samples.setdefault(key, []).append(perc)
+    return { key: np.mean(values) for (key, values) in samples.items() }
+
+def _randomNeighborSets(rng, num_sets, keys, vocab, k=5):
+    neighbor_sets = []
+    for _ in range(num_sets):
+        neighbors = {}
+        for key in keys:
+            # some keys are missing from some sets
+            if rng.rand() < 0.15:
+                continue
+            # (sampled with replacement, so neighbors may repeat)
+            neighbors[key] = [
+                (vocab[ix], float(rng.rand()))
+                    for ix in rng.randint(0, len(vocab), size=rng.randint(1, k+1))
+            ]
+        neighbor_sets.append(neighbors)
+    return neighbor_sets
+
+class PairedNeighborhoodOverlapTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.keys = ['C%03d' % i for i in range(60)]
+        self.vocab = ['N%d' % i for i in range(12)]
+
+    def testAlignNeighborSets(self):
+        neighbor_sets = [
+            {'a': [('x', 0.1), ('y', 0.2), ('x', 0.3)], 'b': [('z', 0.1)]},
+            {'c': [('y', 0.1)], 'a': [('z', 0.2)]},
+        ]
+        (keys, matrices, present, counts) = pno.alignNeighborSets(neighbor_sets)
+        self.assertEqual(keys, ['a', 'b', 'c'])
+        self.assertEqual(matrices.shape, (2, 3, 3))
+        self.assertEqual(present.tolist(), [[True, True, False], [True, False, True]])
+        # repeated neighbors are only counted once
+        self.assertEqual(counts.tolist(), [[2, 1, 0], [1, 0, 1]])
+
+    def testNeighborhoodOverlapMatchesSets(self):
+        for _ in range(5):
+            (neighbors_1, neighbors_2) = _randomNeighborSets(self.rng, 2, self.keys, self.vocab)
+            self.assertEqual(pno.getNeighborhoodOverlap(neighbors_1, neighbors_2),
+                _setOverlap(neighbors_1, neighbors_2))
+
+    def testOverlapDistributionsMatchSets(self):
+        sets_1 = _randomNeighborSets(self.rng, 4, self.keys, self.vocab)
+        sets_2 = _randomNeighborSets(self.rng, 3, self.keys[20:] + ['D1', 'D2'], self.vocab)
+        for (neighbor_sets_1, neighbor_sets_2, self_paired) in [
+                    (sets_1, sets_2, False),
+                    (sets_1, sets_1, True),
+                    (sets_1, sets_1, False),
+                ]:
+            actual = pno.pairedOverlapDistributions(neighbor_sets_1, neighbor_sets_2,
+                self_paired=self_paired)
+            expected = _setOverlapDistributions(neighbor_sets_1, neighbor_sets_2,
+                self_paired=self_paired)
+            self.assertEqual(set(actual.keys()), set(expected.keys()))
+            for key in expected:
+                self.assertAlmostEqual(actual[key], expected[key], places=12)
+
+    def testNoPairs(self):
+        sets = _randomNeighborSets(self.rng, 1, self.keys, self.vocab)
+        self.assertEqual(pno.pairedOverlapDistributions(sets, sets, self_paired=True), {})
+
+if __name__ == '__main__':
+    unittest.main()
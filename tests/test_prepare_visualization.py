@@ -0,0 +1,108 @@
+import os
+import json
+import gzip
+import tempfile
+import unittest
+from nearest_neighbors import nn_io
+from nearest_neighbors.calculation import prepare_visualization
+
+def _point(id_val, x, y, confidence, highlight):
+    return {
+        "id": id_val,
+        "x": x,
+        "y": y,
+        "confidence": confidence,
+        "color": "color %s" % id_val,
+        "hoverText": "name %s" % id_val,
+        "highlight": highlight,
+    }
+
+def _frameData(points):
+    return { point["id"]: point for point in points }
+
+class VisualizationFramesTests(unittest.TestCase):
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.out_path = os.path.join(self._tmpdir.name, 'vis.json')
+        self.data = [
+            _frameData([
+                _point('a', 0.123456, 1.0, 0.5, ['b', 'c']),
+                _point('b', 2.0, -1.0, 0.75, ['a', 'z']),
+            ]),
+            _frameData([
+                _point('c', 3.0, 0.5, 0.25, ['a']),
+                _point('a', -0.5, 0.0, 1.0, ['c', 'b']),
+            ]),
+        ]
+        self.corpora = ['2020-03', '2020-04']
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _readJSON(self, path):
+        with open(path, 'rb') as stream:
+            contents = stream.read()
+        with open('{0}.gz'.format(path), 'rb') as stream:
+            self.assertEqual(gzip.decompress(stream.read()), contents)
+        return json.loads(contents)
+
+    def _write(self, data, corpora):
+        prepare_visualization.write_visualization_frames(data, corpora, self.out_path, build='b1')
+
+    def testManifest(self):
+        self._write(self.data, self.corpora)
+        manifest = self._readJSON(nn_io.visualizationManifestPath(self.out_path))
+        self.assertEqual(manifest["build"], 'b1')
+        self.assertEqual(manifest["frameLabels"], self.corpora)
+        self.assertEqual(manifest["frames"], [
+            {"label": '2020-03', "numPoints": 2},
+            {"label": '2020-04', "numPoints": 2},
+        ])
+        # each point is stored once; neighbors that are never plotted have
+        # no hover text or color
+        points = manifest["points"]
+        self.assertEqual(sorted(points["id"]), ['a', 'b', 'c', 'z'])
+        for (id_val, hover_text, color) in zip(points["id"], points["hoverText"], points["color"]):
+            if id_val == 'z':
+                self.assertEqual((hover_text, color), (None, None))
+            else:
+                self.assertEqual((hover_text, color), ("name %s" % id_val, "color %s" % id_val))
+
+    def testFramesReconstructViewerData(self):
+        self._write(self.data, self.corpora)
+        points = self._readJSON(nn_io.visualizationManifestPath(self.out_path))["points"]
+        for (i, frame_data) in enumerate(self.data):
+            frame = self._readJSON(nn_io.visualizationFramePath(self.out_path, i))
+            self.assertEqual((frame["build"], frame["label"]), ('b1', self.corpora[i]))
+            reconstructed = {}
+            for j in range(len(frame["points"])):
+                ix = frame["points"][j]
+                reconstructed[points["id"][ix]] = {
+                    "id": points["id"][ix],
+                    "x": frame["x"][j],
+                    "y": frame["y"][j],
+                    "confidence": frame["confidence"][j],
+                    "color": points["color"][ix],
+                    "hoverText": points["hoverText"][ix],
+                    "highlight": [points["id"][nbr] for nbr in frame["highlight"][j]],
+                }
+            # (floats are rounded to 4 places, as in the full file)
+            expected = {
+                id_val: dict(item, x=round(item["x"], 4))
+                    for (id_val, item) in frame_data.items()
+            }
+            self.assertEqual(reconstructed, expected)
+
+    def testRemovesStaleFrames(self):
+        self._write(self.data + [_frameData([_point('d', 0.0, 0.0, 0.5, [])])],
+            self.corpora + ['2020-05'])
+        self.assertTrue(os.path.exists(nn_io.visualizationFramePath(self.out_path, 2)))
+        self._write(self.data, self.corpora)
+        for path in [nn_io.visualizationFramePath(self.out_path, 2),
+                '{0}.gz'.format(nn_io.visualizationFramePath(self.out_path, 2))]:
+            self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(self._readJSON(nn_io.visualizationManifestPath(self.out_path))["frames"]), 2)
+
+if __name__ == '__main__':
+    unittest.main()
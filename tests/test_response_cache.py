@@ -0,0 +1,98 @@
+import unittest
+from unittest import mock
+from flask import Flask, request
+from nearest_neighbors.dashboard.response_cache import ResponseCache
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('nearest_neighbors.dashboard.response_cache.time.monotonic',
+            side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testLRUEviction(self):
+        cache = ResponseCache(max_entries=2, ttl=60)
+        cache.put('a', 1, 'A')
+        cache.put('b', 1, 'B')
+        self.assertEqual(cache.get('a', 1), 'A')
+        # 'b' is now least recently used
+        cache.put('c', 1, 'C')
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), 'A')
+        self.assertEqual(cache.get('c', 1), 'C')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(len(cache), 2)
+
+    def testTTL(self):
+        cache = ResponseCache(max_entries=10, ttl=60)
+        cache.put('a', 1, 'A')
+        self.now += 59
+        self.assertEqual(cache.get('a', 1), 'A')
+        self.now += 2
+        self.assertIsNone(cache.get('a', 1))
+        self.assertEqual(len(cache), 0)
+
+    def testVersionKeying(self):
+        cache = ResponseCache(max_entries=10, ttl=60)
+        cache.put('a', 1, 'A')
+        self.assertIsNone(cache.get('a', 2))
+        # stale entries are dropped, not just skipped
+        self.assertIsNone(cache.get('a', 1))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['invalidations']), (0, 2, 1))
+
+    def testDisabled(self):
+        cache = ResponseCache(max_entries=0)
+        cache.put('a', 1, 'A')
+        self.assertIsNone(cache.get('a', 1))
+
+class CachedViewTests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = ResponseCache(max_entries=10, ttl=60)
+        self.version = 1
+        self.calls = 0
+        cached = self.cache.cached(self.app, lambda: self.version)
+
+        @self.app.route('/echo/<value>')
+        @cached
+        def echo(value):
+            self.calls += 1
+            if value == 'missing':
+                return 'not found', 404
+            return '{0}:{1}:{2}'.format(value, request.args.get('x', ''), self.calls)
+
+        self.client = self.app.test_client()
+
+    def testServesRepeatedRequestsFromCache(self):
+        first = self.client.get('/echo/a?x=1')
+        second = self.client.get('/echo/a?x=1')
+        self.assertEqual((first.headers['X-Cache'], second.headers['X-Cache']), ('MISS', 'HIT'))
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertEqual(self.calls, 1)
+
+    def testKeyedOnArgumentsAndEncoding(self):
+        self.client.get('/echo/a?x=1')
+        self.assertEqual(self.client.get('/echo/a?x=2').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/echo/b?x=1').headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get('/echo/a?x=1',
+            headers={'Accept-Encoding': 'gzip'}).headers['X-Cache'], 'MISS')
+        self.assertEqual(self.calls, 4)
+
+    def testInvalidatedOnNewVersion(self):
+        self.client.get('/echo/a')
+        self.version = 2
+        response = self.client.get('/echo/a')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(response.get_data(as_text=True), 'a::2')
+
+    def testErrorsAreNotCached(self):
+        self.client.get('/echo/missing')
+        self.client.get('/echo/missing')
+        self.assertEqual(self.calls, 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+from nearest_neighbors.data_models import EntityTerm
+from nearest_neighbors.dashboard import typeahead
+
+TERMS = [
+    EntityTerm('C001', 'Pneumonia due to virus', 0),
+    EntityTerm('C001', 'Viral pneumonia', 1),
+    EntityTerm('C002', 'COVID-19 pneumonia', 1),
+    EntityTerm('C003', 'Pneumothorax', 1),
+    EntityTerm('C004', 'Influenza', 1),
+]
+
+class _TermSource:
+    def __init__(self, terms):
+        self.terms = terms
+        self.num_reads = 0
+
+    def selectAllEntityTermsWithNeighbors(self):
+        self.num_reads += 1
+        return iter(self.terms)
+
+class TypeaheadIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = typeahead.TypeaheadIndex.build(TERMS)
+
+    def testMatchesWordStarts(self):
+        keys = [key for (key, _, _) in self.index.lookup('pneu')]
+        self.assertEqual(set(keys), {'C001', 'C002', 'C003'})
+        self.assertEqual(self.index.lookup('covid 19'),
+            [('C002', 'COVID-19 pneumonia', 'COVID-19 pneumonia')])
+        self.assertEqual(self.index.lookup('ZZZ'), [])
+        self.assertEqual(self.index.lookup('  '), [])
+
+    def testOneMatchPerEntityPreferringPreferredTerms(self):
+        self.assertEqual(self.index.lookup('pneumonia'), [
+            ('C001', 'Viral pneumonia', 'Viral pneumonia'),
+            ('C002', 'COVID-19 pneumonia', 'COVID-19 pneumonia'),
+        ])
+        # a non-preferred match still displays the preferred name
+        self.assertEqual(self.index.lookup('due to'),
+            [('C001', 'Viral pneumonia', 'Pneumonia due to virus')])
+
+    def testMatchesEntityKeys(self):
+        self.assertEqual(self.index.lookup('c004'), [('C004', 'Influenza', 'C004')])
+
+    def testLimit(self):
+        self.assertEqual(len(self.index.lookup('pneu', limit=2)), 2)
+
+    def testRanksPrefixesWithManyMatches(self):
+        # the best match sorts last in the index, past the entries that
+        # would be ranked on the fly
+        terms = [
+            EntityTerm('C1%02d' % i, 'Pa long non-preferred term %02d' % i, 0)
+                for i in range(20)
+        ] + [EntityTerm('C200', 'Pz', 1), EntityTerm('C201', 'Pb short', 1)]
+        with mock.patch.object(typeahead.TypeaheadIndex, 'MAX_SCAN', 5):
+            index = typeahead.TypeaheadIndex.build(terms)
+            for prefix in ['p', 'P ', 'pa', 'pa long non']:
+                with mock.patch.object(typeahead.TypeaheadIndex, 'MAX_SCAN', 10**6):
+                    expected = index.lookup(prefix, limit=3)
+                self.assertEqual(index.lookup(prefix, limit=3), expected)
+            self.assertEqual([key for (key, _, _) in index.lookup('p', limit=3)],
+                ['C200', 'C201', 'C100'])
+
+class GetIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        typeahead._current = (None, None)
+
+    def tearDown(self):
+        typeahead._current = (None, None)
+
+    def testRebuildsOnlyWhenVersionChanges(self):
+        source = _TermSource(TERMS)
+        first = typeahead.getIndex(source, version=1)
+        self.assertIs(typeahead.getIndex(source, version=1), first)
+        self.assertEqual(source.num_reads, 1)
+
+        source.terms = TERMS + [EntityTerm('C005', 'Bronchitis', 1)]
+        second = typeahead.getIndex(source, version=2)
+        self.assertIsNot(second, first)
+        self.assertEqual(source.num_reads, 2)
+        self.assertEqual(second.lookup('bronch'), [('C005', 'Bronchitis', 'Bronchitis')])
+
+    def testServesPreviousIndexDuringRebuild(self):
+        source = _TermSource(TERMS)
+        first = typeahead.getIndex(source, version=1)
+        with typeahead._build_lock:
+            self.assertIs(typeahead.getIndex(source, version=2), first)
+        self.assertEqual(source.num_reads, 1)
+
+if __name__ == '__main__':
+    unittest.main()